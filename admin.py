@@ -15,10 +15,30 @@
 # Copyright (C) 2012 Attila Nagy
 
 import hk.models
+from django import forms
 from django.contrib import admin
 
+class MessageVersionForm(forms.ModelForm):
+    # The text of the versions with a text base is a delta (see
+    # hk.textdelta), so the full text is shown and an edited version is
+    # stored in full.
+
+    class Meta:
+        model = hk.models.MessageVersion
+
+    def __init__(self, *args, **kwargs):
+        super(MessageVersionForm, self).__init__(*args, **kwargs)
+        if self.instance.text_base_id is not None:
+            self.initial['text'] = self.instance.get_text()
+
+    def save(self, commit=True):
+        self.instance.text_base = None
+        return super(MessageVersionForm, self).save(commit)
+
+
 class MessageVersionInline(admin.StackedInline):
     model = hk.models.MessageVersion
+    form = MessageVersionForm
     fieldsets = [
         (None, {'fields': ['author', 'parent', 'deleted']}),
         ('Header information',
@@ -27,8 +47,9 @@ class MessageVersionInline(admin.StackedInline):
                 'classes': ['collapse']
             }
         ),
-        (None, {'fields': ['text']}),
+        (None, {'fields': ['text', 'text_base']}),
     ]
+    readonly_fields = ('text_base',)
     fk_name = "message"
     extra = 1
 
@@ -38,6 +59,11 @@ class MessageAdmin(admin.ModelAdmin):
     readonly_fields = ('latest_version_link', 'get_root_message', 'get_children') 
 
 
+class MessageVersionAdmin(admin.ModelAdmin):
+    form = MessageVersionForm
+    readonly_fields = ('text_base',)
+
+
 class UserRightInline(admin.TabularInline):
     model = hk.models.UserRight
     extra = 1
@@ -50,6 +76,11 @@ class HeapAdmin(admin.ModelAdmin):
 admin.site.register(hk.models.Heap, HeapAdmin)
 admin.site.register(hk.models.Conversation)
 admin.site.register(hk.models.Message, MessageAdmin)
-admin.site.register(hk.models.MessageVersion)
+admin.site.register(hk.models.MessageVersion, MessageVersionAdmin)
 admin.site.register(hk.models.Label)
 admin.site.register(hk.models.UserRight)
+admin.site.register(hk.models.PendingReply)
+admin.site.register(hk.models.Blob)
+admin.site.register(hk.models.Attachment)
+admin.site.register(hk.models.LabelCount)
+admin.site.register(hk.models.RetentionPolicy)
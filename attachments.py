@@ -0,0 +1,339 @@
+# This file is part of Heapkeeper.
+#
+# Heapkeeper is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Heapkeeper is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Heapkeeper.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright (C) 2012 Csaba Hoch
+
+# Storage of the attachments of messages.
+#
+# The content of the attachments is not stored in the database but in files
+# named after the SHA-256 digest of their content ("content-addressed"), in the
+# HK_ATTACHMENT_DIR directory. Identical attachments are stored only once: each
+# file has a Blob row, which counts the attachments (of message versions)
+# referring to it, and the Attachment rows refer to the Blob.
+#
+# A file is written into the "tmp" subdirectory and renamed to its final name
+# when it is complete, so a file with a digest as its name is always complete.
+#
+# Files are removed by `collect_garbage` when no attachment refers to them. A
+# file is written before the transaction that adds its attachment is
+# committed, so files modified within the grace period are kept even if they
+# have no references; writing a file that exists already renews its
+# modification time.
+#
+# Attachments are served by the `attachment` view, with ETags (the digest) and
+# byte ranges. If HK_ATTACHMENT_SENDFILE is set, the view only checks the
+# access and the web server sends the file: its value is the name of the
+# header understood by the web server (e.g. "X-Accel-Redirect" for nginx, in
+# which case HK_ATTACHMENT_SENDFILE_URL is the internal location of the
+# attachment directory; "X-Sendfile" for Apache's mod_xsendfile).
+
+import hashlib
+import os
+import re
+import tempfile
+import time
+import urllib
+from django.conf import settings
+from django.db import connection, transaction
+from django.http import Http404, HttpResponse, HttpResponseNotModified
+from django.shortcuts import get_object_or_404
+from hk.models import *
+from hk.threads import chunks
+
+# The size of the pieces in which files are sent
+CHUNK_SIZE = 65536
+
+def get_attachment_dir():
+    return getattr(settings, 'HK_ATTACHMENT_DIR',
+                   os.path.join(tempfile.gettempdir(),
+                                'heapkeeper-attachments'))
+
+def get_blob_path(digest):
+    return os.path.join(get_attachment_dir(), digest[:2], digest)
+
+
+class BlobWriter(object):
+    """Writes a file into the attachment store while its digest is
+    calculated.
+
+    The content is given by `write`, and the file is added to the store by
+    `close` (or thrown away by `abort`).
+    """
+
+    def __init__(self):
+        tmp_dir = os.path.join(get_attachment_dir(), 'tmp')
+        if not os.path.isdir(tmp_dir):
+            os.makedirs(tmp_dir)
+        fd, self.tmp_path = tempfile.mkstemp(dir=tmp_dir)
+        self.file = os.fdopen(fd, 'wb')
+        self.hash = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.file.write(data)
+        self.hash.update(data)
+        self.size += len(data)
+
+    def close(self):
+        """Adds the file to the store.
+
+        **Returns:** str -- The digest of the content.
+        """
+
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        digest = self.hash.hexdigest()
+        path = get_blob_path(digest)
+        try:
+            # The file is protected from the garbage collector until its
+            # attachment is added
+            os.utime(path, None)
+            os.remove(self.tmp_path)
+        except OSError:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            os.rename(self.tmp_path, path)
+        return digest
+
+    def abort(self):
+        self.file.close()
+        os.remove(self.tmp_path)
+
+
+##### Attachments
+
+def add_attachment(version, filename, content_type, size, digest):
+    """Attaches a file of the attachment store to a message version.
+
+    **Arguments:**
+
+    - `version` (MessageVersion)
+    - `filename` (unicode)
+    - `content_type` (str)
+    - `size` (int) -- The size of the file.
+    - `digest` (str) -- The digest of the file (see `BlobWriter.close`).
+
+    **Returns:** Attachment
+    """
+
+    blob, created = Blob.objects.get_or_create(digest=digest,
+                                               defaults={'size': size})
+    attachment = Attachment(version=version, blob=blob, filename=filename,
+                            content_type=content_type)
+    attachment.save()
+    return attachment
+
+def parse_range(header, size):
+    """Parses the value of a Range header.
+
+    Only single byte ranges are supported; other ranges are ignored, as
+    allowed by RFC 2616.
+
+    **Arguments:**
+
+    - `header` (str)
+    - `size` (int) -- The size of the file.
+
+    **Returns:** (int, int) | None -- The first and last byte of the range;
+    ``None`` if the whole file should be sent.
+
+    **Raises:** ValueError if the range is not satisfiable.
+    """
+
+    m = re.match(r'^bytes=(\d*)-(\d*)$', header.strip())
+    if m is None or m.group(1) == m.group(2) == '':
+        return None
+    if m.group(1) == '':
+        # The last bytes of the file
+        length = int(m.group(2))
+        if length == 0 or size == 0:
+            raise ValueError('Range not satisfiable')
+        return max(size - length, 0), size - 1
+    first = int(m.group(1))
+    last = int(m.group(2)) if m.group(2) != '' else size - 1
+    if m.group(2) != '' and last < first:
+        return None
+    if first >= size:
+        raise ValueError('Range not satisfiable')
+    return first, min(last, size - 1)
+
+def read_file(path, first, length):
+    # Yields `length` bytes of a file from the given position.
+    with open(path, 'rb') as f:
+        f.seek(first)
+        while length > 0:
+            data = f.read(min(length, CHUNK_SIZE))
+            if not data:
+                break
+            length -= len(data)
+            yield data
+
+def content_disposition(filename):
+    # The file name is given in ASCII and (for newer browsers) in UTF-8 as
+    # well, see RFC 6266.
+    ascii_name = filename.encode('ascii', 'replace').replace('"', '')
+    utf8_name = urllib.quote(filename.encode('utf-8'), safe='')
+    return ('attachment; filename="%s"; filename*=UTF-8\'\'%s'
+            % (ascii_name, utf8_name))
+
+def attachment(request, attachment_id):
+    attachment = get_object_or_404(Attachment.objects.select_related('blob'),
+                                   pk=attachment_id)
+    attachment.version.message.get_heap().check_access(request.user, 0)
+    blob = attachment.blob
+    etag = '"%s"' % blob.digest
+    if etag in re.split(r'\s*,\s*',
+                        request.META.get('HTTP_IF_NONE_MATCH', '')):
+        response = HttpResponseNotModified()
+        response['ETag'] = etag
+        return response
+
+    path = get_blob_path(blob.digest)
+    if not os.path.exists(path):
+        raise Http404
+    sendfile = getattr(settings, 'HK_ATTACHMENT_SENDFILE', None)
+    if sendfile is not None:
+        # The web server handles the ranges
+        response = HttpResponse(content_type=attachment.content_type)
+        if sendfile == 'X-Accel-Redirect':
+            response[sendfile] = '%s/%s/%s' % (
+                    settings.HK_ATTACHMENT_SENDFILE_URL.rstrip('/'),
+                    blob.digest[:2], blob.digest)
+        else:
+            response[sendfile] = path
+    else:
+        byte_range = None
+        if request.META.get('HTTP_IF_RANGE', etag) == etag:
+            try:
+                byte_range = parse_range(request.META.get('HTTP_RANGE', ''),
+                                         blob.size)
+            except ValueError:
+                response = HttpResponse(status=416)
+                response['Content-Range'] = 'bytes */%d' % blob.size
+                return response
+        if byte_range is None:
+            first, last = 0, blob.size - 1
+            status = 200
+        else:
+            first, last = byte_range
+            status = 206
+        response = HttpResponse(read_file(path, first, last - first + 1),
+                                content_type=attachment.content_type,
+                                status=status)
+        response['Content-Length'] = str(last - first + 1)
+        if status == 206:
+            response['Content-Range'] = \
+                'bytes %d-%d/%d' % (first, last, blob.size)
+        response['Accept-Ranges'] = 'bytes'
+
+    response['ETag'] = etag
+    response['Cache-Control'] = 'private'
+    response['Content-Disposition'] = content_disposition(attachment.filename)
+    response['X-Content-Type-Options'] = 'nosniff'
+    return response
+
+
+##### Garbage collection
+
+def get_grace_period():
+    return getattr(settings, 'HK_ATTACHMENT_GRACE_PERIOD', 3600)
+
+@transaction.commit_on_success
+def recount_references():
+    """Recalculates the reference counts of the blobs.
+
+    **Returns:** int -- The number of blobs whose count was wrong.
+    """
+
+    blob_table = connection.ops.quote_name(Blob._meta.db_table)
+    attachment_table = connection.ops.quote_name(Attachment._meta.db_table)
+    count = ('(SELECT COUNT(*) FROM %s WHERE %s.blob_id = %s.id)'
+             % (attachment_table, attachment_table, blob_table))
+    cursor = connection.cursor()
+    cursor.execute('UPDATE %s SET refcount = %s WHERE refcount <> %s'
+                   % (blob_table, count, count))
+    transaction.set_dirty()
+    return cursor.rowcount
+
+def collect_garbage(dry_run=False, grace_period=None):
+    """Removes the blobs that have no attachments and the files of the
+    attachment store that have no blobs.
+
+    Files modified within the grace period are kept.
+
+    **Arguments:**
+
+    - `dry_run` (bool) -- Only count what would be removed.
+    - `grace_period` (int | None) -- In seconds; the default is the
+      HK_ATTACHMENT_GRACE_PERIOD setting.
+
+    **Returns:** (int, int) -- The number of files removed and their total
+    size.
+    """
+
+    if grace_period is None:
+        grace_period = get_grace_period()
+    deadline = time.time() - grace_period
+    removed = [0, 0]
+
+    def remove(path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False # Removed already
+        if stat.st_mtime >= deadline:
+            return False
+        if not dry_run:
+            os.remove(path)
+        removed[0] += 1
+        removed[1] += stat.st_size
+        return True
+
+    # Blobs whose count is wrong are never removed while they have
+    # attachments
+    unreferenced = Blob.objects.filter(refcount__lte=0,
+                                       attachment__isnull=True)
+    for blob_id, digest in list(unreferenced.values_list('id', 'digest')):
+        path = get_blob_path(digest)
+        if dry_run:
+            remove(path)
+            continue
+        with transaction.commit_on_success():
+            # The blob may have got an attachment in the meantime
+            if unreferenced.filter(pk=blob_id).exists() and \
+               (remove(path) or not os.path.exists(path)):
+                unreferenced.filter(pk=blob_id).delete()
+
+    # Files that were written but whose attachment was never added
+    root = get_attachment_dir()
+    if not os.path.isdir(root):
+        return tuple(removed)
+    for dirname in sorted(os.listdir(root)):
+        directory = os.path.join(root, dirname)
+        if not os.path.isdir(directory):
+            continue
+        if dirname == 'tmp':
+            for filename in os.listdir(directory):
+                remove(os.path.join(directory, filename))
+            continue
+        filenames = os.listdir(directory)
+        known = set()
+        for chunk in chunks(filenames):
+            known.update(Blob.objects.filter(digest__in=chunk)
+                             .values_list('digest', flat=True))
+        for filename in filenames:
+            if filename not in known:
+                remove(os.path.join(directory, filename))
+    return tuple(removed)
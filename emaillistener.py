@@ -17,87 +17,454 @@
 # Copyright (C) 2012 Csaba Hoch
 
 import asyncore
-import base64
 import datetime
-import email
-import email.header
-import quopri
+import errno
+import itertools
+import json
+import os
 import re
 import smtpd
+import socket
+import tempfile
+import threading
 import time
-import multiprocessing
+import traceback
+from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import PermissionDenied
 from django.core.urlresolvers import reverse
+from django.db import connection, transaction
 from django.shortcuts import render, redirect
+from hk.attachments import add_attachment
+from hk import ingestcache
+from hk.mime import parse_mail_file
 from hk.models import *
+from hk.threads import chunks
 
 
-##### SMTP server to receive mail
+##### SMTP service to receive mail
 
-email_thread = None
+# The SMTP service is a separate process started by "manage.py smtpserver".
+# Its event loop (asyncore) only receives the mails and writes them into a
+# spool directory (see Spool); a mail is acknowledged only after it is safely
+# on the disk. A pool of worker threads parses the spooled mails and writes
+# them into the database in batches, so neither a slow nor a locked database
+# stalls the senders or loses mail.
+#
+# The service and the "smtp" views communicate through two files in the
+# HK_SMTP_DIR directory: the service writes its counters into the status file
+# every second, and the views write into the control file whether the service
+# should accept connections.
+
+STATUS_FILE = 'status.json'
+CONTROL_FILE = 'control.json'
+
+# The service is considered down if it has not written its status for this
+# many seconds.
+STATUS_TIMEOUT = 10
+
+# The default of the HK_SMTP_MAX_MESSAGE_SIZE setting (bytes)
+MAX_MESSAGE_SIZE = 32 * 1024 * 1024
+
+def get_max_message_size():
+    return getattr(settings, 'HK_SMTP_MAX_MESSAGE_SIZE', MAX_MESSAGE_SIZE)
+
+def get_smtp_dir():
+    return getattr(settings, 'HK_SMTP_DIR',
+                   os.path.join(tempfile.gettempdir(), 'heapkeeper-smtp'))
+
+def read_json(filename):
+    try:
+        with open(os.path.join(get_smtp_dir(), filename)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+def write_json(filename, data):
+    # The file is replaced atomically, so the reader never sees a partial
+    # file.
+    directory = get_smtp_dir()
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    path = os.path.join(directory, filename)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(data, f)
+    os.rename(path + '.tmp', path)
+
+class Spool(object):
+    """A Maildir-like directory of the mails received but not stored yet.
+
+    A mail is written into the "tmp" subdirectory, synced to the disk and
+    then renamed into "new", so "new" contains only complete mails. A worker
+    claims a mail by renaming it into "cur", and removes it after the mail is
+    stored in the database. The mails in "cur" when the service starts were
+    being stored when it stopped, so they are moved back into "new".
+
+    The file name contains the number of failed attempts to store the mail
+    and the time before which it should not be tried again. The mails that
+    failed too many times are moved into "failed".
+
+    The first line of the file contains the envelope (sender, recipients and
+    time of arrival); the rest is the mail.
+
+    **Argument:**
+
+    - `directory` (str)
+    """
 
-def normalize_str(s):
-    s = re.sub(r'\r\n', r'\n', s) # Windows EOL
-    s = re.sub(r'\xc2\xa0', ' ', s) # Non-breaking space
-    return s
+    subdirs = ('tmp', 'new', 'cur', 'failed')
 
-def utf8(s, charset):
-    if charset is not None:
-        return s.decode(charset).encode('utf-8')
-    else:
-        return s
+    def __init__(self, directory):
+        self.directory = directory
+        self.counter = itertools.count()
+        self.hostname = re.sub(r'[^\w.-]', '_', socket.gethostname())
+        for subdir in self.subdirs:
+            if not os.path.isdir(self.path(subdir)):
+                os.makedirs(self.path(subdir))
 
-class FakeSMTPServer(smtpd.DebuggingServer):
-    def __init__(*args, **kwargs):
-        smtpd.SMTPServer.__init__(*args, **kwargs)
+    def path(self, subdir, name=''):
+        return os.path.join(self.directory, subdir, name)
+
+    def sync_dir(self, subdir):
+        fd = os.open(self.path(subdir), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def add(self, mailfrom, rcpttos, data):
+        received = time.time()
+        name = '%.6f.%d_%d.%s' % (received, os.getpid(), next(self.counter),
+                                  self.hostname)
+        envelope = json.dumps({'from': mailfrom,
+                               'to': rcpttos,
+                               'received': received})
+        with open(self.path('tmp', name), 'wb') as f:
+            f.write(envelope + '\n')
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(self.path('tmp', name),
+                  self.path('new', '%s,0,0' % name))
+        self.sync_dir('new')
+
+    def read(self, name):
+        # Returns the sender, the recipients, the time of arrival and the
+        # parsed mail (see hk.mime.ParsedMail) of a claimed mail.
+        with open(self.path('cur', name), 'rb') as f:
+            envelope = json.loads(f.readline())
+            mail = parse_mail_file(f)
+        return (envelope['from'], envelope['to'], envelope['received'], mail)
+
+    def claim(self, count):
+        """Claims the oldest mails that can be stored now.
+
+        **Argument:**
+
+        - `count` (int) -- The maximum number of mails to claim.
+
+        **Returns:** [str] -- The names of the claimed mails.
+        """
+
+        now = time.time()
+        claimed = []
+        for name in sorted(os.listdir(self.path('new'))):
+            if len(claimed) == count:
+                break
+            if float(name.rsplit(',', 2)[2]) > now:
+                continue
+            try:
+                os.rename(self.path('new', name), self.path('cur', name))
+            except OSError, e:
+                if e.errno == errno.ENOENT:
+                    continue # Claimed by another worker
+                raise
+            claimed.append(name)
+        return claimed
+
+    def done(self, name):
+        os.remove(self.path('cur', name))
+
+    def retry(self, name, max_attempts):
+        # Puts back a mail that could not be stored; it is tried again later
+        # (the delay doubles after each attempt), or it is given up.
+        # Returns whether it will be tried again.
+        unique, attempts, not_before = name.rsplit(',', 2)
+        attempts = int(attempts) + 1
+        if attempts >= max_attempts:
+            os.rename(self.path('cur', name), self.path('failed', name))
+            return False
+        delay = min(2 ** attempts, 3600)
+        os.rename(self.path('cur', name),
+                  self.path('new', '%s,%d,%d' % (unique, attempts,
+                                                 time.time() + delay)))
+        return True
+
+    def recover(self):
+        for name in os.listdir(self.path('cur')):
+            os.rename(self.path('cur', name), self.path('new', name))
+
+    def count(self):
+        return len(os.listdir(self.path('new')))
+
+
+class Counters(object):
+    """The counters of the SMTP service. They are updated by several
+    threads."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {
+            'connections': 0,      # accepted connections
+            'open_connections': 0,
+            'received': 0,         # mails written into the spool
+            'rejected': 0,         # mails that could not be spooled
+            'too_large': 0,        # mails refused because of their size
+            'stored': 0,           # mails written into the database
+            'retried': 0,          # failed attempts to store a mail
+            'failed': 0,           # mails given up
+            'batches': 0,          # transactions of the workers
+            'latency_total': 0.0,  # seconds from receiving to storing
+            'latency_max': 0.0,
+        }
+
+    def add(self, name, value=1):
+        with self.lock:
+            self.values[name] += value
+
+    def add_latency(self, latency):
+        with self.lock:
+            self.values['latency_total'] += latency
+            self.values['latency_max'] = max(self.values['latency_max'],
+                                             latency)
+
+    def get(self):
+        with self.lock:
+            return dict(self.values)
+
+
+class SMTPChannel(smtpd.SMTPChannel):
+    # Counts the open connections and refuses the mails that are larger than
+    # HK_SMTP_MAX_MESSAGE_SIZE. smtpd keeps the whole DATA of a mail in
+    # memory, so the data of a mail that is too large is thrown away while it
+    # arrives, and the mail is refused when it ends. The state of the
+    # conversation is kept in the private attributes of smtpd.SMTPChannel.
+
+    def __init__(self, server, conn, addr):
+        self.counters = server.counters
+        self.counters.add('connections')
+        self.counters.add('open_connections')
+        self.counted = True
+        self.max_size = get_max_message_size()
+        self.data_size = 0
+        smtpd.SMTPChannel.__init__(self, server, conn, addr)
+
+    def collect_incoming_data(self, data):
+        if self._SMTPChannel__state == self.DATA:
+            self.data_size += len(data)
+            if self.data_size > self.max_size:
+                self._SMTPChannel__line = []
+                return
+        smtpd.SMTPChannel.collect_incoming_data(self, data)
+
+    def found_terminator(self):
+        if (self._SMTPChannel__state == self.DATA and
+            self.data_size > self.max_size):
+            self._SMTPChannel__line = []
+            self._SMTPChannel__rcpttos = []
+            self._SMTPChannel__mailfrom = None
+            self._SMTPChannel__state = self.COMMAND
+            self.set_terminator('\r\n')
+            self.data_size = 0
+            self.counters.add('too_large')
+            self.push('552 Message size exceeds the limit of %d bytes'
+                      % self.max_size)
+            return
+        self.data_size = 0
+        smtpd.SMTPChannel.found_terminator(self)
+
+    def close(self):
+        if self.counted:
+            self.counted = False
+            self.counters.add('open_connections', -1)
+        smtpd.SMTPChannel.close(self)
+
+
+class SMTPServer(smtpd.SMTPServer):
+
+    def __init__(self, port, service):
+        smtpd.SMTPServer.__init__(self, ('0.0.0.0', port), None)
+        self.service = service
+        self.counters = service.counters
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            conn, addr = pair
+            SMTPChannel(self, conn, addr)
 
     def process_message(self, peer, mailfrom, rcpttos, data):
-        print 'Received mail from %s to %s.' % (mailfrom, rcpttos,)
-        mail = email.message_from_string(data)
-
-        subject = email.header.decode_header(mail['Subject'])[0][0]
-        message_id = email.header.decode_header(mail['Message-ID'])[0][0]
-        in_reply_to = email.header.decode_header(mail['In-Reply-To'])[0][0]
-
-        text = mail.get_payload()
-        encoding = mail['Content-Transfer-Encoding']
-        if encoding != None:
-            if encoding.lower() in ('7bit', '8bit', 'binary'):
-                pass # no conversion needed
-            elif encoding.lower() == 'base64':
-                text = base64.b64decode(text)
-            elif encoding.lower() == 'quoted-printable':
-                text = quopri.decodestring(text)
-            else:
-                print('WARNING: Unknown encoding, skipping decoding: '
-                            '%s\n'
-                            'text:\n%s\n' % (encoding, text))
-        charset = mail.get_content_charset()
-        text = utf8(text, charset)
-        text = normalize_str(text)
-
-        message_from_mail(mailfrom, rcpttos,
-                          subject, message_id, in_reply_to,
-                          text)
-
-
-def server_thread(port=25):
-    smtp_server = FakeSMTPServer(('0.0.0.0', port), None)
-    asyncore.loop()
-
-def run_server_thread(port):
-    global email_thread
-    if email_thread is not None and email_thread.is_alive():
-        print "STMP thread already running!"
-        return
-    email_thread = multiprocessing.Process(target=server_thread,
-                                           args=(int(port),))
-    email_thread.start()
-    print "STMP thread started."
+        # Called by the event loop, so it must not wait for the database.
+        try:
+            self.service.spool.add(mailfrom, rcpttos, data)
+        except (IOError, OSError):
+            traceback.print_exc()
+            self.counters.add('rejected')
+            return '451 The mail could not be saved, try again later'
+        self.counters.add('received')
+        self.service.wakeup.set()
+
+
+class MailService(object):
+    """The SMTP service: an SMTP server and the workers that store the mails
+    it receives.
+
+    **Arguments:**
+
+    - `port` (int) -- The port to listen on.
+    - `workers` (int) -- The number of worker threads.
+    - `batch_size` (int) -- The maximum number of mails stored in one
+      transaction.
+    - `max_attempts` (int) -- The number of attempts to store a mail before
+      it is given up.
+    """
 
-def stop_server_thread():
-    email_thread.terminate()
+    def __init__(self, port, workers, batch_size, max_attempts):
+        self.port = port
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.spool = Spool(os.path.join(get_smtp_dir(), 'spool'))
+        self.counters = Counters()
+        self.workers = [threading.Thread(target=self.run_worker)
+                        for i in range(workers)]
+        # Set when a mail arrives or the service stops
+        self.wakeup = threading.Event()
+        self.stopping = False
+        self.server = None
+        self.started = datetime.datetime.now()
+
+    def run_worker(self):
+        try:
+            while not self.stopping:
+                names = self.spool.claim(self.batch_size)
+                if names:
+                    self.store(names)
+                else:
+                    self.wakeup.wait(1)
+                    self.wakeup.clear()
+        finally:
+            connection.close()
+
+    def store(self, names):
+        # Stores the claimed mails in one transaction. If that fails, they
+        # are stored one by one, so that only the wrong mails are retried.
+        mails = []
+        for name in names:
+            try:
+                mailfrom, rcpttos, received, mail = self.spool.read(name)
+                mails.append(
+                    (name, received, (mailfrom, rcpttos) + mail.get_fields()))
+            except Exception:
+                self.retry(name)
+        try:
+            store_mails([args for name, received, args in mails])
+            self.counters.add('batches')
+            for name, received, args in mails:
+                self.stored(name, received)
+        except Exception:
+            for name, received, args in mails:
+                try:
+                    store_mails([args])
+                    self.counters.add('batches')
+                    self.stored(name, received)
+                except Exception:
+                    self.retry(name)
+
+    def stored(self, name, received):
+        self.spool.done(name)
+        self.counters.add('stored')
+        self.counters.add_latency(time.time() - received)
+
+    def retry(self, name):
+        print 'Could not store mail %s:' % name
+        traceback.print_exc()
+        if self.spool.retry(name, self.max_attempts):
+            self.counters.add('retried')
+        else:
+            self.counters.add('failed')
+
+    def set_accepting(self, accepting, port):
+        if self.server is not None and (not accepting or port != self.port):
+            self.server.close()
+            self.server = None
+            print 'Not accepting mail.'
+        if accepting and self.server is None:
+            self.server = SMTPServer(port, self)
+            self.port = port
+            print 'Accepting mail on port %d.' % port
+
+    def write_status(self):
+        status = self.counters.get()
+        status.update({
+            'pid': os.getpid(),
+            'port': self.port,
+            'accepting': self.server is not None,
+            'queued': self.spool.count(),
+            'workers': len(self.workers),
+            'started': self.started.strftime('%Y-%m-%d %H:%M:%S'),
+            'updated': time.time(),
+        })
+        write_json(STATUS_FILE, status)
+
+    def run(self):
+        """Runs the service until it is interrupted (e.g. by CTRL-C). The
+        mails that are not stored by then remain in the spool and are stored
+        after the service is started again."""
+
+        self.spool.recover()
+        for worker in self.workers:
+            worker.start()
+        # A service started by hand accepts mails until it is disabled from
+        # the web interface.
+        write_json(CONTROL_FILE, {'accepting': True, 'port': self.port})
+        try:
+            while True:
+                control = read_json(CONTROL_FILE) or {}
+                self.set_accepting(control.get('accepting', True),
+                                   int(control.get('port', self.port)))
+                self.write_status()
+                # The loop returns after one second at the latest, so the
+                # control file is read and the status is written regularly.
+                deadline = time.time() + 1
+                while time.time() < deadline:
+                    timeout = max(deadline - time.time(), 0)
+                    if asyncore.socket_map:
+                        asyncore.loop(timeout=timeout, count=1)
+                    else:
+                        time.sleep(timeout)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.set_accepting(False, self.port)
+            self.stopping = True
+            self.wakeup.set()
+            for worker in self.workers:
+                worker.join()
+            write_json(STATUS_FILE, {})
+
+def get_service_status():
+    """Returns the status of the SMTP service.
+
+    **Returns:** dict | None -- The counters and the state of the service (see
+    `MailService.write_status`), or ``None`` if it is not running.
+    """
+
+    status = read_json(STATUS_FILE)
+    if not status or time.time() - status['updated'] > STATUS_TIMEOUT:
+        return None
+    stored = status['stored']
+    status['latency_avg'] = status['latency_total'] / stored if stored else 0
+    return status
 
 ##### Mail to message
 
@@ -139,40 +506,265 @@ def parse_subject(subject):
 
 def message_from_mail(mailfrom, rcpttos,
                       subject, message_id, in_reply_to,
-                      text):
+                      text, references=(), attachments=()):
+    store_mails([(mailfrom, rcpttos, subject, message_id, in_reply_to, text,
+                  references, attachments)],
+                skip_stored=False)
+
+def store_mails(mails, skip_stored=True):
+    # Stores mails in one transaction. If `skip_stored` is true, a mail is
+    # not stored again into the heaps that it was stored into already: the
+    # service may stop after storing a mail but before removing it from the
+    # spool.
+    try:
+        add_mails(mails, skip_stored)
+    finally:
+        # The cache entries read in the transaction may refer to the messages
+        # stored in it, which do not exist if it was rolled back.
+        ingestcache.invalidate('message', [mail[3] for mail in mails])
+
+@transaction.commit_on_success
+def add_mails(mails, skip_stored):
+    for mail in mails:
+        message_id = mail[3]
+        if skip_stored and message_id:
+            stored_heaps = set(heap_id for msg_id, heap_id in
+                               look_up_messages([message_id])[message_id])
+        else:
+            stored_heaps = set()
+        add_mail(*mail, stored_heaps=stored_heaps)
+
+
+##### Lookups
+
+# The address of the sender in the From header
+SENDER_RE = re.compile('[-._A-Za-z0-9]+@[-._A-Za-z0-9]+')
+
+# The short name of the heap in the address of a recipient
+RECIPIENT_RE = re.compile('^([^@].*)@')
+
+def get_heaps(short_names):
+    """Looks up heaps by their short names, using the ingest cache.
+
+    **Argument:**
+
+    - `short_names` ([str])
+
+    **Returns:** {str: Heap | None}
+    """
+
+    found = ingestcache.get_entries('heap', short_names)
+    missing = [name for name in short_names if found.get(name) is None]
+    if missing:
+        # Missing heaps are not cached: they may be created by another
+        # process, which cannot invalidate the entries of this one.
+        heaps = {}
+        for heap in Heap.objects.filter(short_name__in=missing) \
+                        .order_by('-id'):
+            heaps[heap.short_name] = heap
+        ingestcache.set_entries('heap', heaps)
+        found.update(heaps)
+        for name in missing:
+            found.setdefault(name, None)
+    return found
+
+def get_author(mailfrom):
+    """Looks up the user who sent a mail, using the ingest cache.
+
+    **Argument:**
+
+    - `mailfrom` (str) -- The sender of the mail.
+
+    **Returns:** User | None
+    """
+
+    match = SENDER_RE.search(mailfrom)
+    if match is None:
+        return None
+    email = match.group(0)
+    found = ingestcache.get_entries('user', [email])
+    if found.get(email) is not None:
+        return found[email]
+    try:
+        author = User.objects.get(email=email)
+    except User.DoesNotExist:
+        # Not cached, like missing heaps (see get_heaps)
+        return None
+    ingestcache.set_entries('user', {email: author})
+    return author
+
+def look_up_messages(message_ids):
+    """Looks up messages by their Message-IDs, using the ingest cache.
+
+    **Argument:**
+
+    - `message_ids` ([str])
+
+    **Returns:** {str: ((int, int | None))} -- The ids and heap ids of the
+    messages with the given Message-IDs, in the order of their ids.
+    """
+
+    found = ingestcache.get_entries('message', message_ids)
+    missing = [message_id for message_id in set(message_ids)
+               if not found.get(message_id)]
+    if missing:
+        messages = dict((message_id, []) for message_id in missing)
+        for ids in chunks(missing):
+            for message_id, msg_id, heap_id in \
+                    Message.objects.filter(message_id__in=ids) \
+                        .order_by('id') \
+                        .values_list('message_id', 'id',
+                                     'root__conversation__heap'):
+                messages[message_id].append((msg_id, heap_id))
+        messages = dict((message_id, tuple(entries))
+                        for message_id, entries in messages.iteritems())
+        # Missing messages are not cached, like missing heaps (see
+        # get_heaps): e.g. "manage.py importmail" may store them.
+        ingestcache.set_entries('message',
+                                dict((message_id, entries)
+                                     for message_id, entries
+                                     in messages.iteritems()
+                                     if entries))
+        found.update(messages)
+    return found
+
+
+##### Threading
+
+def get_parent_candidates(in_reply_to, references):
+    # The Message-IDs of the possible parents, the closest first: the
+    # References header lists the ancestors from the root.
+    candidates = []
+    for message_id in [in_reply_to] + list(reversed(references)):
+        if message_id and message_id not in candidates:
+            candidates.append(message_id)
+    return candidates
+
+def find_parent(heap, candidates, messages):
+    """Finds the closest ancestor of a mail in a heap.
+
+    **Arguments:**
+
+    - `heap` (Heap)
+    - `candidates` ([str]) -- The Message-IDs of the possible parents, the
+      closest first (see `get_parent_candidates`).
+    - `messages` ({str: ((int, int | None))}) -- The messages with the
+      candidate Message-IDs (see `look_up_messages`).
+
+    **Returns:** (int | None, int) -- The id of the parent and its rank
+    (index in `candidates`).
+    """
+
+    # A mail sent to several heaps is stored as a message in each of them
+    for rank, message_id in enumerate(candidates):
+        for msg_id, heap_id in messages.get(message_id, ()):
+            if heap_id == heap.id:
+                return msg_id, rank
+    return None, len(candidates)
+
+def add_pending_reply(msg, heap, candidates, rank):
+    # Makes the message wait for the candidates that are closer than its
+    # current parent.
+    awaited = candidates[:rank]
+    for i, message_id in enumerate(awaited):
+        PendingReply(message=msg, heap=heap, awaited=message_id,
+                     rank=i).save()
+    if not awaited:
+        return
+    # Another worker may have stored one of the candidates meanwhile, and
+    # looked for its pending replies before the rows above were written. So
+    # the candidates are looked up again, bypassing the cache: with SQLite,
+    # the rows above are written only after the transaction of that worker
+    # committed.
+    arrived = {}
+    for parent_id, message_id in \
+            Message.objects.filter(message_id__in=awaited,
+                                   root__conversation__heap=heap) \
+                .exclude(pk=msg.pk) \
+                .order_by('id') \
+                .values_list('id', 'message_id'):
+        arrived.setdefault(message_id, parent_id)
+    for i, message_id in enumerate(awaited):
+        if message_id in arrived:
+            parent = Message.objects.get(pk=arrived[message_id])
+            attach_waiting_reply(msg, parent, i)
+            break
+
+def attach_reply(reply, parent):
+    """Makes a message the reply of another one. If the message is the root
+    of a conversation, the conversation is merged into the conversation of
+    the parent: the labels of the conversation are moved to the message.
+
+    **Arguments:**
+
+    - `reply` (Message)
+    - `parent` (Message)
+    """
+
+    labels = list(reply.latest_version().labels.all())
+    for conv in Conversation.objects.filter(root_message=reply):
+        labels.extend(conv.labels.all())
+        conv.delete()
+    # The root and path of the whole thread of the reply are updated by one
+    # statement (see Message.update_ancestry).
+    reply.change(parent=parent, labels=labels)
+
+def attach_pending_replies(msg, heap):
+    """Attaches the pending replies that wait for a new message.
+
+    **Arguments:**
+
+    - `msg` (Message)
+    - `heap` (Heap)
+    """
+
+    if msg.message_id is None:
+        return
+    pending = PendingReply.objects \
+                  .filter(heap=heap, awaited=msg.message_id) \
+                  .select_related('message')
+    for pending_reply in pending:
+        attach_waiting_reply(pending_reply.message, msg, pending_reply.rank)
+
+def attach_waiting_reply(reply, parent, rank):
+    # Attaches a pending reply to a message it waits for with the given rank.
+    # The parent may be a reply of the pending reply itself.
+    if reply.is_ancestor_of(Message.objects.get(pk=parent.pk)):
+        return
+    attach_reply(reply, parent)
+    # The reply waits only for closer messages from now on
+    PendingReply.objects.filter(message=reply, rank__gte=rank).delete()
+
+def add_mail(mailfrom, rcpttos,
+             subject, message_id, in_reply_to,
+             text, references=(), attachments=(), stored_heaps=()):
     # TODO Add access control!!!
     # TODO Should cross posting be allowed?
 
+    # The mail is not stored into the heaps whose ids are in `stored_heaps`.
+
+    # Everything that does not depend on the heap is looked up once
+    heapnames = [RECIPIENT_RE.search(rcpt).group(1) for rcpt in rcpttos]
+    found = get_heaps(heapnames)
     heaps = []
-    for rcpt in rcpttos:
-        heapname = re.search('^([^@].*)@', rcpt).group(1)
-        try:
-            heap = Heap.objects.get(short_name=heapname)
-            heaps.append(heap)
-        except Heap.DoesNotExist:
-            print '%s attempted to post to nonexistent heap "%s".' % (mailfrom, heapname)
+    for heapname in heapnames:
+        if found[heapname] is None:
+            print '%s attempted to post to nonexistent heap "%s".' % \
+                  (mailfrom, heapname)
+        elif found[heapname].id not in stored_heaps:
+            heaps.append(found[heapname])
+    if not heaps:
+        return
+    author = get_author(mailfrom)
+    candidates = get_parent_candidates(in_reply_to, references)
+    messages = look_up_messages(candidates)
+    real_subject, labels = parse_subject(subject)
 
     for heap in heaps:
         # Cross-posting is enabled for now
 
         now = datetime.datetime.now()
-        try:
-            r = re.compile('[-._A-Za-z0-9]+@[-._A-Za-z0-9]+')
-            match = r.search(mailfrom)
-            if match is not None:
-                sender_mail = match.group(0)
-                author = User.objects.get(email=sender_mail)
-            else:
-                author = None
-        except User.DoesNotExist:
-            author = None
-
-        try:
-            parent = Message.objects.get(message_id=in_reply_to)
-        except Message.DoesNotExist:
-            parent = None
-
-        real_subject, labels = parse_subject(subject)
+        parent_id, rank = find_parent(heap, candidates, messages)
 
         msg = Message()
         msg.message_id = message_id
@@ -182,12 +774,15 @@ def message_from_mail(mailfrom, rcpttos,
                 author=author,
                 creation_date=now,
                 version_date=now,
-                parent=parent,
+                parent_id=parent_id,
                 text=text
             )
         mv.save()
+        # Cross-posted copies share the files of the attachments
+        for attachment in attachments:
+            add_attachment(mv, *attachment)
 
-        if parent is None:
+        if parent_id is None:
             conv = Conversation(
                     heap=heap,
                     subject=real_subject,
@@ -199,43 +794,42 @@ def message_from_mail(mailfrom, rcpttos,
             label_target = msg
 
         label_target.add_label(labels)
+        add_pending_reply(msg, heap, candidates, rank)
+        attach_pending_replies(msg, heap)
 
 
 ##### "smtp" views
 
 def smtp(request):
     # Must be admin to use
-    global email_thread
-
     if not request.user.is_superuser:
         raise PermissionDenied
 
-    if email_thread is None:
-        alive = False
-    else:
-        alive = email_thread.is_alive()
-
     return render(
                request,
                'smtp.html',
-               {'running': alive})
+               {'status': get_service_status()})
 
-def enable_smtp(request, port=25):
+def enable_smtp(request, port=None):
     # Must be admin to use
     if not request.user.is_superuser:
         raise PermissionDenied
-    
-    run_server_thread(port)
-    
+
+    control = read_json(CONTROL_FILE) or {}
+    control['accepting'] = True
+    if port is not None:
+        control['port'] = int(port)
+    write_json(CONTROL_FILE, control)
+
     return redirect(reverse('hk.views.smtp'))
 
 def disable_smtp(request):
     # Must be admin to use
-    global email_thread
-
     if not request.user.is_superuser:
         raise PermissionDenied
-    
-    stop_server_thread()
-    
+
+    control = read_json(CONTROL_FILE) or {}
+    control['accepting'] = False
+    write_json(CONTROL_FILE, control)
+
     return redirect(reverse('hk.views.smtp'))
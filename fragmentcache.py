@@ -0,0 +1,244 @@
+# This file is part of Heapkeeper.
+#
+# Heapkeeper is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Heapkeeper is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Heapkeeper.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright (C) 2012 Csaba Hoch
+
+# Cache of rendered conversation fragments.
+#
+# Two kinds of entries are stored:
+#
+# - The HTML of a message (without its replies), keyed by the id of the message
+#   version and by whether the label controls are shown. Versions are not
+#   modified after they are written (except for the labels of a new version and
+#   edits in the admin), so the entries are deleted only in these cases.
+# - The HTML of a whole thread, keyed by the root message and the permission
+#   tier of the reader. The entry stores the version ids it was built from, so
+#   it is used only if no message of the thread changed.
+#
+# The entries are also stamped: the heap stamp is renewed when the user rights
+# of the heap change (the icons of the authors depend on them) and when the
+# name, email address or superuser status of an author of the heap changes,
+# the thread stamp when the conversation changes.
+#
+# The backend is the Django cache named by the HK_FRAGMENT_CACHE setting (e.g.
+# a file based cache); by default an in-process LRU cache is used.
+
+from collections import OrderedDict
+import threading
+import time
+from django.conf import settings
+from django.core.cache import get_cache
+from django.core.cache.backends.base import BaseCache
+
+
+##### LRU cache backend
+
+_lru_caches = {}
+_lru_locks = {}
+
+class LRUCache(BaseCache):
+    """In-process cache that drops the least recently used entry when it has
+    more than MAX_ENTRIES entries."""
+
+    def __init__(self, name, params):
+        BaseCache.__init__(self, params)
+        self._cache = _lru_caches.setdefault(name, OrderedDict())
+        self._lock = _lru_locks.setdefault(name, threading.Lock())
+
+    def add(self, key, value, timeout=None, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        with self._lock:
+            if self._get(key) is not None:
+                return False
+            self._set(key, value, timeout)
+            return True
+
+    def get(self, key, default=None, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        with self._lock:
+            entry = self._get(key)
+        if entry is None:
+            return default
+        return entry[1]
+
+    def set(self, key, value, timeout=None, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        with self._lock:
+            self._set(key, value, timeout)
+
+    def delete(self, key, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        with self._lock:
+            self._cache.pop(key, None)
+
+    def has_key(self, key, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        with self._lock:
+            return self._get(key) is not None
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+    def _get(self, key):
+        # Returns the (expiry, value) pair and marks the entry as recently
+        # used; the caller holds the lock.
+        entry = self._cache.pop(key, None)
+        if entry is None or entry[0] <= time.time():
+            return None
+        self._cache[key] = entry
+        return entry
+
+    def _set(self, key, value, timeout):
+        if timeout is None:
+            timeout = self.default_timeout
+        self._cache.pop(key, None)
+        self._cache[key] = (time.time() + timeout, value)
+        while len(self._cache) > self._max_entries:
+            self._cache.popitem(last=False)
+
+
+##### Fragment cache
+
+_fragment_cache = None
+
+def get_fragment_cache():
+    global _fragment_cache
+    if _fragment_cache is None:
+        name = getattr(settings, 'HK_FRAGMENT_CACHE', None)
+        if name is not None:
+            _fragment_cache = get_cache(name)
+        else:
+            _fragment_cache = get_cache('hk.fragmentcache.LRUCache',
+                                        LOCATION='hk-fragments',
+                                        TIMEOUT=24 * 60 * 60,
+                                        OPTIONS={'MAX_ENTRIES': 10000})
+    return _fragment_cache
+
+def new_stamp():
+    return int(time.time() * 1000000)
+
+def get_stamps(keys):
+    # Stamps that are missing (never set or evicted) are created, so that
+    # entries made with an earlier stamp do not become valid again.
+    cache = get_fragment_cache()
+    stamps = cache.get_many(keys)
+    missing = dict((key, new_stamp()) for key in keys if key not in stamps)
+    if missing:
+        cache.set_many(missing)
+        stamps.update(missing)
+    return stamps
+
+def heap_stamp_key(heap_id):
+    return 'hk:stamp:heap:%d' % heap_id
+
+def thread_stamp_key(root_id):
+    return 'hk:stamp:thread:%d' % root_id
+
+def message_key(version_id, controls):
+    return 'hk:message:%d:%d' % (version_id, controls)
+
+def thread_key(root_id, tier):
+    return 'hk:thread:%d:%s' % (root_id, tier)
+
+def get_tier(user, right):
+    # The rendered HTML depends on the reader only through the label controls
+    # (see print_message), so readers in the same tier share thread entries.
+    if right >= 2:
+        return 'alter'
+    elif right == 1 and user.is_authenticated():
+        return 'send%d' % user.id
+    else:
+        return 'none'
+
+def get_heap_stamp(heap_id):
+    return get_stamps([heap_stamp_key(heap_id)])[heap_stamp_key(heap_id)]
+
+def get_thread_signature(root_id, heap_id, version_ids):
+    """Returns the signature of a thread.
+
+    The signature has to be calculated before rendering the thread, so that a
+    change during the rendering leaves the stored entry invalid.
+
+    **Arguments:**
+
+    - `root_id` (int) -- The root message of the thread.
+    - `heap_id` (int)
+    - `version_ids` ([int]) -- The current versions of the thread in the order
+      they are displayed.
+
+    **Returns:** object
+    """
+
+    heap_key = heap_stamp_key(heap_id)
+    stamp_key = thread_stamp_key(root_id)
+    stamps = get_stamps([heap_key, stamp_key])
+    return (stamps[heap_key], stamps[stamp_key], tuple(version_ids))
+
+def get_thread(root_id, tier, signature):
+    # Returns the cached HTML of a thread, or None.
+    entry = get_fragment_cache().get(thread_key(root_id, tier))
+    if entry is None or entry[0] != signature:
+        return None
+    return entry[1]
+
+def set_thread(root_id, tier, signature, html):
+    get_fragment_cache().set(thread_key(root_id, tier), (signature, html))
+
+def get_messages(heap_stamp, keys):
+    """Returns the cached HTML of messages.
+
+    **Arguments:**
+
+    - `heap_stamp` (int) -- Returned by `get_heap_stamp`.
+    - `keys` ([(int, bool)]) -- Version ids and whether controls are shown.
+
+    **Returns:** {(int, bool): unicode} -- The entries found.
+    """
+
+    cache_keys = dict((message_key(*key), key) for key in keys)
+    result = {}
+    for cache_key, entry in \
+            get_fragment_cache().get_many(cache_keys.keys()).iteritems():
+        stamp, html = entry
+        if stamp == heap_stamp:
+            result[cache_keys[cache_key]] = html
+    return result
+
+def set_messages(heap_stamp, fragments):
+    # `fragments` is a {(version id, controls): html} dictionary.
+    get_fragment_cache().set_many(
+        dict((message_key(*key), (heap_stamp, html))
+             for key, html in fragments.iteritems()))
+
+
+##### Invalidation
+
+def invalidate_version(version_id, root_id):
+    cache = get_fragment_cache()
+    cache.delete_many([message_key(version_id, controls)
+                       for controls in (False, True)])
+    if root_id is not None:
+        invalidate_thread(root_id)
+
+def invalidate_thread(root_id):
+    get_fragment_cache().set(thread_stamp_key(root_id), new_stamp())
+
+def invalidate_heap(heap_id):
+    get_fragment_cache().set(heap_stamp_key(heap_id), new_stamp())
@@ -15,170 +15,1121 @@
 # Copyright (C) 2012 Attila Nagy
 # Copyright (C) 2012 Csaba Hoch
 
+# Database integrity check.
+#
+# The checks do not walk the messages one by one: the current parent of every
+# message is loaded into arrays once (see MessageGraph), and the other
+# invariants are checked with aggregate queries. So the number of queries does
+# not depend on the size of the database.
+#
+# The checks are run as jobs (FsckJob objects) in the background, either by a
+# thread of the web server or by the "fsck" management command. The problems
+# found are stored as FsckFinding objects. The job is saved after each check,
+# so an interrupted job can be resumed from the check it was performing.
+#
+# Incremental jobs check only the objects changed (see TouchedObject) since
+# the start of the last job that found no problems.
+#
+# The problems found can be repaired by "manage.py fsck --repair" (see
+# REPAIRS).
+
 from hk.models import *
+from hk.labels import get_unused_labels
+from hk.retention import prune_message
+from hk.threads import chunks
+from array import array
 import datetime
-from django.contrib.contenttypes.models import ContentType
+import json
+import threading
+import traceback
+from django.conf import settings
 from django.core.exceptions import PermissionDenied
 from django.core.urlresolvers import reverse
-from django.shortcuts import render
+from django.db import connection, transaction
+from django.db.models import Count, F
+from django.shortcuts import get_object_or_404, redirect, render
 
-def get_admin_url(object):
-    model = object.__class__
-    content_type = ContentType.objects.get_for_model(model)
-    return reverse('admin:%s_%s_change' % (content_type.app_label,
-                                               content_type.model),
-                       args=(object.id,))
+def get_admin_url(model, obj_id):
+    return reverse('admin:hk_%s_change' % model, args=(obj_id,))
 
-##### "fsck" view
 
-def fsck(request):
-    # TODO add more useful admin links
+##### Scope of incremental checks
 
-    # Must be admin to use
-    if not request.user.is_superuser:
-        raise PermissionDenied
+class Scope(object):
+    """The objects changed since a given time."""
+
+    def __init__(self, since):
+        self.since = since
+        self.messages = set()
+        self.conversations = set()
+        self.labels = set()
+        self.heaps = set()
+        self.users = set()
+        touched = TouchedObject.objects \
+                      .filter(date__gte=since) \
+                      .values_list('kind', 'key')
+        for kind, key in touched.iterator():
+            if kind == 'label':
+                self.labels.add(key)
+            else:
+                getattr(self, kind + 's').add(int(key))
+
+
+def scoped(queryset, field, ids):
+    """Restricts a query to the given objects.
+
+    **Arguments:**
+
+    - `queryset` (QuerySet)
+    - `field` (str) -- The field that is compared with the ids.
+    - `ids` (set | None) -- ``None`` means no restriction.
+
+    **Returns:** iterable(QuerySet) -- The query is split into several ones
+    so that they do not have too many parameters.
+    """
+
+    if ids is None:
+        yield queryset
+    else:
+        for ids_chunk in chunks(sorted(ids)):
+            yield queryset.filter(**{field + '__in': ids_chunk})
+
+
+##### Message graph
+
+MESSAGE_FIELDS = ('id',
+                  'current_version',
+                  'current_version__parent',
+                  'current_version__deleted',
+                  'root',
+                  'path')
+
+class MessageGraph(object):
+    """The current parent of messages.
+
+    The messages are numbered from 0; `ids[i]` is the id of the ith message,
+    `parents[i]` is the number of its current parent (-1 if it has no parent
+    or no current version, -2 if the parent does not exist), `deleted[i]`
+    tells whether its current version is deleted and `has_version[i]` whether
+    it has a current version at all.
+
+    Without a scope, all messages are loaded. With a scope, only the changed
+    messages, the roots of the changed conversations, their replies and
+    ancestors are loaded; `checked[i]` tells whether the ith message should
+    be checked.
+
+    `conversations` is the set of conversations to be checked (``None`` means
+    all).
+    """
+
+    def __init__(self, scope=None):
+        self.scope = scope
+        self.ids = array('l')
+        self.parents = array('l')
+        self.deleted = bytearray()
+        self.has_version = bytearray()
+        self.checked = bytearray()
+        self.roots = []
+        self.paths = []
+        self.index = {}
+        self.parent_ids = []
+        messages = Message.objects.order_by('id').values_list(*MESSAGE_FIELDS)
+
+        if scope is None:
+            self.load(messages, True)
+            self.conversations = None
+        else:
+            msg_ids = set(scope.messages)
+            for convs in scoped(Conversation.objects, 'id',
+                                scope.conversations):
+                msg_ids.update(convs.values_list('root_message', flat=True))
+            for msgs in scoped(messages, 'id', msg_ids):
+                self.load(msgs, True)
+            for msgs in scoped(messages, 'current_version__parent', msg_ids):
+                self.load(msgs, True)
+            self.load_ancestors(messages)
+
+            # The conversations whose root or statistics may have changed
+            self.conversations = set(scope.conversations)
+            root_ids = self.get_checked_ids()
+            root_ids.update(self.roots[i] for i in xrange(len(self))
+                            if self.checked[i])
+            root_ids.discard(None)
+            for convs in scoped(Conversation.objects, 'root_message',
+                                root_ids):
+                self.conversations.update(convs.values_list('id', flat=True))
+
+        for parent_id in self.parent_ids:
+            if parent_id is None:
+                self.parents.append(-1)
+            else:
+                self.parents.append(self.index.get(parent_id, -2))
+
+    def load(self, rows, checked):
+        for msg_id, version_id, parent_id, deleted, root_id, path in \
+                rows.iterator():
+            if msg_id in self.index:
+                continue
+            self.index[msg_id] = len(self.ids)
+            self.ids.append(msg_id)
+            self.parent_ids.append(parent_id)
+            self.deleted.append(bool(deleted))
+            self.has_version.append(version_id is not None)
+            self.checked.append(checked)
+            self.roots.append(root_id)
+            self.paths.append(path)
+
+    def load_ancestors(self, messages):
+        # The ancestors are usually the ones in the paths, so those are loaded
+        # first; then the missing parents are loaded until all are present.
+        missing = set()
+        for path in self.paths:
+            missing.update(int(msg_id) for msg_id in path.split('/')
+                           if msg_id)
+        while True:
+            missing.update(self.parent_ids)
+            missing.discard(None)
+            missing.difference_update(self.index)
+            if not missing:
+                break
+            count = len(self)
+            for msgs in scoped(messages, 'id', missing):
+                self.load(msgs, False)
+            if len(self) == count:
+                break # The missing parents do not exist
+            missing = set()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def get_checked_ids(self):
+        """Returns the ids of the messages to be checked (``None`` means all).
+
+        **Returns:** set | None
+        """
+
+        if self.scope is None:
+            return None
+        return set(self.ids[i] for i in xrange(len(self)) if self.checked[i])
+
+    def find_loops(self):
+        """Returns the messages that are in parent loops, in linear time.
+
+        Every message has at most one parent, so walking up from a message
+        either reaches a root, a message already known not to be in a loop,
+        or a message visited by the same walk, which closes a loop.
+
+        **Returns:** [int] -- Message ids.
+        """
+
+        parents = self.parents
+        # 0: not visited, 1: on the current walk, 2: finished
+        state = bytearray(len(self))
+        in_loop = []
+        for start in xrange(len(self)):
+            walk = []
+            i = start
+            while i >= 0 and state[i] == 0:
+                state[i] = 1
+                walk.append(i)
+                i = parents[i]
+            if i >= 0 and state[i] == 1:
+                # The walk reached itself: the messages from i are the loop.
+                in_loop.extend(walk[walk.index(i):])
+            for j in walk:
+                state[j] = 2
+        return sorted(self.ids[i] for i in in_loop)
+
+    def get_ancestry(self):
+        """Calculates the root and path of the messages from the parents (see
+        `compute_ancestry`).
+
+        **Returns:** [(int | None, str)] -- The root id and path of each
+        message; ``(None, '')`` for messages in or below parent loops.
+        """
+
+        ids = self.ids
+        parents = self.parents
+        no_ancestry = (None, '')
+        result = [None] * len(self)
+        for start in xrange(len(self)):
+            walk = []
+            on_walk = set()
+            i = start
+            while i >= 0 and result[i] is None and i not in on_walk:
+                on_walk.add(i)
+                walk.append(i)
+                i = parents[i]
+            if i == -1:
+                # walk[-1] is a root
+                ancestry = None
+            elif i >= 0 and result[i] is not None:
+                ancestry = result[i]
+            else:
+                # A loop, or a parent that does not exist
+                ancestry = no_ancestry
+            for j in reversed(walk):
+                if ancestry is None:
+                    ancestry = (ids[j], '/%d/' % ids[j])
+                elif ancestry is not no_ancestry:
+                    ancestry = (ancestry[0], '%s%d/' % (ancestry[1], ids[j]))
+                result[j] = ancestry
+        return result
 
-    res = "\n"
-    all_ok = True
-    start = datetime.datetime.now()
-    print 'fsck operation initiated at %s' % start
-
-    test = 'Test 1: Messages without message versions\n\n'
-    print test
-    res += test
-    problem = []
-    for msg in Message.objects.all():
-        if MessageVersion.objects.filter(message=msg).count() == 0:
-            problem.append(msg)
-    for msg in problem:
-        error = 'Message #%d has no message versions!' % msg.id
-        print error
-        res += error + ' <a href="%s">edit</a>' % get_admin_url(msg)
-        all_ok = False
-
-    test = '\n\n\nTest 2: Parentless non-deleted message with zero or multiple conversation\n\n'
-    print test
-    res += test
+
+##### Checks
+
+# Each check receives the message graph and returns a list of problems. A
+# problem is an (error message, links, data) triple, where links is a list of
+# (text, model name, object id) triples pointing to the admin pages to be used
+# to fix the problem, and data is a list that describes the problem for the
+# repair function of the check (e.g. the ids of the objects involved).
+
+def check_messages_without_versions(graph):
+    problems = []
+    without_versions = Message.objects \
+                           .filter(message__isnull=True) \
+                           .order_by('id')
+    for msgs in scoped(without_versions, 'id', graph.get_checked_ids()):
+        problems.extend(('Message #%d has no message versions!' % msg_id,
+                         [('edit', 'message', msg_id)],
+                         [msg_id])
+                        for msg_id in msgs.values_list('id', flat=True))
+    return problems
+
+def get_conversation_counts(root_ids):
+    counts = {}
+    for convs in scoped(Conversation.objects, 'root_message', root_ids):
+        for row in convs.values('root_message').annotate(count=Count('id')):
+            counts[row['root_message']] = row['count']
+    return counts
+
+def check_root_conversations(graph):
+    conv_counts = get_conversation_counts(graph.get_checked_ids())
     zero = []
     many = []
-    for msg in Message.objects.all():
-        msg_lv = msg.latest_version()
-        if msg_lv is None:
-            continue # This has been covered in Test 1
-        if (msg_lv.parent is None
-                and not msg_lv.deleted):
-            count = Conversation.objects.filter(root_message=msg).count()
+    for i, msg_id in enumerate(graph.ids):
+        if not graph.checked[i] or not graph.has_version[i]:
+            continue # The latter has been covered in Test 1
+        if graph.parents[i] == -1 and not graph.deleted[i]:
+            count = conv_counts.get(msg_id, 0)
             if count == 0:
-                zero.append(msg)
+                zero.append(msg_id)
             if count > 1:
-                many.append(msg)
-    for msg in zero:
-        error = 'Root message #%d has no matching conversation!' % msg.id
-        print error
-        res += error + ' <a href="%s">edit</a>\n' % get_admin_url(msg)
-        all_ok = False
-    for msg in many:
-        error = 'Root message #%d has multiple matching conversations!' % msg.id
-        print error
-        res += error + ' <a href="%s">edit</a>\n' % get_admin_url(msg)
-        all_ok = False
-
-    test = '\n\n\nTest 3: deleted message as parent\n\n'
-    print test
-    res += test
-    problem = []
-    for msg in Message.objects.all():
-        msg_lv = msg.latest_version()
-        if msg_lv.deleted:
-            for msg_child in Message.objects.all():
-                if msg_child.current_parent() == msg:
-                    problem.append((msg, msg_child,))
-    for msg, child in problem:
-        error = 'Deleted message #%d is parent of message #%d!' % (msg.id, child.id,)
-        print error
-        res += error + ' <a href="%s">edit parent</a>' % get_admin_url(msg)
-        res += ' <a href="%s">edit child</a>\n' % get_admin_url(child)
-        all_ok = False
-
-    test = '\n\n\nTest 4: parent message loops\n\n'
-    print test
-    res += test
-    problem = []
-    for msg in Message.objects.all():
-        try:
-            _ = msg.get_root_message(exception=True)
-        except LoopException as loop:
-            problem.extend(loop.messages)
-            problem = list(set(problem))
-    for msg in problem:
-        error = 'Message #%d is in a parent loop!' % msg.id
-        print error
-        res += error + ' <a href="%s">edit</a>\n' % get_admin_url(msg)
-        all_ok = False
-
-    test = '\n\n\nTest 5: deleted message as conversation root\n\n'
-    print test
-    res += test
-    problem = []
-    for msg in Message.objects.all():
-        if msg.is_deleted():
-            count = Conversation.objects.filter(root_message=msg).count()
-            if count > 0:
-                problem.append(msg)
-    for msg in problem:
-        error = 'Deleted message #%d is the root of a conversation!' % msg.id
-        print error
-        res += error + ' <a href="%s">edit</a>\n' % get_admin_url(msg)
-        all_ok = False
-
-    test = '\n\n\nTest 6: conv with root that has parent\n\n'
-    print test
-    res += test
-    problem = []
-    for conv in Conversation.objects.all():
-        if conv.root_message.current_parent() is not None:
-            problem.append((conv, conv.root_message,))
-    for conv, root in problem:
-        error = 'Conversation #%d has root message (#%d) that has a parent!'\
-                    % (conv.id, root.id)
-        print error
-        res += error + ' <a href="%s">edit</a>\n' % get_admin_url(root)
-        all_ok = False
-            
-    test = '\n\n\nTest 7: unused labels\n\n'
-    print test
-    res += test
-    problem = []
-    for label in Label.objects.all():
-        if label.messageversion_set.count() == 0 \
-                and label.conversation_set.count() == 0:
-            problem.append(label)
-    for label in problem:
-        error = "Label '%s' is unused!" % label.pk
-        print error
+                many.append(msg_id)
+    return ([('Root message #%d has no matching conversation!' % msg_id,
+              [('edit', 'message', msg_id)],
+              ['zero', msg_id])
+             for msg_id in sorted(zero)] +
+            [('Root message #%d has multiple matching conversations!'
+              % msg_id,
+              [('edit', 'message', msg_id)],
+              ['many', msg_id])
+             for msg_id in sorted(many)])
+
+def check_deleted_parents(graph):
+    pairs = sorted((graph.ids[p], graph.ids[i])
+                   for i, p in enumerate(graph.parents)
+                   if p >= 0 and graph.deleted[p] and
+                      (graph.checked[i] or graph.checked[p]))
+    return [('Deleted message #%d is parent of message #%d!'
+             % (msg_id, child_id),
+             [('edit parent', 'message', msg_id),
+              ('edit child', 'message', child_id)],
+             [msg_id, child_id])
+            for msg_id, child_id in pairs]
+
+def check_loops(graph):
+    return [('Message #%d is in a parent loop!' % msg_id,
+             [('edit', 'message', msg_id)],
+             [msg_id])
+            for msg_id in graph.find_loops()]
+
+def check_deleted_roots(graph):
+    problems = []
+    for msg_id in sorted(get_conversation_counts(graph.get_checked_ids())):
+        i = graph.index.get(msg_id)
+        if i is not None and graph.deleted[i]:
+            problems.append(
+                ('Deleted message #%d is the root of a conversation!'
+                 % msg_id,
+                 [('edit', 'message', msg_id)],
+                 [msg_id]))
+    return problems
+
+def check_conversation_roots(graph):
+    problems = []
+    convs = Conversation.objects.order_by('id')
+    for convs in scoped(convs, 'id', graph.conversations):
+        for conv_id, root_id in convs.values_list('id', 'root_message'):
+            i = graph.index.get(root_id)
+            if i is not None and graph.parents[i] != -1:
+                problems.append(
+                    ('Conversation #%d has root message (#%d) that has a '
+                     'parent!' % (conv_id, root_id),
+                     [('edit', 'message', root_id)],
+                     [conv_id, root_id]))
+    return problems
+
+def check_unused_labels(graph):
+    unused = get_unused_labels().order_by('pk')
+    label_ids = None if graph.scope is None else graph.scope.labels
+    problems = []
+    for labels in scoped(unused, 'pk', label_ids):
         # TODO add link to admin page
-        res += error
-        all_ok = False
-
-    test = '\n\n\nTest 8: heap without admin\n\n'
-    print test
-    res += test
-    problem = []
-    for heap in Heap.objects.all():
-        if heap.userright_set.filter(right=3).count() == 0:
-            problem.append(heap)
-    for heap in problem:
-        error = "Heap '%s' has no admin!" % heap.short_name
-        print error
+        problems.extend(("Label '%s' is unused!" % label, [], [label])
+                        for label in labels.values_list('pk', flat=True))
+    return problems
+
+def check_heap_admins(graph):
+    without_admin = Heap.objects.exclude(userright__right=3).order_by('id')
+    heap_ids = None if graph.scope is None else graph.scope.heaps
+    problems = []
+    for heaps in scoped(without_admin, 'id', heap_ids):
         # TODO add link to admin page
-        res += error
-        all_ok = False
+        problems.extend(("Heap '%s' has no admin!" % short_name, [],
+                         [heap_id])
+                        for heap_id, short_name in
+                        heaps.values_list('id', 'short_name'))
+    return problems
+
+def check_current_versions(graph):
+    problems = []
+    for msgs in scoped(Message.objects, 'id', graph.get_checked_ids()):
+        current = list(msgs.order_by('id')
+                           .values_list('id', 'current_version'))
+        if graph.scope is None:
+            latest = compute_latest_versions()
+        else:
+            latest = compute_latest_versions([row[0] for row in current])
+        problems.extend(
+            ('Message #%d does not point to its latest version! '
+             '(Run "manage.py updatecurrentversions" to fix it.)' % msg_id,
+             [('edit', 'message', msg_id)],
+             [msg_id])
+            for msg_id, version_id in current
+            if version_id != latest.get(msg_id))
+    return problems
+
+def check_paths(graph):
+    ancestry = graph.get_ancestry()
+    problems = []
+    for i, msg_id in enumerate(graph.ids):
+        if graph.checked[i] and \
+           (graph.roots[i], graph.paths[i]) != ancestry[i]:
+            problems.append(
+                ('Message #%d has wrong root or path! '
+                 '(Run "manage.py updatepaths" to fix it.)' % msg_id,
+                 [('edit', 'message', msg_id)],
+                 [msg_id]))
+    return problems
+
+def check_effective_rights(graph):
+    expected = compute_effective_rights()
+    actual = dict(((user_id, heap_id), (given_right, right))
+                  for user_id, heap_id, given_right, right in
+                  EffectiveRight.objects.values_list(
+                      'user', 'heap', 'given_right', 'right'))
+    keys = set(expected) | set(actual)
+    scope = graph.scope
+    if scope is not None:
+        keys = [(user_id, heap_id) for user_id, heap_id in keys
+                if user_id in scope.users or heap_id in scope.heaps]
+    return [('The effective right of user #%d on heap #%d is wrong! '
+             '(Run "manage.py updateeffectiverights" to fix it.)' % key,
+             [],
+             list(key))
+            for key in sorted(keys)
+            if expected.get(key) != actual.get(key)]
+
+def check_conversation_stats(graph):
+    problems = []
+    for convs in scoped(Conversation.objects, 'id', graph.conversations):
+        rows = list(convs.order_by('id')
+                         .values_list('id', 'root_message', 'last_activity',
+                                      'message_count', 'participant_count'))
+        if graph.conversations is None:
+            stats = compute_conversation_stats()
+        else:
+            stats = compute_conversation_stats([row[1] for row in rows])
+        for row in rows:
+            conv_id, root_id, current = row[0], row[1], row[2:]
+            if root_id in stats and stats[root_id] != current:
+                problems.append(
+                    ('Conversation #%d has wrong statistics! '
+                     '(Run "manage.py updateconversationstats" to fix it.)'
+                     % conv_id,
+                     [('edit', 'conversation', conv_id)],
+                     [conv_id, root_id]))
+    return problems
+
+def check_label_counts(graph):
+    problems = []
+    for convs in scoped(Conversation.objects, 'id', graph.conversations):
+        rows = list(convs.order_by('id').values_list('id', 'root_message'))
+        if graph.conversations is None:
+            counts = compute_label_counts()
+        else:
+            counts = compute_label_counts([row[1] for row in rows])
+        expected = {}
+        for (root_id, label), label_counts in counts.iteritems():
+            expected.setdefault(root_id, {})[label] = label_counts
+        actual = {}
+        for count_row in \
+                LabelCount.objects \
+                    .filter(conversation__in=[row[0] for row in rows]) \
+                    .values_list('conversation', 'label', 'message_count',
+                                 'deleted_count', 'on_conversation'):
+            actual.setdefault(count_row[0], {})[count_row[1]] = count_row[2:]
+        problems.extend(
+            ('Conversation #%d has wrong label counts! '
+             '(Run "manage.py gclabels --recount" to fix it.)' % conv_id,
+             [('edit', 'conversation', conv_id)],
+             [conv_id, root_id])
+            for conv_id, root_id in rows
+            if expected.get(root_id, {}) != actual.get(conv_id, {}))
+    return problems
+
+def check_version_texts(graph):
+    problems = []
+    for msgs in scoped(Message.objects, 'id', graph.get_checked_ids()):
+        problems.extend(
+            ('The current version of message #%d is stored as a delta!'
+             % msg_id,
+             [('edit', 'message', msg_id)],
+             [version_id])
+            for msg_id, version_id in
+            msgs.filter(current_version__text_base__isnull=False)
+                .order_by('id')
+                .values_list('id', 'current_version'))
+    for versions in scoped(MessageVersion.objects, 'message',
+                           graph.get_checked_ids()):
+        problems.extend(
+            ('Message version #%d is stored as a delta against a version of '
+             'another message!' % version_id,
+             [('edit', 'message', msg_id)],
+             [version_id])
+            for version_id, msg_id in
+            versions.filter(text_base__isnull=False)
+                    .exclude(text_base__message=F('message'))
+                    .order_by('id')
+                    .values_list('id', 'message'))
+    return problems
+
+def check_retention_policies(graph):
+    # Only the number of versions is checked; finding the versions that do
+    # not change the text would need the texts of every version.
+    problems = []
+    for policy in RetentionPolicy.objects \
+                      .filter(keep_versions__isnull=False) \
+                      .order_by('heap'):
+        # The first version is kept besides the last ones
+        allowed = max(policy.keep_versions, 1) + 1
+        heap_versions = MessageVersion.objects.filter(
+                            message__root__conversation__heap=policy.heap_id)
+        for versions in scoped(heap_versions, 'message',
+                               graph.get_checked_ids()):
+            problems.extend(
+                ('Message #%d has more versions than the retention policy of '
+                 'its heap keeps! (Run "manage.py pruneversions" to fix it.)'
+                 % msg_id,
+                 [('edit', 'message', msg_id)],
+                 [msg_id, policy.heap_id])
+                for msg_id in
+                versions.values('message')
+                        .annotate(version_count=Count('id'))
+                        .filter(version_count__gt=allowed)
+                        .order_by('message')
+                        .values_list('message', flat=True))
+    return problems
+
+CHECKS = (
+    ('Messages without message versions',
+     check_messages_without_versions),
+    ('Parentless non-deleted message with zero or multiple conversation',
+     check_root_conversations),
+    ('deleted message as parent', check_deleted_parents),
+    ('parent message loops', check_loops),
+    ('deleted message as conversation root', check_deleted_roots),
+    ('conv with root that has parent', check_conversation_roots),
+    ('unused labels', check_unused_labels),
+    ('heap without admin', check_heap_admins),
+    ('stale current version pointer', check_current_versions),
+    ('wrong root or path', check_paths),
+    ('wrong effective rights', check_effective_rights),
+    ('wrong conversation statistics', check_conversation_stats),
+    ('wrong label counts', check_label_counts),
+    ('broken version texts', check_version_texts),
+    ('versions against the retention policy', check_retention_policies),
+)
+
+
+##### Repairs
+
+# REPAIRS contains a repair function for each check, in the same order as
+# CHECKS. A repair function receives the data of a problem and a
+# RepairContext, and returns the list of fixes that would solve the problem,
+# or None if it cannot be repaired automatically. A fix is a (description,
+# function) pair. The description is a line of a diff: "+" means a created
+# object, "-" a deleted one and "~" a modified one.
+#
+# The fixes are performed after all of them are collected, so a fix function
+# checks again that its problem still exists: an earlier fix may have solved
+# it already.
+
+class RepairContext(object):
+    """The objects used by the repairs that need them.
+
+    - `heap` (Heap | None) -- The heap of the new conversations whose heap
+      cannot be determined otherwise.
+    - `admin` (User | None) -- The user who becomes the admin of the heaps
+      that have no admin.
+    """
+
+    def __init__(self, heap=None, admin=None):
+        self.heap = heap
+        self.admin = admin
+
+def get_parent_id(msg_id):
+    # Returns None also if the message does not exist any more.
+    parent_ids = Message.objects.filter(pk=msg_id) \
+                     .values_list('current_version__parent', flat=True)
+    return parent_ids[0] if parent_ids else None
+
+def lacks_conversation(msg_id):
+    # Whether the message is a root message without a conversation.
+    return (Message.objects.filter(pk=msg_id,
+                                   current_version__isnull=False,
+                                   current_version__parent__isnull=True,
+                                   current_version__deleted=False)
+                .exists() and
+            not Conversation.objects.filter(root_message=msg_id).exists())
+
+def get_subject(msg):
+    lines = msg.latest_version().text.strip().splitlines()
+    return lines[0][:256] if lines else '(no subject)'
+
+def make_root(msg_id, heap, subject=None):
+    # Makes the message the root of a new conversation, like the "Delete
+    # message" view does with the children of the deleted message. A message
+    # that is the root of a conversation already (e.g. a message of a parent
+    # loop) keeps its conversation.
+    msg = Message.objects.get(pk=msg_id)
+    if msg.current_parent() is not None:
+        msg.change(parent=None)
+    if Conversation.objects.filter(root_message=msg).exists():
+        return
+    if subject is None:
+        subject = get_subject(msg)
+    Conversation(heap=heap, subject=subject, root_message=msg).save()
+
+def update_subtree_ancestry(root_id):
+    # Sets the root and path of the messages below a root message from their
+    # current parents. Used after a parent loop is cut: the paths of the
+    # messages of the loop (and of their other replies) were not updated
+    # while they were in the loop.
+    parents = {root_id: None}
+    old_roots = set()
+    level = [root_id]
+    while level:
+        next_level = []
+        for ids in chunks(level):
+            replies = Message.objects \
+                          .filter(current_version__parent__in=ids) \
+                          .values_list('id', 'current_version__parent', 'root')
+            for msg_id, parent_id, old_root_id in replies:
+                if msg_id not in parents:
+                    parents[msg_id] = parent_id
+                    old_roots.add(old_root_id)
+                    next_level.append(msg_id)
+        level = next_level
+    ancestry = compute_ancestry(parents)
+    for ids in chunks(sorted(parents)):
+        for msg_id, root, path in Message.objects.filter(pk__in=ids) \
+                                      .values_list('id', 'root', 'path'):
+            if (root, path) != ancestry[msg_id]:
+                Message.objects.filter(pk=msg_id).update(
+                    root=ancestry[msg_id][0], path=ancestry[msg_id][1])
+    update_conversation_stats(old_roots | set([root_id]))
+
+def repair_messages_without_versions(data, context):
+    msg_id, = data
+    if MessageVersion.objects.filter(parent=msg_id).exists():
+        # Deleting the message would delete its children
+        return None
+
+    def fix():
+        Message.objects.filter(pk=msg_id, message__isnull=True).delete()
+    return [('- Message #%d' % msg_id, fix)]
+
+def repair_root_conversations(data, context):
+    kind, msg_id = data
+    if kind == 'zero':
+        if not lacks_conversation(msg_id):
+            return [] # The problem has been solved since the check
+        if context.heap is None:
+            return None
+
+        def fix():
+            if lacks_conversation(msg_id):
+                make_root(msg_id, context.heap)
+        return [("+ Conversation of message #%d in heap '%s'"
+                 % (msg_id, context.heap.short_name), fix)]
+
+    # The oldest conversation is kept and gets the labels of the others.
+    conv_ids = list(Conversation.objects.filter(root_message=msg_id)
+                        .order_by('id').values_list('id', flat=True))
+    if len(conv_ids) < 2:
+        return [] # The problem has been solved since the check
+    kept_id = conv_ids[0]
+
+    def make_fix(conv_id):
+        def fix():
+            for conv in Conversation.objects.filter(pk=conv_id):
+                kept = Conversation.objects.get(pk=kept_id)
+                kept.labels.add(*conv.labels.all())
+                conv.delete()
+        return fix
+    return [('- Conversation #%d (merged into #%d)' % (conv_id, kept_id),
+             make_fix(conv_id))
+            for conv_id in conv_ids[1:]]
+
+def repair_deleted_parents(data, context):
+    parent_id, child_id = data
+    parents = Message.objects.filter(pk=parent_id,
+                                     current_version__deleted=True)
+    if not parents or get_parent_id(child_id) != parent_id:
+        return [] # The problem has been solved since the check
+    parent = parents[0]
+    convs = Conversation.objects.filter(root_message=parent.root_id)[:1]
+    if convs:
+        heap = convs[0].heap
+        subject = convs[0].subject
+    elif context.heap is not None:
+        heap = context.heap
+        subject = None
+    else:
+        return None
+
+    def fix():
+        if get_parent_id(child_id) == parent_id:
+            make_root(child_id, heap, subject)
+    return [('~ Message #%d: parent #%d -> none' % (child_id, parent_id), fix),
+            ("+ Conversation of message #%d in heap '%s'"
+             % (child_id, heap.short_name), None)]
 
-    if all_ok:
-        res = "Database checked, no errors found."
-        print res
+def find_loop(msg_id):
+    # Returns the ids of the parent loop of the message, starting with the
+    # message, or None if the message is not in a loop.
+    loop = [msg_id]
+    parent_id = get_parent_id(msg_id)
+    while parent_id is not None and parent_id not in loop:
+        loop.append(parent_id)
+        parent_id = get_parent_id(parent_id)
+    return loop if parent_id == msg_id else None
+
+def is_loop_cut_at(msg_id):
+    # Each message of a loop has a problem; the loop is cut only once, at the
+    # message with the smallest id.
+    loop = find_loop(msg_id)
+    return loop is not None and msg_id == min(loop)
+
+def repair_loops(data, context):
+    msg_id, = data
+    loop = find_loop(msg_id)
+    if loop is None or msg_id != min(loop):
+        return [] # See is_loop_cut_at
+    parent_id = loop[1] if len(loop) > 1 else msg_id
+    convs = Conversation.objects.filter(root_message=msg_id)[:1]
+    if convs:
+        # The conversation becomes valid again when the loop is cut
+        heap = convs[0].heap
+        new_conversation = []
+    elif context.heap is not None:
+        heap = context.heap
+        new_conversation = [("+ Conversation of message #%d in heap '%s'"
+                             % (msg_id, heap.short_name), None)]
+    else:
+        return None
+
+    def fix():
+        if get_parent_id(msg_id) == parent_id:
+            make_root(msg_id, heap)
+            update_subtree_ancestry(msg_id)
+    return ([('~ Message #%d: parent #%d -> none' % (msg_id, parent_id),
+              fix)] +
+            new_conversation +
+            [('~ Root and path of the messages of the loop', None)])
+
+def repair_deleted_roots(data, context):
+    msg_id, = data
+    conv_ids = list(Conversation.objects.filter(root_message=msg_id)
+                        .values_list('id', flat=True))
+
+    def fix():
+        if Message.objects.get(pk=msg_id).latest_version().deleted:
+            Conversation.objects.filter(root_message=msg_id).delete()
+    return [('- Conversation #%d' % conv_id, fix if i == 0 else None)
+            for i, conv_id in enumerate(conv_ids)]
+
+def repair_conversation_roots(data, context):
+    conv_id, root_id = data
+    if is_loop_cut_at(root_id):
+        return [] # The root loses its parent (see repair_loops)
+
+    def fix():
+        if get_parent_id(root_id) is not None:
+            Conversation.objects.filter(pk=conv_id).delete()
+    return [('- Conversation #%d' % conv_id, fix)]
+
+def repair_unused_labels(data, context):
+    label, = data
+
+    def fix():
+        get_unused_labels().filter(pk=label).delete()
+    return [("- Label '%s'" % label, fix)]
+
+def repair_heap_admins(data, context):
+    heap_id, = data
+    if context.admin is None:
+        return None
+
+    def fix():
+        if not UserRight.objects.filter(heap=heap_id, right=3).exists():
+            UserRight(heap_id=heap_id, user=context.admin, right=3).save()
+    return [("+ UserRight: %s is heapadmin of heap #%d"
+             % (context.admin.username, heap_id), fix)]
+
+def repair_current_versions(data, context):
+    msg_id, = data
+
+    def fix():
+        Message.objects.get(pk=msg_id).refresh_current_version()
+    return [('~ Message #%d: current version' % msg_id, fix)]
+
+def repair_paths(data, context):
+    msg_id, = data
+
+    def fix():
+        Message.objects.get(pk=msg_id).update_ancestry()
+    return [('~ Message #%d: root and path' % msg_id, fix)]
+
+def repair_effective_rights(data, context):
+    user_id, heap_id = data
+
+    def fix():
+        update_effective_right(User.objects.get(pk=user_id),
+                               Heap.objects.get(pk=heap_id))
+    return [('~ EffectiveRight of user #%d on heap #%d' % (user_id, heap_id),
+             fix)]
+
+def repair_conversation_stats(data, context):
+    conv_id, root_id = data
+
+    def fix():
+        update_conversation_stats([root_id])
+    return [('~ Conversation #%d: statistics' % conv_id, fix)]
+
+def repair_label_counts(data, context):
+    conv_id, root_id = data
+
+    def fix():
+        update_label_counts([root_id])
+    return [('~ Conversation #%d: label counts' % conv_id, fix)]
+
+def repair_version_texts(data, context):
+    version_id, = data
+    if not Message.objects \
+               .filter(current_version=version_id,
+                       current_version__text_base__message=F('id')) \
+               .exists():
+        # The text of a delta against a version of another message is lost
+        return None
+
+    def fix():
+        for version in MessageVersion.objects.filter(pk=version_id):
+            version.expand()
+    return [('~ MessageVersion #%d: text' % version_id, fix)]
+
+def repair_retention_policies(data, context):
+    msg_id, heap_id = data
+
+    def fix():
+        for policy in RetentionPolicy.objects.filter(heap=heap_id):
+            prune_message(msg_id, policy, datetime.datetime.now())
+    return [('- Message #%d: old versions' % msg_id, fix)]
+
+REPAIRS = (
+    repair_messages_without_versions,
+    repair_root_conversations,
+    repair_deleted_parents,
+    repair_loops,
+    repair_deleted_roots,
+    repair_conversation_roots,
+    repair_unused_labels,
+    repair_heap_admins,
+    repair_current_versions,
+    repair_paths,
+    repair_effective_rights,
+    repair_conversation_stats,
+    repair_label_counts,
+    repair_version_texts,
+    repair_retention_policies,
+)
+
+def plan_repairs(findings, context):
+    """Collects the fixes of the problems found by a job.
+
+    **Arguments:**
+
+    - `findings` ([FsckFinding])
+    - `context` (RepairContext)
+
+    **Returns:** ([(unicode, callable | None)], [FsckFinding]) -- The fixes
+    and the findings that cannot be repaired automatically. A fix without a
+    function is only a part of the description of the previous fix.
+    """
+
+    fixes = []
+    descriptions = set()
+    unrepairable = []
+    for finding in findings:
+        if not finding.data:
+            # Found by a job that did not store the data of the problems
+            unrepairable.append(finding)
+            continue
+        finding_fixes = REPAIRS[finding.check](json.loads(finding.data),
+                                               context)
+        if finding_fixes is None:
+            unrepairable.append(finding)
+            continue
+        # Different checks may find the same problem (e.g. a deleted root
+        # message that has a parent)
+        for description, fix in finding_fixes:
+            if description not in descriptions:
+                descriptions.add(description)
+                fixes.append((description, fix))
+    return fixes, unrepairable
+
+@transaction.commit_on_success
+def apply_fixes(fixes):
+    for description, fix in fixes:
+        if fix is not None:
+            fix()
+
+def repair(fixes, batch_size=100, progress=None):
+    """Performs the fixes in batches; each batch is one transaction.
+
+    **Arguments:**
+
+    - `fixes` ([(unicode, callable | None)]) -- See `plan_repairs`.
+    - `batch_size` (int)
+    - `progress` (callable | None) -- Called with the number of fixes done
+      after each batch.
+    """
+
+    fixes = [fix for fix in fixes if fix[1] is not None]
+    done = 0
+    for batch in chunks(fixes, batch_size):
+        apply_fixes(batch)
+        done += len(batch)
+        if progress is not None:
+            progress(done)
+
+
+##### Jobs
+
+def get_last_clean_job():
+    jobs = FsckJob.objects \
+               .filter(status='done', fsckfinding__isnull=True) \
+               .order_by('-started')[:1]
+    return jobs[0] if jobs else None
+
+def create_job(incremental=False):
+    """Queues a new job.
+
+    If there was no clean job yet, the new job checks everything even if it
+    is incremental.
+
+    **Argument:**
+
+    - `incremental` (bool)
+
+    **Returns:** FsckJob
+    """
+
+    job = FsckJob()
+    if incremental:
+        last_clean_job = get_last_clean_job()
+        if last_clean_job is not None:
+            job.incremental = True
+            job.since = last_clean_job.started
+    job.save()
+    return job
+
+def claim_job(job_id):
+    # Marks a queued job as running; returns whether it was queued. The check
+    # and the update are performed in one statement, so a job is run by only
+    # one worker.
+    now = datetime.datetime.now()
+    claimed = FsckJob.objects \
+                  .filter(pk=job_id, status='queued') \
+                  .update(status='running', heartbeat=now)
+    FsckJob.objects.filter(pk=job_id, started__isnull=True) \
+        .update(started=now)
+    return claimed == 1
+
+def is_interrupted(job):
+    # A running job whose worker has not saved it for a long time is
+    # considered to be dead.
+    if job.status != 'running' or job.heartbeat is None:
+        return False
+    stale_after = getattr(settings, 'HK_FSCK_STALE_AFTER', 3600)
+    return (datetime.datetime.now() - job.heartbeat >
+            datetime.timedelta(seconds=stale_after))
+
+def requeue_job(job):
+    """Queues a failed or interrupted job again, so that it is resumed from
+    its checkpoint.
+
+    **Argument:**
+
+    - `job` (FsckJob)
+
+    **Returns:** bool -- Whether the job was queued.
+    """
+
+    if job.status != 'failed' and not is_interrupted(job):
+        return False
+    return FsckJob.objects \
+               .filter(pk=job.id, status=job.status) \
+               .update(status='queued', error='') == 1
+
+@transaction.commit_on_success
+def save_checkpoint(job_id, number, problems):
+    for error, links, data in problems:
+        FsckFinding(job_id=job_id, check=number, error=error,
+                    links=json.dumps(links), data=json.dumps(data)).save()
+    FsckJob.objects.filter(pk=job_id).update(
+        next_check=number + 1,
+        heartbeat=datetime.datetime.now())
+
+@transaction.commit_on_success
+def finish_job(job_id):
+    job = FsckJob.objects.get(pk=job_id)
+    FsckJob.objects.filter(pk=job_id).update(
+        status='done',
+        finished=datetime.datetime.now())
+    if not job.fsckfinding_set.exists():
+        # The objects changed before the job are checked now, so the next
+        # incremental job does not need them.
+        TouchedObject.objects.filter(date__lt=job.started).delete()
+
+def run_job(job_id, progress=None):
+    """Runs a claimed job from its checkpoint.
+
+    If an exception is raised, the job is marked as failed and the exception
+    is raised again.
+
+    **Arguments:**
+
+    - `job_id` (int)
+    - `progress` (callable | None) -- Called with the number and title of
+      each check before it is performed.
+    """
+
+    try:
+        job = FsckJob.objects.get(pk=job_id)
+        scope = Scope(job.since) if job.incremental else None
+        graph = MessageGraph(scope)
+        for number in range(job.next_check, len(CHECKS)):
+            title, check = CHECKS[number]
+            if progress is not None:
+                progress(number, title)
+            save_checkpoint(job_id, number, check(graph))
+        finish_job(job_id)
+    except (Exception, KeyboardInterrupt):
+        transaction.rollback_unless_managed()
+        FsckJob.objects.filter(pk=job_id).update(
+            status='failed',
+            error=traceback.format_exc())
+        raise
+
+def run_queued_jobs(progress=None):
+    # Runs the queued jobs until there is none left.
+    while True:
+        jobs = FsckJob.objects.filter(status='queued').order_by('created')[:1]
+        if not jobs:
+            break
+        if claim_job(jobs[0].id):
+            run_job(jobs[0].id, progress)
+
+def run_worker_thread():
+    try:
+        run_queued_jobs()
+    except Exception:
+        pass # The error is stored in the job
+    finally:
+        connection.close()
+
+def start_worker():
+    # The queued jobs are run by a thread of the web server unless an
+    # external worker ("manage.py fsck --worker") is used.
+    if getattr(settings, 'HK_FSCK_IN_PROCESS', True):
+        thread = threading.Thread(target=run_worker_thread)
+        thread.daemon = True
+        thread.start()
+
+
+##### "fsck" views
+
+def fsck(request):
+    # Must be admin to use
+    if not request.user.is_superuser:
+        raise PermissionDenied
+
+    if request.method == 'POST':
+        job = create_job(incremental=('incremental' in request.POST))
+        start_worker()
+        return redirect('hk.views.fsck_job', job_id=job.id)
+
+    jobs = FsckJob.objects \
+               .annotate(findings=Count('fsckfinding')) \
+               .order_by('-created')[:20]
     return render(
                request,
                'fsck.html',
-               {'res': res})
+               {'jobs': jobs})
 
+def fsck_job(request, job_id):
+    # Must be admin to use
+    if not request.user.is_superuser:
+        raise PermissionDenied
+
+    job = get_object_or_404(FsckJob, pk=job_id)
+    if request.method == 'POST':
+        if requeue_job(job):
+            start_worker()
+        return redirect('hk.views.fsck_job', job_id=job.id)
+
+    findings = {}
+    for finding in job.fsckfinding_set.order_by('id'):
+        links = [(text, get_admin_url(model, obj_id))
+                 for text, model, obj_id in json.loads(finding.links or '[]')]
+        findings.setdefault(finding.check, []).append(
+            {'error': finding.error, 'links': links})
+    checks = []
+    for number, (title, check) in enumerate(CHECKS):
+        checks.append({'number': number + 1,
+                       'title': title,
+                       'done': number < job.next_check,
+                       'findings': findings.get(number, [])})
+    return render(
+               request,
+               'fsck_job.html',
+               {'job': job,
+                'checks': checks,
+                'check_count': len(CHECKS),
+                'in_progress': job.status in ('queued', 'running') and
+                               not is_interrupted(job),
+                'resumable': job.status == 'failed' or is_interrupted(job)})
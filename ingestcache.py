@@ -0,0 +1,97 @@
+# This file is part of Heapkeeper.
+#
+# Heapkeeper is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Heapkeeper is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Heapkeeper.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright (C) 2012 Csaba Hoch
+
+# Cache of the objects looked up when received mails are stored.
+#
+# Three kinds of entries are stored, keyed by strings:
+#
+# - 'heap': the Heap with a given short name,
+# - 'user': the User with a given email address,
+# - 'message': the (id, heap id) pairs of the messages with a given
+#   Message-ID.
+#
+# Labels are not cached: they may be deleted by another process (see
+# hk.models.get_label_objs).
+#
+# Missing heaps, users and messages are not cached: they may be created by
+# another process (e.g. the web server or "manage.py importmail"), and a mail
+# to a heap or from a user created meanwhile would be dropped, or a reply to a
+# message stored meanwhile would not be threaded, until the entry expired.
+# The entries are deleted by the signal handlers in hk.models when the objects
+# change. Entries of messages are also deleted after the transaction that
+# stored a message with the same Message-ID finished, so that entries read
+# within the transaction do not outlive a rollback.
+#
+# The backend is the Django cache named by the HK_INGEST_CACHE setting; by
+# default an in-process LRU cache (see hk.fragmentcache.LRUCache) is used. Its
+# entries cannot be deleted by other processes (e.g. the web server), so they
+# expire after a minute.
+
+import hashlib
+from django.conf import settings
+from django.core.cache import get_cache
+
+_ingest_cache = None
+
+def get_ingest_cache():
+    global _ingest_cache
+    if _ingest_cache is None:
+        name = getattr(settings, 'HK_INGEST_CACHE', None)
+        if name is not None:
+            _ingest_cache = get_cache(name)
+        else:
+            _ingest_cache = get_cache('hk.fragmentcache.LRUCache',
+                                      LOCATION='hk-ingest',
+                                      TIMEOUT=60,
+                                      OPTIONS={'MAX_ENTRIES': 10000})
+    return _ingest_cache
+
+def cache_key(kind, key):
+    # Email addresses and Message-IDs may contain characters that are not
+    # allowed in memcached keys.
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    return 'hk:ingest:%s:%s' % (kind, hashlib.md5(key).hexdigest())
+
+def get_entries(kind, keys):
+    """Returns cached entries.
+
+    **Arguments:**
+
+    - `kind` (str) -- 'heap', 'user' or 'message'.
+    - `keys` ([str])
+
+    **Returns:** {str: object} -- The entries found.
+    """
+
+    cache_keys = dict((cache_key(kind, key), key) for key in keys)
+    result = {}
+    for key, entry in \
+            get_ingest_cache().get_many(cache_keys.keys()).iteritems():
+        # The values are wrapped, because the cache cannot store None
+        result[cache_keys[key]] = entry[0]
+    return result
+
+def set_entries(kind, entries):
+    # `entries` is a {key: value} dictionary.
+    get_ingest_cache().set_many(
+        dict((cache_key(kind, key), (value,))
+             for key, value in entries.iteritems()))
+
+def invalidate(kind, keys):
+    keys = [cache_key(kind, key) for key in keys if key is not None]
+    if keys:
+        get_ingest_cache().delete_many(keys)
@@ -0,0 +1,347 @@
+# This file is part of Heapkeeper.
+#
+# Heapkeeper is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Heapkeeper is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Heapkeeper.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright (C) 2012 Csaba Hoch
+
+# Operations on many labels and conversations.
+#
+# Labels can be added to and removed from many conversations, or from all
+# messages of many conversations, in one transaction: from the heap page (see
+# the `heaplabels` view) or by "manage.py changelabels". Every message gets at
+# most one new version, and the messages whose labels would not change get
+# none.
+#
+# The labels of the conversations and of the current versions of their
+# messages are looked up in the label index (the LabelCount rows): to list
+# the labels of a heap, to filter its conversations by label expressions, and
+# to decide whether a label is used. The labels that are not deleted when
+# they are removed from their last object (e.g. because the message was
+# deleted) are collected by "manage.py gclabels".
+
+from django.db import transaction
+from django.db.models import Count, Q, Sum
+from hk.models import *
+from hk.threads import chunks
+import operator
+import re
+
+def parse_labels(text):
+    """Parses a comma separated list of labels.
+
+    **Argument:**
+
+    - `text` (unicode)
+
+    **Returns:** [unicode]
+    """
+
+    return [label.strip() for label in text.split(',') if label.strip()]
+
+def select_conversations(heap, conversation_ids=None, label=None):
+    """Selects conversations of a heap.
+
+    **Arguments:**
+
+    - `heap` (Heap)
+    - `conversation_ids` ([int] | None) -- If given, only these conversations
+      are selected.
+    - `label` (unicode | None) -- If given, only the conversations with this
+      label are selected.
+
+    **Returns:** QuerySet
+    """
+
+    convs = Conversation.objects.filter(heap=heap)
+    if conversation_ids is not None:
+        convs = convs.filter(pk__in=conversation_ids)
+    if label is not None:
+        convs = convs.filter(labels=label)
+    return convs.order_by('id')
+
+def get_unused_labels():
+    """Returns the labels of no current message version and no conversation.
+
+    The labels of the old versions are not looked at: they are removed from
+    the old versions when the label is deleted.
+
+    **Returns:** QuerySet
+    """
+
+    return Label.objects.filter(labelcount__isnull=True,
+                                conversation__isnull=True)
+
+def delete_unused_labels(texts):
+    # Labels that were removed from their last object are deleted (like in
+    # the views that remove a single label).
+    for batch in chunks(list(texts)):
+        get_unused_labels().filter(text__in=batch).delete()
+
+def collect_unused_labels(batch_size=100, dry_run=False):
+    """Deletes the unused labels, committing after each batch.
+
+    **Arguments:**
+
+    - `batch_size` (int) -- The number of labels deleted in one transaction.
+    - `dry_run` (bool) -- If true, the labels are only counted.
+
+    **Returns:** [unicode] -- The labels deleted (or to be deleted).
+    """
+
+    texts = list(get_unused_labels().order_by('text')
+                     .values_list('text', flat=True))
+    if not dry_run:
+        for i in range(0, len(texts), batch_size):
+            # The labels are checked again, since they may have been used
+            # since they were listed
+            with transaction.commit_on_success():
+                delete_unused_labels(texts[i:i + batch_size])
+    return texts
+
+def recount_labels(batch_size=1000):
+    """Recalculates the LabelCount rows of every conversation.
+
+    **Argument:**
+
+    - `batch_size` (int) -- The number of conversations updated in one
+      transaction.
+
+    **Returns:** int -- The number of rows corrected.
+    """
+
+    root_ids = list(Conversation.objects.order_by('id')
+                        .values_list('root_message', flat=True))
+    changed = 0
+    for i in range(0, len(root_ids), batch_size):
+        with transaction.commit_on_success():
+            changed += update_label_counts(root_ids[i:i + batch_size])
+    return changed
+
+def get_heap_labels(heap, conversations=None):
+    """Lists the labels used in a heap, using the label index.
+
+    **Arguments:**
+
+    - `heap` (Heap)
+    - `conversations` (QuerySet | None) -- If given, only the labels of these
+      conversations (of the heap) are listed.
+
+    **Returns:** [(unicode, int, int)] -- The labels with the number of
+    conversations that carry them (themselves or in their messages) and the
+    number of (not deleted) messages that have them, ordered by label.
+    """
+
+    counts = LabelCount.objects \
+                 .filter(conversation__heap=heap) \
+                 .exclude(on_conversation=False, message_count=0)
+    if conversations is not None:
+        counts = counts.filter(conversation__in=conversations.values('id'))
+    return list(counts.values_list('label')
+                      .annotate(conversations=Count('id'),
+                                messages=Sum('message_count'))
+                      .order_by('label'))
+
+
+##### Label expressions
+
+# A label expression selects the conversations that carry some labels, e.g.
+# 'bug and (urgent or "needs review") and not wontfix'. A conversation carries
+# a label if the conversation itself or the current version of one of its
+# (not deleted) messages has it. "and" binds stronger than "or", and it may
+# be omitted between two operands. Labels that contain whitespace,
+# parentheses or the words "and", "or", "not" have to be quoted.
+
+LABEL_EXPRESSION_TOKEN_RE = re.compile(
+    r'\s*(?:(?P<paren>[()])|"(?P<quoted>[^"]*)"|(?P<word>[^\s()"]+))')
+
+LABEL_EXPRESSION_OPERATORS = ('and', 'or', 'not')
+
+class LabelExpressionError(Exception):
+    pass
+
+def tokenize_label_expression(text):
+    # Returns the tokens as (kind, value) pairs, where kind is 'paren',
+    # 'operator' or 'label'.
+    tokens = []
+    text = text.strip()
+    pos = 0
+    while pos < len(text):
+        match = LABEL_EXPRESSION_TOKEN_RE.match(text, pos)
+        if match is None:
+            raise LabelExpressionError('Unterminated quotation mark.')
+        pos = match.end()
+        if match.group('paren') is not None:
+            tokens.append(('paren', match.group('paren')))
+        elif match.group('quoted') is not None:
+            tokens.append(('label', match.group('quoted')))
+        elif match.group('word').lower() in LABEL_EXPRESSION_OPERATORS:
+            tokens.append(('operator', match.group('word').lower()))
+        else:
+            tokens.append(('label', match.group('word')))
+    return tokens
+
+def parse_label_expression(text):
+    """Parses a label expression.
+
+    **Argument:**
+
+    - `text` (unicode)
+
+    **Returns:** tuple -- The syntax tree, whose nodes are ``('label',
+    text)``, ``('not', node)``, ``('and', [node])`` and ``('or', [node])``.
+
+    **Raises:** LabelExpressionError
+    """
+
+    tokens = tokenize_label_expression(text)
+    # The position of the next token; a list so that the nested functions
+    # can change it.
+    pos = [0]
+
+    def peek():
+        return tokens[pos[0]] if pos[0] < len(tokens) else (None, None)
+
+    def parse_or():
+        operands = [parse_and()]
+        while peek() == ('operator', 'or'):
+            pos[0] += 1
+            operands.append(parse_and())
+        return operands[0] if len(operands) == 1 else ('or', operands)
+
+    def parse_and():
+        operands = [parse_not()]
+        while True:
+            token = peek()
+            if token == ('operator', 'and'):
+                pos[0] += 1
+            elif token[0] != 'label' and \
+                 token not in (('operator', 'not'), ('paren', '(')):
+                break
+            operands.append(parse_not())
+        return operands[0] if len(operands) == 1 else ('and', operands)
+
+    def parse_not():
+        kind, value = peek()
+        pos[0] += 1
+        if (kind, value) == ('operator', 'not'):
+            return ('not', parse_not())
+        elif (kind, value) == ('paren', '('):
+            node = parse_or()
+            if peek() != ('paren', ')'):
+                raise LabelExpressionError('Missing closing parenthesis.')
+            pos[0] += 1
+            return node
+        elif kind == 'label':
+            return ('label', value)
+        elif kind is None:
+            raise LabelExpressionError('Unexpected end of the expression.')
+        else:
+            raise LabelExpressionError('Unexpected "%s".' % value)
+
+    if not tokens:
+        raise LabelExpressionError('The expression is empty.')
+    node = parse_or()
+    if pos[0] < len(tokens):
+        raise LabelExpressionError('Unexpected "%s".' % tokens[pos[0]][1])
+    return node
+
+def quote_label(text):
+    # Returns the label as an operand of a label expression.
+    if re.match(r'^[^\s()"]+$', text) and \
+       text.lower() not in LABEL_EXPRESSION_OPERATORS:
+        return text
+    return '"%s"' % text
+
+def compile_label_expression(node):
+    """Compiles the syntax tree of a label expression into a filter of
+    conversations.
+
+    Each label becomes a subquery on the label index (see LabelCount).
+
+    **Argument:**
+
+    - `node` (tuple) -- Returned by `parse_label_expression`.
+
+    **Returns:** Q
+    """
+
+    kind, value = node
+    if kind == 'label':
+        carriers = LabelCount.objects \
+                       .filter(Q(on_conversation=True) |
+                               Q(message_count__gt=0),
+                               label=value) \
+                       .values('conversation')
+        return Q(id__in=carriers)
+    elif kind == 'not':
+        return ~compile_label_expression(value)
+    elif kind == 'and':
+        return reduce(operator.and_, map(compile_label_expression, value))
+    else:
+        return reduce(operator.or_, map(compile_label_expression, value))
+
+def filter_conversations(conversations, expression):
+    """Selects the conversations that match a label expression.
+
+    **Arguments:**
+
+    - `conversations` (QuerySet)
+    - `expression` (unicode)
+
+    **Returns:** QuerySet
+
+    **Raises:** LabelExpressionError
+    """
+
+    return conversations.filter(
+               compile_label_expression(parse_label_expression(expression)))
+
+
+##### Changing labels
+
+@transaction.commit_on_success
+def change_labels(conversations, add=(), remove=(), messages=False):
+    """Adds and removes labels of conversations in one transaction.
+
+    **Arguments:**
+
+    - `conversations` ([Conversation])
+    - `add` ([unicode]) -- The labels to add; they are created if needed.
+    - `remove` ([unicode]) -- The labels to remove.
+    - `messages` (bool) -- If true, the labels of the (not deleted) messages
+      of the conversations are changed instead of the labels of the
+      conversations.
+
+    **Returns:** int -- The number of conversations or messages changed.
+    """
+
+    add = get_label_objs(add)
+    remove = set(remove)
+    changed = 0
+    if messages:
+        root_ids = [conv.root_message_id for conv in conversations]
+        for ids in chunks(root_ids):
+            for msg in Message.objects \
+                           .filter(root__in=ids,
+                                   current_version__deleted=False) \
+                           .select_related('current_version') \
+                           .order_by('id'):
+                if msg.change_labels(add, remove):
+                    changed += 1
+    else:
+        for conv in conversations:
+            if conv.change_labels(add, remove):
+                changed += 1
+    delete_unused_labels(remove)
+    return changed
+
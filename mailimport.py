@@ -0,0 +1,473 @@
+# This file is part of Heapkeeper.
+#
+# Heapkeeper is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Heapkeeper is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Heapkeeper.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright (C) 2012 Csaba Hoch
+
+# Bulk import of mail archives (mbox files and Maildir directories).
+#
+# Storing the mails one by one like the SMTP service does would take several
+# queries per mail. The importer parses the mails in a pool of processes, and
+# writes them in batches, one transaction per batch, with SQL statements that
+# bypass the models and so their signal handlers. The data maintained by the
+# signal handlers (root and path, conversation statistics, search index,
+# touched objects) is filled in for each batch.
+#
+# Replies are threaded by In-Reply-To and References. The Message-IDs of the
+# imported messages are kept in memory, and the messages stored earlier are
+# looked up once per batch. A reply whose parent is not found becomes the root
+# of a new conversation and a pending reply (see PendingReply), which is
+# attached to its parent if that is imported later.
+#
+# The number of mails imported from each archive is saved into a state file
+# after each batch, so an interrupted import can be continued. Mails whose
+# Message-ID is already in the database are skipped, so importing an archive
+# twice does not duplicate its mails.
+
+import collections
+import datetime
+import email.utils
+import json
+import mailbox
+import multiprocessing
+import os
+import time
+from cStringIO import StringIO
+from django.db import connection, transaction
+from django.utils.encoding import smart_unicode
+from hk.emaillistener import attach_pending_replies, \
+                             get_parent_candidates, parse_subject
+from hk import ingestcache
+from hk.mime import parse_mail_file
+from hk.models import *
+from hk import search
+from hk.threads import chunks
+
+def quote(name):
+    return connection.ops.quote_name(name)
+
+def table(model):
+    return quote(model._meta.db_table)
+
+def m2m_table(model, field_name):
+    field = model._meta.get_field(field_name)
+    return (quote(field.m2m_db_table()),
+            quote(field.m2m_column_name()),
+            quote(field.m2m_reverse_name()))
+
+INSERT_MESSAGE = \
+    'INSERT INTO %s (message_id, path) VALUES (%%s, %%s)' % table(Message)
+
+INSERT_VERSION = \
+    ('INSERT INTO %s (message_id, parent_id, author_id, creation_date, '
+     'version_date, text, deleted) VALUES (%%s, %%s, %%s, %%s, %%s, %%s, %%s)'
+     % table(MessageVersion))
+
+UPDATE_MESSAGE = \
+    ('UPDATE %s SET current_version_id = %%s, root_id = %%s, path = %%s '
+     'WHERE id = %%s' % table(Message))
+
+INSERT_CONVERSATION = \
+    ('INSERT INTO %s (subject, root_message_id, heap_id, last_activity, '
+     'message_count, participant_count) VALUES (%%s, %%s, %%s, %%s, 0, 0)'
+     % table(Conversation))
+
+INSERT_LABEL = 'INSERT INTO %s (text) VALUES (%%s)' % table(Label)
+
+INSERT_VERSION_LABEL = 'INSERT INTO %s (%s, %s) VALUES (%%s, %%s)' % \
+                       m2m_table(MessageVersion, 'labels')
+
+INSERT_CONVERSATION_LABEL = 'INSERT INTO %s (%s, %s) VALUES (%%s, %%s)' % \
+                            m2m_table(Conversation, 'labels')
+
+INSERT_PENDING_REPLY = \
+    ('INSERT INTO %s (message_id, heap_id, awaited, rank) '
+     'VALUES (%%s, %%s, %%s, %%s)' % table(PendingReply))
+
+INSERT_BLOB = \
+    ('INSERT INTO %s (digest, size, refcount) VALUES (%%s, %%s, 0)'
+     % table(Blob))
+
+UPDATE_BLOB_REFCOUNT = \
+    'UPDATE %s SET refcount = refcount + %%s WHERE id = %%s' % table(Blob)
+
+INSERT_ATTACHMENT = \
+    ('INSERT INTO %s (version_id, blob_id, filename, content_type) '
+     'VALUES (%%s, %%s, %%s, %%s)' % table(Attachment))
+
+INSERT_TOUCHED = \
+    ('INSERT INTO %s (kind, %s, date) VALUES (%%s, %%s, %%s)'
+     % (table(TouchedObject), quote('key')))
+
+
+##### Reading the archives
+
+def is_maildir(path):
+    return (os.path.isdir(os.path.join(path, 'cur')) and
+            os.path.isdir(os.path.join(path, 'new')))
+
+def is_mbox(path):
+    with open(path, 'rb') as f:
+        return f.read(5) == 'From '
+
+def find_archives(path, top=True):
+    """Finds the archives in a path.
+
+    A directory is a Maildir if it has "cur" and "new" subdirectories. Other
+    directories (and the subfolders of Maildirs) are searched recursively for
+    Maildirs and mbox files.
+
+    **Arguments:**
+
+    - `path` (str) -- An mbox file or a directory.
+    - `top` (bool) -- Whether the path was given by the user; such a file is
+      treated as an mbox file even if it does not look like one.
+
+    **Returns:** [(str, str)] -- The type ('mbox' or 'maildir') and path of
+    the archives.
+    """
+
+    if not os.path.isdir(path):
+        return [('mbox', path)] if top or is_mbox(path) else []
+    archives = []
+    if is_maildir(path):
+        archives.append(('maildir', path))
+    for name in sorted(os.listdir(path)):
+        if name not in ('cur', 'new', 'tmp'):
+            archives.extend(find_archives(os.path.join(path, name), False))
+    return archives
+
+def open_archive(archive_type, path):
+    # Returns the mailbox and the keys of its mails in order.
+    if archive_type == 'mbox':
+        box = mailbox.mbox(path, factory=None, create=False)
+        return box, box.keys()
+    else:
+        box = mailbox.Maildir(path, factory=None, create=False)
+        # The file names start with the time of delivery
+        return box, sorted(box.keys())
+
+def parse_archived_mail(raw):
+    """Parses a mail of an archive. It is called in the worker processes.
+
+    **Argument:**
+
+    - `raw` (str) -- The mail, with headers.
+
+    **Returns:** (str, unicode, str | None, [str], unicode, datetime | None,
+    [(str, str, int, str)]) | None -- The sender's email address, the
+    subject, the Message-ID, the Message-IDs of the possible parents (see
+    `hk.emaillistener.get_parent_candidates`), the text, the date and the
+    attachments (see `hk.mime.ParsedMail`) of the mail; ``None`` if it cannot
+    be parsed.
+    """
+
+    try:
+        mail = parse_mail_file(StringIO(raw))
+        subject, message_id, in_reply_to, text, references, attachments = \
+            mail.get_fields()
+        sender = email.utils.parseaddr(mail.headers['From'] or '')[1]
+        date = email.utils.parsedate_tz(mail.headers['Date'] or '')
+        if date is not None:
+            date = datetime.datetime.fromtimestamp(email.utils.mktime_tz(date))
+        return (sender,
+                smart_unicode(subject, errors='replace'),
+                message_id,
+                get_parent_candidates(in_reply_to, references),
+                smart_unicode(text, errors='replace'),
+                date,
+                attachments)
+    except Exception:
+        return None
+
+
+##### Importer
+
+class Importer(object):
+    """Imports archives into a heap.
+
+    **Arguments:**
+
+    - `heap` (Heap) -- The heap of the new conversations.
+    - `state_file` (str) -- The file that stores how many mails were imported
+      from each archive.
+    - `batch_size` (int) -- The number of mails stored in one transaction.
+    - `progress` (callable | None) -- Called after each batch with the
+      importer.
+    """
+
+    def __init__(self, heap, state_file, batch_size, progress=None):
+        self.heap = heap
+        self.state_file = state_file
+        self.batch_size = batch_size
+        self.progress = progress
+        if os.path.exists(state_file):
+            with open(state_file) as f:
+                self.state = json.load(f)
+        else:
+            self.state = {}
+        self.authors = dict(User.objects.values_list('email', 'id'))
+        # Message-ID -> (id, root id, path) of the messages imported or looked
+        # up
+        self.messages = {}
+        # The ids of the messages looked up
+        self.old_ids = set()
+        self.imported = 0
+        self.skipped = 0
+        self.started = time.time()
+
+    def read_batches(self, archives):
+        # Yields the mails not imported yet as lists of (archive path, index,
+        # raw mail) triples.
+        batch = []
+        for archive_type, path in archives:
+            box, keys = open_archive(archive_type, path)
+            for index in xrange(self.state.get(path, 0), len(keys)):
+                batch.append((path, index, box.get_string(keys[index])))
+                if len(batch) == self.batch_size:
+                    yield batch
+                    batch = []
+            box.close()
+        if batch:
+            yield batch
+
+    def run(self, archives, processes):
+        """Imports the archives.
+
+        The mails of the next batch are parsed by the worker processes while
+        the current batch is written into the database.
+
+        **Arguments:**
+
+        - `archives` ([(str, str)]) -- See `find_archives`.
+        - `processes` (int) -- The number of worker processes.
+        """
+
+        # The database connection must not be inherited by the workers
+        connection.close()
+        pool = multiprocessing.Pool(processes)
+        try:
+            batches = self.read_batches(archives)
+            batch = next(batches, None)
+            if batch is not None:
+                parsed = pool.map_async(parse_archived_mail,
+                                        [raw for path, index, raw in batch])
+            while batch is not None:
+                mails = parsed.get()
+                next_batch = next(batches, None)
+                if next_batch is not None:
+                    parsed = pool.map_async(
+                                 parse_archived_mail,
+                                 [raw for path, index, raw in next_batch])
+                try:
+                    self.store(mails)
+                finally:
+                    # The messages are inserted without signals
+                    ingestcache.invalidate('message',
+                                           [mail[2] for mail in mails
+                                            if mail is not None])
+                for path, index, raw in batch:
+                    self.state[path] = index + 1
+                self.save_state()
+                if self.progress is not None:
+                    self.progress(self)
+                batch = next_batch
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def save_state(self):
+        with open(self.state_file + '.tmp', 'w') as f:
+            json.dump(self.state, f)
+        os.rename(self.state_file + '.tmp', self.state_file)
+
+    def look_up_messages(self, message_ids):
+        # Adds the messages of the heap with the given Message-IDs to
+        # self.messages.
+        message_ids = list(set(message_id for message_id in message_ids
+                               if message_id is not None and
+                                  message_id not in self.messages))
+        for ids in chunks(message_ids):
+            messages = Message.objects \
+                           .filter(message_id__in=ids,
+                                   root__conversation__heap=self.heap) \
+                           .order_by('-id') \
+                           .values_list('message_id', 'id', 'root', 'path')
+            # The oldest message wins if a Message-ID occurs more than once
+            for message_id, msg_id, root_id, path in messages:
+                self.messages[message_id] = (msg_id, root_id, path)
+                self.old_ids.add(msg_id)
+
+    def find_new_labels(self, labels):
+        # Returns the labels that are not in the database yet.
+        new_labels = set(labels)
+        for texts in chunks(list(labels)):
+            new_labels.difference_update(
+                Label.objects.filter(text__in=texts)
+                             .values_list('text', flat=True))
+        return sorted(new_labels)
+
+    @transaction.commit_on_success
+    def store(self, mails):
+        """Stores a batch of mails in one transaction.
+
+        **Argument:**
+
+        - `mails` ([tuple | None]) -- See `parse_archived_mail`.
+        """
+
+        cursor = connection.cursor()
+        def insert(sql, params, model):
+            cursor.execute(sql, params)
+            return connection.ops.last_insert_id(cursor, model._meta.db_table,
+                                                 'id')
+
+        parsed = [mail for mail in mails if mail is not None]
+        self.skipped += len(mails) - len(parsed)
+        message_ids = [mail[2] for mail in parsed]
+        for mail in parsed:
+            message_ids.extend(mail[3])
+        self.look_up_messages(message_ids)
+
+        now = datetime.datetime.now()
+        message_updates = []
+        batch_labels = set()
+        version_labels = []
+        conversation_labels = []
+        indexed = []
+        root_ids = set()
+        touched = []
+        old_parent_ids = []
+        pending_replies = []
+        new_message_ids = []
+        attachment_rows = []
+        for sender, subject, message_id, candidates, text, date, \
+                attachments in parsed:
+            if message_id is not None and message_id in self.messages:
+                self.skipped += 1
+                continue
+            date = date or now
+            parent = None
+            for rank, candidate in enumerate(candidates):
+                if candidate in self.messages:
+                    parent = self.messages[candidate]
+                    break
+            else:
+                rank = len(candidates)
+
+            msg_id = insert(INSERT_MESSAGE, [message_id, ''], Message)
+            if parent is None:
+                parent_id = None
+                root_id = msg_id
+                path = '/%d/' % msg_id
+            else:
+                parent_id, root_id, parent_path = parent
+                # The parent may be in a parent loop, without root and path
+                path = parent_path + '%d/' % msg_id if parent_path else ''
+                if parent_id in self.old_ids:
+                    old_parent_ids.append(parent_id)
+            version_id = insert(INSERT_VERSION,
+                                [msg_id, parent_id, self.authors.get(sender),
+                                 date, date, text, False],
+                                MessageVersion)
+            message_updates.append((version_id, root_id, path, msg_id))
+            if message_id is not None:
+                self.messages[message_id] = (msg_id, root_id, path)
+                new_message_ids.append(message_id)
+            pending_replies.extend((msg_id, self.heap.id, candidate, i)
+                                   for i, candidate in
+                                   enumerate(candidates[:rank]))
+            attachment_rows.extend((version_id,) + attachment
+                                   for attachment in attachments)
+
+            real_subject, labels = parse_subject(subject)
+            labels = set(label[:64] for label in labels if label)
+            batch_labels |= labels
+            if parent is None:
+                conv_id = insert(INSERT_CONVERSATION,
+                                 [real_subject[:256], msg_id, self.heap.id,
+                                  date],
+                                 Conversation)
+                conversation_labels.extend((conv_id, label)
+                                           for label in labels)
+                touched.append(('conversation', unicode(conv_id), now))
+            else:
+                version_labels.extend((version_id, label) for label in labels)
+            root_ids.add(root_id)
+            indexed.append((msg_id, text))
+            touched.append(('message', unicode(msg_id), now))
+            self.imported += 1
+
+        cursor.executemany(UPDATE_MESSAGE, message_updates)
+        # The labels are looked up in this transaction, so a label deleted
+        # meanwhile by another process (e.g. by "manage.py gclabels") is
+        # created again (like in get_label_objs)
+        new_labels = self.find_new_labels(batch_labels)
+        cursor.executemany(INSERT_LABEL, [(label,) for label in new_labels])
+        touched.extend(('label', label, now) for label in new_labels)
+        cursor.executemany(INSERT_VERSION_LABEL, version_labels)
+        cursor.executemany(INSERT_CONVERSATION_LABEL, conversation_labels)
+        cursor.executemany(INSERT_PENDING_REPLY, pending_replies)
+        self.store_attachments(cursor, attachment_rows)
+        cursor.executemany(INSERT_TOUCHED, touched)
+        touch('message', old_parent_ids)
+        search.index_messages(indexed)
+        update_conversation_stats(root_ids)
+        self.attach_pending_replies(new_message_ids)
+
+    def store_attachments(self, cursor, rows):
+        # Adds the attachments given as (version id, file name, content
+        # type, size, digest) tuples, creating the missing blobs.
+        sizes = dict((row[4], row[3]) for row in rows)
+        blob_ids = {}
+        def look_up_blobs(digests):
+            for chunk in chunks(digests):
+                blob_ids.update(Blob.objects.filter(digest__in=chunk)
+                                    .values_list('digest', 'id'))
+        look_up_blobs(sizes.keys())
+        missing = [digest for digest in sizes if digest not in blob_ids]
+        cursor.executemany(INSERT_BLOB,
+                           [(digest, sizes[digest]) for digest in missing])
+        look_up_blobs(missing)
+
+        refcounts = collections.defaultdict(int)
+        attachments = []
+        for version_id, filename, content_type, size, digest in rows:
+            blob_id = blob_ids[digest]
+            refcounts[blob_id] += 1
+            attachments.append((version_id, blob_id, filename, content_type))
+        cursor.executemany(INSERT_ATTACHMENT, attachments)
+        cursor.executemany(UPDATE_BLOB_REFCOUNT,
+                           [(count, blob_id)
+                            for blob_id, count in refcounts.items()])
+
+    def attach_pending_replies(self, message_ids):
+        # Attaches the pending replies that wait for the given messages.
+        awaited = set()
+        for ids in chunks(message_ids):
+            awaited.update(PendingReply.objects
+                               .filter(heap=self.heap, awaited__in=ids)
+                               .values_list('awaited', flat=True))
+        if not awaited:
+            return
+        for message_id in awaited:
+            msg = Message.objects.get(pk=self.messages[message_id][0])
+            attach_pending_replies(msg, self.heap)
+        # The threads of the attached replies have got a new root and path;
+        # the messages are looked up again when they are needed.
+        self.messages.clear()
+
+    def get_rate(self):
+        # The number of mails processed per second.
+        processed = self.imported + self.skipped
+        return processed / max(time.time() - self.started, 0.001)
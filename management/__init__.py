@@ -0,0 +1,28 @@
+# This file is part of Heapkeeper.
+#
+# Heapkeeper is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Heapkeeper is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Heapkeeper.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright (C) 2012 Csaba Hoch
+
+# Setup done by "manage.py syncdb" besides creating the tables of the models.
+
+from django.db.models.signals import post_syncdb
+from hk import models
+from hk import search
+
+def create_search_tables(sender, **kwargs):
+    # The tables of the search backend that do not belong to a model (e.g.
+    # the FTS5 table) are created together with the tables of the models.
+    search.get_backend().setup()
+
+post_syncdb.connect(create_search_tables, sender=models)
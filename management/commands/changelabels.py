@@ -0,0 +1,68 @@
+# This file is part of Heapkeeper.
+#
+# Heapkeeper is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Heapkeeper is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Heapkeeper.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright (C) 2012 Csaba Hoch
+
+
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from hk.models import *
+from hk import labels
+
+
+class Command(BaseCommand):
+    args = '[<conversation id> ...]'
+    help = ('Adds and removes labels of conversations (or of their messages) '
+            'in one transaction.')
+    option_list = BaseCommand.option_list + (
+        make_option('--heap', dest='heap', default=None,
+                    metavar='SHORT_NAME',
+                    help='The heap of the conversations (required).'),
+        make_option('--add', dest='add', default='',
+                    help='Comma separated labels to add.'),
+        make_option('--remove', dest='remove', default='',
+                    help='Comma separated labels to remove.'),
+        make_option('--label', dest='label', default=None,
+                    help='Change only the conversations with this label.'),
+        make_option('--messages', action='store_true', dest='messages',
+                    default=False,
+                    help='Change the labels of the messages of the '
+                         'conversations instead of the conversations.'),
+    )
+
+    def handle(self, *args, **options):
+        if options['heap'] is None:
+            raise CommandError('--heap is required.')
+        try:
+            heap = Heap.objects.get(short_name=options['heap'])
+        except Heap.DoesNotExist:
+            raise CommandError('No such heap: %s' % options['heap'])
+        add = labels.parse_labels(options['add'].decode('utf-8'))
+        remove = labels.parse_labels(options['remove'].decode('utf-8'))
+        if not add and not remove:
+            raise CommandError('No labels given.')
+        try:
+            conversation_ids = [int(arg) for arg in args] or None
+        except ValueError:
+            raise CommandError('Conversation ids must be numbers.')
+        label = options['label']
+        if label is not None:
+            label = label.decode('utf-8')
+
+        convs = labels.select_conversations(heap, conversation_ids, label)
+        changed = labels.change_labels(convs, add, remove,
+                                       options['messages'])
+        print '%d %s changed.' % \
+              (changed, 'messages' if options['messages'] else
+                        'conversations')
@@ -0,0 +1,63 @@
+# This file is part of Heapkeeper.
+#
+# Heapkeeper is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Heapkeeper is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Heapkeeper.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright (C) 2012 Csaba Hoch
+
+from optparse import make_option
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+from hk.models import *
+
+
+class Command(NoArgsCommand):
+    help = ('Stores the old versions of the messages as deltas against the '
+            'next version.')
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size',
+                    default=100,
+                    help='Number of messages updated in one transaction.'),
+        make_option('--expand', action='store_true', dest='expand',
+                    default=False,
+                    help='Store every version in full instead.'),
+    )
+
+    def handle_noargs(self, **options):
+        batch_size = options['batch_size']
+
+        # Only the messages with more than one version have old versions
+        message_ids = list(MessageVersion.objects
+                               .values('message')
+                               .annotate(versions=Count('id'))
+                               .filter(versions__gt=1)
+                               .order_by('message')
+                               .values_list('message', flat=True))
+        changed = saved = 0
+        for i in range(0, len(message_ids), batch_size):
+            batch_changed, batch_saved = self.update_batch(
+                                             message_ids[i:i + batch_size],
+                                             options['expand'])
+            changed += batch_changed
+            saved += batch_saved
+        print '%d versions of %d messages changed, %d characters saved.' % \
+              (changed, len(message_ids), saved)
+
+    @transaction.commit_on_success
+    def update_batch(self, message_ids, expand):
+        changed = saved = 0
+        for message_id in message_ids:
+            message_changed, message_saved = compress_versions(message_id,
+                                                               expand)
+            changed += message_changed
+            saved += message_saved
+        return changed, saved
@@ -0,0 +1,123 @@
+# This file is part of Heapkeeper.
+#
+# Heapkeeper is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Heapkeeper is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Heapkeeper.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright (C) 2012 Csaba Hoch
+
+from optparse import make_option
+import time
+from django.contrib.auth.models import User
+from django.core.management.base import CommandError, NoArgsCommand
+from hk.models import *
+from hk import fsck
+
+
+class Command(NoArgsCommand):
+    help = 'Checks the integrity of the database.'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--incremental', action='store_true', dest='incremental',
+                    default=False,
+                    help='Check only the objects changed since the last '
+                         'check that found no problems.'),
+        make_option('--resume', type='int', dest='resume', default=None,
+                    metavar='JOB_ID',
+                    help='Resume a failed or interrupted check.'),
+        make_option('--worker', action='store_true', dest='worker',
+                    default=False,
+                    help='Run the checks queued from the web interface.'),
+        make_option('--repair', action='store_true', dest='repair',
+                    default=False,
+                    help='Repair the problems found.'),
+        make_option('--dry-run', action='store_true', dest='dry_run',
+                    default=False,
+                    help='Only print the changes that --repair would make.'),
+        make_option('--heap', dest='heap', default=None,
+                    metavar='SHORT_NAME',
+                    help='The heap of the conversations created for messages '
+                         'whose heap is unknown.'),
+        make_option('--admin', dest='admin', default=None,
+                    metavar='USERNAME',
+                    help='The user who becomes the admin of the heaps that '
+                         'have no admin.'),
+        make_option('--batch-size', type='int', dest='batch_size',
+                    default=100,
+                    help='The number of repairs performed in one '
+                         'transaction.'),
+    )
+
+    def handle_noargs(self, **options):
+        context = self.get_repair_context(options)
+        if options['worker']:
+            fsck.run_queued_jobs(self.progress)
+            return
+
+        if options['resume'] is not None:
+            try:
+                job = FsckJob.objects.get(pk=options['resume'])
+            except FsckJob.DoesNotExist:
+                raise CommandError('No such check: %d' % options['resume'])
+            if job.status != 'queued' and not fsck.requeue_job(job):
+                raise CommandError('Check #%d cannot be resumed (%s).'
+                                   % (job.id, job.status))
+        else:
+            job = fsck.create_job(options['incremental'])
+        if not fsck.claim_job(job.id):
+            raise CommandError('Check #%d is run by someone else.' % job.id)
+        print 'Check #%d started.' % job.id
+        fsck.run_job(job.id, self.progress)
+
+        findings = FsckFinding.objects.filter(job=job.id).order_by('id')
+        for finding in findings:
+            print finding.error
+        print 'Check #%d finished, %d problems found.' % \
+              (job.id, len(findings))
+        if (options['repair'] or options['dry_run']) and findings:
+            self.repair(findings, context, options)
+
+    def get_repair_context(self, options):
+        context = fsck.RepairContext()
+        if options['heap'] is not None:
+            try:
+                context.heap = Heap.objects.get(short_name=options['heap'])
+            except Heap.DoesNotExist:
+                raise CommandError('No such heap: %s' % options['heap'])
+        if options['admin'] is not None:
+            try:
+                context.admin = User.objects.get(username=options['admin'])
+            except User.DoesNotExist:
+                raise CommandError('No such user: %s' % options['admin'])
+        return context
+
+    def repair(self, findings, context, options):
+        fixes, unrepairable = fsck.plan_repairs(findings, context)
+        for finding in unrepairable:
+            print 'Cannot be repaired automatically: %s' % finding.error
+        for description, fix in fixes:
+            print description
+        if options['dry_run']:
+            return
+
+        self.total = len([fix for fix in fixes if fix[1] is not None])
+        self.start = time.time()
+        fsck.repair(fixes, options['batch_size'], self.repair_progress)
+        elapsed = time.time() - self.start
+        print '%d repairs performed in %.1f seconds.' % (self.total, elapsed)
+        print 'Run the check again to see whether problems remain.'
+
+    def repair_progress(self, done):
+        elapsed = time.time() - self.start
+        print '%d of %d repairs performed (%.1f/s).' % \
+              (done, self.total, done / max(elapsed, 0.001))
+
+    def progress(self, number, title):
+        print 'Test %d: %s' % (number + 1, title)
@@ -0,0 +1,50 @@
+# This file is part of Heapkeeper.
+#
+# Heapkeeper is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Heapkeeper is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Heapkeeper.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright (C) 2012 Csaba Hoch
+
+
+from optparse import make_option
+from django.core.management.base import NoArgsCommand
+from hk import attachments
+
+
+class Command(NoArgsCommand):
+    help = ('Removes the files of the attachment store that belong to no '
+            'message version.')
+    option_list = NoArgsCommand.option_list + (
+        make_option('--dry-run', action='store_true', dest='dry_run',
+                    default=False,
+                    help='Only print what would be removed.'),
+        make_option('--recount', action='store_true', dest='recount',
+                    default=False,
+                    help='Recalculate the reference counts of the files '
+                         'first.'),
+        make_option('--grace-period', type='int', dest='grace_period',
+                    default=None, metavar='SECONDS',
+                    help='Keep the files modified in this period '
+                         '(default: HK_ATTACHMENT_GRACE_PERIOD or one '
+                         'hour).'),
+    )
+
+    def handle_noargs(self, **options):
+        if options['recount']:
+            print '%d reference counts corrected.' % \
+                  attachments.recount_references()
+        count, size = attachments.collect_garbage(options['dry_run'],
+                                                  options['grace_period'])
+        if options['dry_run']:
+            print '%d files (%d bytes) would be removed.' % (count, size)
+        else:
+            print '%d files (%d bytes) removed.' % (count, size)
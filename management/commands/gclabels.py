@@ -0,0 +1,49 @@
+# This file is part of Heapkeeper.
+#
+# Heapkeeper is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Heapkeeper is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Heapkeeper.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright (C) 2012 Csaba Hoch
+
+
+from optparse import make_option
+from django.core.management.base import NoArgsCommand
+from hk import labels
+
+
+class Command(NoArgsCommand):
+    help = ('Deletes the labels that belong to no current message version '
+            'and no conversation.')
+    option_list = NoArgsCommand.option_list + (
+        make_option('--dry-run', action='store_true', dest='dry_run',
+                    default=False,
+                    help='Only print what would be deleted.'),
+        make_option('--recount', action='store_true', dest='recount',
+                    default=False,
+                    help='Recalculate the label counts of the conversations '
+                         'first.'),
+        make_option('--batch-size', type='int', dest='batch_size',
+                    default=100,
+                    help='Number of labels deleted in one transaction.'),
+    )
+
+    def handle_noargs(self, **options):
+        if options['recount']:
+            print '%d label counts corrected.' % labels.recount_labels()
+        texts = labels.collect_unused_labels(options['batch_size'],
+                                             options['dry_run'])
+        for text in texts:
+            print text.encode('utf-8')
+        if options['dry_run']:
+            print '%d labels would be deleted.' % len(texts)
+        else:
+            print '%d labels deleted.' % len(texts)
@@ -0,0 +1,63 @@
+# This file is part of Heapkeeper.
+#
+# Heapkeeper is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Heapkeeper is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Heapkeeper.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright (C) 2012 Csaba Hoch
+
+import multiprocessing
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from hk.models import *
+from hk import mailimport
+
+
+class Command(BaseCommand):
+    args = '<mbox file or Maildir directory> ...'
+    help = 'Imports mail archives into a heap.'
+    option_list = BaseCommand.option_list + (
+        make_option('--heap', dest='heap', default=None,
+                    metavar='SHORT_NAME',
+                    help='The heap to import into (required).'),
+        make_option('--state', dest='state', default='importmail.state',
+                    help='The file that stores how far the import got; an '
+                         'interrupted import continues from there.'),
+        make_option('--batch-size', type='int', dest='batch_size',
+                    default=1000,
+                    help='Number of mails stored in one transaction.'),
+        make_option('--processes', type='int', dest='processes',
+                    default=multiprocessing.cpu_count(),
+                    help='Number of processes that parse the mails.'),
+    )
+
+    def handle(self, *args, **options):
+        if not args:
+            raise CommandError('No archive given.')
+        if options['heap'] is None:
+            raise CommandError('The --heap option is required.')
+        try:
+            heap = Heap.objects.get(short_name=options['heap'])
+        except Heap.DoesNotExist:
+            raise CommandError('No such heap: %s' % options['heap'])
+
+        archives = []
+        for path in args:
+            archives.extend(mailimport.find_archives(path))
+        importer = mailimport.Importer(heap, options['state'],
+                                       options['batch_size'], self.progress)
+        importer.run(archives, options['processes'])
+        print 'Import finished: %d mails imported, %d skipped.' % \
+              (importer.imported, importer.skipped)
+
+    def progress(self, importer):
+        print '%d mails imported, %d skipped (%.1f mails/s).' % \
+              (importer.imported, importer.skipped, importer.get_rate())
@@ -0,0 +1,55 @@
+# This file is part of Heapkeeper.
+#
+# Heapkeeper is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Heapkeeper is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Heapkeeper.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright (C) 2012 Csaba Hoch
+
+from optparse import make_option
+from django.core.management.base import CommandError, NoArgsCommand
+from hk.models import *
+from hk import retention
+
+
+class Command(NoArgsCommand):
+    help = ('Deletes the old message versions that the retention policies '
+            'of the heaps do not keep.')
+    option_list = NoArgsCommand.option_list + (
+        make_option('--heap', dest='heap', default=None,
+                    metavar='SHORT_NAME',
+                    help='Prune only the messages of this heap.'),
+        make_option('--dry-run', action='store_true', dest='dry_run',
+                    default=False,
+                    help='Only print what would be deleted.'),
+        make_option('--batch-size', type='int', dest='batch_size',
+                    default=100,
+                    help='Number of messages pruned in one transaction.'),
+    )
+
+    def handle_noargs(self, **options):
+        heap = None
+        if options['heap'] is not None:
+            try:
+                heap = Heap.objects.get(short_name=options['heap'])
+            except Heap.DoesNotExist:
+                raise CommandError('No such heap: %s' % options['heap'])
+
+        stats = retention.prune(heap, options['dry_run'],
+                                options['batch_size'])
+        if options['dry_run']:
+            verb = 'would be deleted'
+        else:
+            verb = 'deleted'
+        print ('%d versions of %d messages %s (with %d labels and %d '
+               'attachments, %d bytes of text).' %
+               (stats.versions, stats.messages, verb, stats.label_rows,
+                stats.attachment_rows, stats.text_bytes))
@@ -0,0 +1,60 @@
+# This file is part of Heapkeeper.
+#
+# Heapkeeper is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Heapkeeper is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Heapkeeper.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright (C) 2012 Csaba Hoch
+
+from optparse import make_option
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+from hk.models import *
+from hk import search
+
+
+class Command(NoArgsCommand):
+    help = 'Rebuilds the search index from the current version of messages.'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size',
+                    default=1000,
+                    help='Number of messages indexed in one transaction.'),
+    )
+
+    def handle_noargs(self, **options):
+        batch_size = options['batch_size']
+
+        self.setup()
+        self.clear()
+        message_ids = list(Message.objects.order_by('id') \
+                               .values_list('id', flat=True))
+        indexed = 0
+        for i in range(0, len(message_ids), batch_size):
+            indexed += self.index_batch(message_ids[i:i + batch_size])
+        print '%d of %d messages indexed.' % (indexed, len(message_ids))
+
+    @transaction.commit_on_success
+    def setup(self):
+        search.get_backend().setup()
+
+    @transaction.commit_on_success
+    def clear(self):
+        search.get_backend().clear()
+
+    @transaction.commit_on_success
+    def index_batch(self, message_ids):
+        messages = Message.objects \
+                       .filter(pk__in=message_ids,
+                               current_version__deleted=False) \
+                       .values_list('id', 'current_version__text')
+        messages = list(messages)
+        search.get_backend().index(messages)
+        return len(messages)
@@ -0,0 +1,46 @@
+# This file is part of Heapkeeper.
+#
+# Heapkeeper is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Heapkeeper is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Heapkeeper.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright (C) 2012 Csaba Hoch
+
+from optparse import make_option
+from django.conf import settings
+from django.core.management.base import NoArgsCommand
+from hk.emaillistener import MailService
+
+
+class Command(NoArgsCommand):
+    help = 'Runs the SMTP service that receives the mails sent to the heaps.'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--port', type='int', dest='port',
+                    default=getattr(settings, 'HK_SMTP_PORT', 25),
+                    help='The port to listen on.'),
+        make_option('--workers', type='int', dest='workers',
+                    default=getattr(settings, 'HK_SMTP_WORKERS', 4),
+                    help='Number of threads that store the mails.'),
+        make_option('--batch-size', type='int', dest='batch_size',
+                    default=getattr(settings, 'HK_SMTP_BATCH_SIZE', 100),
+                    help='Number of mails stored in one transaction.'),
+        make_option('--max-attempts', type='int', dest='max_attempts',
+                    default=getattr(settings, 'HK_SMTP_MAX_ATTEMPTS', 10),
+                    help='Number of attempts to store a mail before it is '
+                         'given up.'),
+    )
+
+    def handle_noargs(self, **options):
+        service = MailService(options['port'], options['workers'],
+                              options['batch_size'], options['max_attempts'])
+        print 'SMTP service started (CTRL-C to stop).'
+        service.run()
+        print 'SMTP service stopped.'
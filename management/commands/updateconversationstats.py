@@ -0,0 +1,59 @@
+# This file is part of Heapkeeper.
+#
+# Heapkeeper is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Heapkeeper is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Heapkeeper.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright (C) 2012 Csaba Hoch
+
+from optparse import make_option
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+from hk.models import *
+
+
+class Command(NoArgsCommand):
+    help = ('Sets the last activity, message count and participant count of '
+            'every conversation.')
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size',
+                    default=1000,
+                    help='Number of conversations updated in one '
+                         'transaction.'),
+    )
+
+    def handle_noargs(self, **options):
+        batch_size = options['batch_size']
+
+        stats = compute_conversation_stats()
+        convs = Conversation.objects.values_list('id', 'root_message',
+                                                 'last_activity',
+                                                 'message_count',
+                                                 'participant_count')
+        changed = []
+        total = 0
+        for row in convs.iterator():
+            total += 1
+            conv_id, root_id, current = row[0], row[1], row[2:]
+            if root_id in stats and stats[root_id] != current:
+                changed.append((conv_id,) + stats[root_id])
+
+        for i in range(0, len(changed), batch_size):
+            self.update_batch(changed[i:i + batch_size])
+        print '%d of %d conversations updated.' % (len(changed), total)
+
+    @transaction.commit_on_success
+    def update_batch(self, batch):
+        for conv_id, last_activity, message_count, participant_count in batch:
+            Conversation.objects.filter(pk=conv_id).update(
+                last_activity=last_activity,
+                message_count=message_count,
+                participant_count=participant_count)
@@ -0,0 +1,54 @@
+# This file is part of Heapkeeper.
+#
+# Heapkeeper is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Heapkeeper is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Heapkeeper.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright (C) 2012 Csaba Hoch
+
+from optparse import make_option
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+from hk.models import *
+
+
+class Command(NoArgsCommand):
+    help = 'Sets the current_version pointer of every message.'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size',
+                    default=1000,
+                    help='Number of messages updated in one transaction.'),
+    )
+
+    def handle_noargs(self, **options):
+        batch_size = options['batch_size']
+
+        latest = compute_latest_versions()
+        current = dict(Message.objects.values_list('id', 'current_version'))
+        changed = [(message_id, latest.get(message_id))
+                   for message_id in current
+                   if current[message_id] != latest.get(message_id)]
+
+        for i in range(0, len(changed), batch_size):
+            self.update_batch(changed[i:i + batch_size])
+        print '%d of %d messages updated.' % (len(changed), len(current))
+
+    @transaction.commit_on_success
+    def update_batch(self, batch):
+        for message_id, version_id in batch:
+            Message.objects.filter(pk=message_id) \
+                .update(current_version=version_id)
+        # The current versions are stored in full
+        version_ids = [version_id for message_id, version_id in batch]
+        for version in MessageVersion.objects \
+                           .filter(pk__in=version_ids,
+                                   text_base__isnull=False):
+            version.expand()
@@ -0,0 +1,49 @@
+# This file is part of Heapkeeper.
+#
+# Heapkeeper is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Heapkeeper is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Heapkeeper.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright (C) 2012 Csaba Hoch
+
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+from hk.models import *
+
+
+class Command(NoArgsCommand):
+    help = 'Recalculates the EffectiveRight table.'
+
+    @transaction.commit_on_success
+    def handle_noargs(self, **options):
+        expected = compute_effective_rights()
+        actual = dict(((user_id, heap_id), (row_id, given_right, right))
+                      for row_id, user_id, heap_id, given_right, right in
+                      EffectiveRight.objects.values_list(
+                          'id', 'user', 'heap', 'given_right', 'right'))
+
+        changed = 0
+        for key, (row_id, given_right, right) in actual.iteritems():
+            if key not in expected:
+                EffectiveRight.objects.filter(pk=row_id).delete()
+                changed += 1
+            elif expected[key] != (given_right, right):
+                given_right, right = expected[key]
+                EffectiveRight.objects.filter(pk=row_id) \
+                    .update(given_right=given_right, right=right)
+                changed += 1
+        for key, (given_right, right) in expected.iteritems():
+            if key not in actual:
+                user_id, heap_id = key
+                EffectiveRight(user_id=user_id, heap_id=heap_id,
+                               given_right=given_right, right=right).save()
+                changed += 1
+        print '%d of %d effective rights updated.' % (changed, len(expected))
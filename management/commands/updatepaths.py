@@ -0,0 +1,52 @@
+# This file is part of Heapkeeper.
+#
+# Heapkeeper is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Heapkeeper is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Heapkeeper.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright (C) 2012 Csaba Hoch
+
+from optparse import make_option
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+from hk.models import *
+
+
+class Command(NoArgsCommand):
+    help = 'Sets the root and path of every message.'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size',
+                    default=1000,
+                    help='Number of messages updated in one transaction.'),
+    )
+
+    def handle_noargs(self, **options):
+        batch_size = options['batch_size']
+
+        parents = dict(Message.objects.values_list('id',
+                                                   'current_version__parent'))
+        ancestry = compute_ancestry(parents)
+        changed = []
+        for msg_id, root_id, path in \
+                Message.objects.values_list('id', 'root', 'path').iterator():
+            # Messages in parent loops get no root and path
+            expected = ancestry.get(msg_id, (None, ''))
+            if (root_id, path) != expected:
+                changed.append((msg_id,) + expected)
+
+        for i in range(0, len(changed), batch_size):
+            self.update_batch(changed[i:i + batch_size])
+        print '%d of %d messages updated.' % (len(changed), len(parents))
+
+    @transaction.commit_on_success
+    def update_batch(self, batch):
+        for msg_id, root_id, path in batch:
+            Message.objects.filter(pk=msg_id).update(root=root_id, path=path)
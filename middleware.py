@@ -0,0 +1,38 @@
+# This file is part of Heapkeeper.
+#
+# Heapkeeper is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Heapkeeper is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Heapkeeper.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright (C) 2012 Csaba Hoch
+
+from django.core.signals import request_finished
+from hk.models import enable_userright_cache, disable_userright_cache
+
+
+class UserRightCacheMiddleware(object):
+    """Caches the user rights queried while a request is processed.
+
+    The cache is turned off by the `request_finished` signal and not in
+    `process_response`, so that it is used by the templates rendered after
+    the middlewares have returned. Streamed responses are rendered even after
+    `request_finished` is sent; their content (see hk.views.StreamedContent)
+    turns the cache on and off itself.
+    """
+
+    def process_request(self, request):
+        enable_userright_cache()
+
+
+def request_finished_handler(sender, **kwargs):
+    disable_userright_cache()
+
+request_finished.connect(request_finished_handler)
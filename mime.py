@@ -0,0 +1,436 @@
+# This file is part of Heapkeeper.
+#
+# Heapkeeper is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Heapkeeper is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Heapkeeper.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright (C) 2012 Attila Nagy
+# Copyright (C) 2012 Csaba Hoch
+
+# Streaming parser of received mails.
+#
+# A mail is read line by line and is never kept in memory as a whole. Only the
+# header blocks of the MIME parts are parsed by the email package (by its feed
+# parser); the bodies of the parts are decoded while they are read:
+#
+# - The text parts become the text of the message. At most
+#   HK_MAIL_MAX_TEXT_SIZE bytes of text are kept in memory; if a text part is
+#   longer, the rest of the text is cut, and the whole part is stored as an
+#   attachment.
+# - Of the alternatives of a multipart/alternative part, the text/plain one is
+#   used if there is one.
+# - The other parts are written into the attachment store (see
+#   hk.attachments) while they are decoded.
+
+import binascii
+import email.header
+import email.parser
+import HTMLParser
+import quopri
+import re
+from cStringIO import StringIO
+from django.conf import settings
+from hk.attachments import BlobWriter
+
+# Longer lines are read in more pieces
+MAX_LINE_LENGTH = 65536
+
+# The maximum size of the header block of a part; the rest is ignored
+MAX_HEADER_SIZE = 1 << 20
+
+# The lengths of the fields of the Attachment model
+MAX_FILENAME_LENGTH = 256
+MAX_CONTENT_TYPE_LENGTH = 128
+
+def get_max_text_size():
+    return getattr(settings, 'HK_MAIL_MAX_TEXT_SIZE', 1 << 20)
+
+def normalize_str(s):
+    s = re.sub(r'\r\n', r'\n', s) # Windows EOL
+    s = re.sub(r'\xc2\xa0', ' ', s) # Non-breaking space
+    return s
+
+def utf8(s, charset):
+    if charset is not None:
+        try:
+            return s.decode(charset, 'replace').encode('utf-8')
+        except LookupError:
+            pass # Unknown charset
+    return s
+
+def html_to_text(html):
+    text = re.sub(r'(?is)<(script|style)\b.*?</\1\s*>', '', html)
+    text = re.sub(r'(?i)<br\s*/?>|</p\s*>', '\n', text)
+    text = re.sub(r'<[^>]*>', '', text).decode('utf-8', 'replace')
+    return HTMLParser.HTMLParser().unescape(text).encode('utf-8')
+
+def get_header(mail, name):
+    # Returns None if the header is missing.
+    value = mail[name]
+    if value is None:
+        return None
+    return email.header.decode_header(value)[0][0]
+
+def get_filename(headers, default):
+    # Returns the decoded file name of a part without directories.
+    filename = headers.get_filename()
+    if filename is None:
+        return default
+    if not isinstance(filename, unicode):
+        decoded = []
+        for value, charset in email.header.decode_header(filename):
+            # Raw 8-bit file names are usually in UTF-8
+            try:
+                decoded.append(value.decode(charset or 'utf-8', 'replace'))
+            except LookupError:
+                decoded.append(value.decode('utf-8', 'replace'))
+        filename = u''.join(decoded)
+    filename = re.split(r'[\\/]', filename)[-1][:MAX_FILENAME_LENGTH]
+    return filename or default
+
+
+##### Decoders of the transfer encodings
+
+class Base64Decoder(object):
+
+    def __init__(self):
+        self.rest = ''
+
+    def decode(self, data):
+        # Only whole groups of 4 characters can be decoded
+        data = self.rest + re.sub(r'[^A-Za-z0-9+/=]', '', data)
+        length = len(data) // 4 * 4
+        self.rest = data[length:]
+        try:
+            return binascii.a2b_base64(data[:length])
+        except binascii.Error:
+            return ''
+
+    def flush(self):
+        return ''
+
+
+class QuotedPrintableDecoder(object):
+
+    def __init__(self):
+        self.rest = ''
+
+    def decode(self, data):
+        # Only whole lines can be decoded, because of the soft line breaks
+        data = self.rest + data
+        end = data.rfind('\n') + 1
+        self.rest = data[end:]
+        return quopri.decodestring(data[:end])
+
+    def flush(self):
+        data = quopri.decodestring(self.rest)
+        self.rest = ''
+        return data
+
+
+class IdentityDecoder(object):
+
+    def decode(self, data):
+        return data
+
+    def flush(self):
+        return ''
+
+def get_decoder(headers):
+    encoding = (headers['Content-Transfer-Encoding'] or '').strip().lower()
+    if encoding == 'base64':
+        return Base64Decoder()
+    elif encoding == 'quoted-printable':
+        return QuotedPrintableDecoder()
+    else:
+        return IdentityDecoder()
+
+
+##### Parts
+
+class TextPart(object):
+    """Collects a text part of the mail.
+
+    At most `limit` bytes are kept. If the part is longer, it is written into
+    the attachment store as well.
+    """
+
+    def __init__(self, headers, limit):
+        self.content_type = \
+            headers.get_content_type()[:MAX_CONTENT_TYPE_LENGTH]
+        self.charset = headers.get_content_charset()
+        self.filename = get_filename(headers, u'message.txt')
+        self.limit = limit
+        self.data = StringIO()
+        self.size = 0
+        self.blob = None
+
+    def write(self, data):
+        if self.blob is None and self.size + len(data) > self.limit:
+            self.blob = BlobWriter()
+            self.blob.write(self.data.getvalue())
+        if self.blob is not None:
+            self.blob.write(data)
+        if self.size < self.limit:
+            self.data.write(data[:self.limit - self.size])
+        self.size += len(data)
+
+    def get_text(self):
+        text = utf8(self.data.getvalue(), self.charset)
+        if self.content_type == 'text/html':
+            text = html_to_text(text)
+        return text
+
+    def get_attachment(self):
+        # Returns the attachment of a long text part, or None.
+        if self.blob is None:
+            return None
+        return (self.filename, self.content_type, self.size, self.blob.close())
+
+    def abort(self):
+        if self.blob is not None:
+            self.blob.abort()
+
+
+class AttachmentPart(object):
+    """Writes a part of the mail into the attachment store."""
+
+    def __init__(self, headers):
+        self.content_type = \
+            headers.get_content_type()[:MAX_CONTENT_TYPE_LENGTH]
+        if self.content_type == 'message/rfc822':
+            self.filename = get_filename(headers, u'message.eml')
+        else:
+            self.filename = get_filename(headers, u'attachment')
+        self.blob = BlobWriter()
+
+    def write(self, data):
+        self.blob.write(data)
+
+    def get_attachment(self):
+        return (self.filename, self.content_type, self.blob.size,
+                self.blob.close())
+
+
+class ParsedMail(object):
+    """The result of `parse_mail_file`.
+
+    - `headers` (email.message.Message) -- The headers of the mail.
+    - `text` (str) -- The text of the message in UTF-8.
+    - `attachments` ([(str, str, int, str)]) -- The file name, content type,
+      size and digest of the attachments, which are in the attachment store
+      already.
+    """
+
+    def __init__(self, headers, text, attachments):
+        self.headers = headers
+        self.text = text
+        self.attachments = attachments
+
+    def get_fields(self):
+        """Returns the fields of the mail needed to store it.
+
+        **Returns:** (str, str | None, str | None, str, [str], [(str, str,
+        int, str)]) -- The subject, Message-ID, In-Reply-To, text, References
+        and attachments of the mail.
+        """
+
+        headers = self.headers
+        return (get_header(headers, 'Subject') or '',
+                get_header(headers, 'Message-ID'),
+                get_header(headers, 'In-Reply-To'),
+                self.text,
+                re.findall(r'<[^>]*>',
+                           get_header(headers, 'References') or ''),
+                self.attachments)
+
+
+##### Parser
+
+class MailParser(object):
+
+    def __init__(self, f):
+        self.f = f
+        self.unread_line = None
+        self.text_size = 0
+
+    def readline(self):
+        if self.unread_line is not None:
+            line = self.unread_line
+            self.unread_line = None
+            return line
+        return self.f.readline(MAX_LINE_LENGTH)
+
+    def unread(self, line):
+        self.unread_line = line
+
+    def match_boundary(self, line, boundaries):
+        # Returns the (boundary, closing) pair of a delimiter line, or None.
+        if not line.startswith('--'):
+            return None
+        line = line.rstrip()
+        for boundary in reversed(boundaries):
+            if line == '--' + boundary:
+                return boundary, False
+            elif line == '--' + boundary + '--':
+                return boundary, True
+        return None
+
+    def read_headers(self, boundaries):
+        parser = email.parser.FeedParser()
+        size = 0
+        while True:
+            line = self.readline()
+            if line == '' or self.match_boundary(line, boundaries):
+                self.unread(line)
+                break
+            if size < MAX_HEADER_SIZE:
+                parser.feed(line)
+                size += len(line)
+            if line in ('\n', '\r\n'):
+                break
+        # The body is not fed to the parser, so it only parses the headers
+        return parser.close()
+
+    def read_body(self, boundaries, part, decoder):
+        # Reads the body of a part until the delimiter of an enclosing part.
+        # The line break before the delimiter belongs to the delimiter.
+        line_break = ''
+        while True:
+            line = self.readline()
+            if line == '':
+                # Without a delimiter, the last line break is kept
+                data = decoder.decode(line_break)
+                if data and part is not None:
+                    part.write(data)
+                break
+            if self.match_boundary(line, boundaries):
+                self.unread(line)
+                break
+            if line.endswith('\r\n'):
+                content, next_line_break = line[:-2], '\r\n'
+            elif line.endswith('\n'):
+                content, next_line_break = line[:-1], '\n'
+            else:
+                content, next_line_break = line, ''
+            data = decoder.decode(line_break + content)
+            if data and part is not None:
+                part.write(data)
+            line_break = next_line_break
+        data = decoder.flush()
+        if data and part is not None:
+            part.write(data)
+
+    def parse_part(self, headers, boundaries, texts, attachments):
+        """Parses the body of a part.
+
+        **Arguments:**
+
+        - `headers` (email.message.Message) -- The headers of the part.
+        - `boundaries` ([str]) -- The boundaries of the enclosing multipart
+          parts.
+        - `texts` ([TextPart]) -- The text parts found are appended to it.
+        - `attachments` ([AttachmentPart]) -- The attachments found are
+          appended to it.
+        """
+
+        boundary = headers.get_boundary()
+        if headers.get_content_maintype() == 'multipart' and boundary:
+            self.parse_multipart(headers, boundaries + [boundary], texts,
+                                 attachments)
+            return
+
+        disposition = (headers['Content-Disposition'] or '').split(';')[0]
+        if headers.get_content_type() in ('text/plain', 'text/html') and \
+           disposition.strip().lower() != 'attachment':
+            part = TextPart(headers,
+                            max(get_max_text_size() - self.text_size, 0))
+            texts.append(part)
+        else:
+            part = AttachmentPart(headers)
+            attachments.append(part)
+        self.read_body(boundaries, part, get_decoder(headers))
+        if isinstance(part, TextPart):
+            self.text_size += min(part.size, part.limit)
+
+    def parse_multipart(self, headers, boundaries, texts, attachments):
+        boundary = boundaries[-1]
+        alternatives = []
+        self.read_body(boundaries, None, IdentityDecoder()) # Preamble
+        while True:
+            line = self.readline()
+            match = self.match_boundary(line, boundaries)
+            if match is None or match[0] != boundary:
+                # End of the file or of an enclosing part
+                self.unread(line)
+                break
+            if match[1]:
+                # The epilogue is ignored
+                self.read_body(boundaries[:-1], None, IdentityDecoder())
+                break
+            part_headers = self.read_headers(boundaries)
+            part_texts = []
+            self.parse_part(part_headers, boundaries, part_texts, attachments)
+            if headers.get_content_subtype() == 'alternative':
+                alternatives.append(part_texts)
+            else:
+                texts.extend(part_texts)
+
+        if alternatives:
+            # The first alternative with a text/plain part is used
+            chosen = alternatives[0]
+            for part_texts in alternatives:
+                if any(text.content_type == 'text/plain'
+                       for text in part_texts):
+                    chosen = part_texts
+                    break
+            for part_texts in alternatives:
+                if part_texts is not chosen:
+                    for text in part_texts:
+                        text.abort()
+            texts.extend(chosen)
+
+    def parse(self):
+        headers = self.read_headers([])
+        texts = []
+        attachments = []
+        self.parse_part(headers, [], texts, attachments)
+        text = '\n'.join(part.get_text() for part in texts)
+        attachment_list = [part.get_attachment() for part in texts]
+        attachment_list.extend(part.get_attachment() for part in attachments)
+        return ParsedMail(headers,
+                          normalize_str(text),
+                          [attachment for attachment in attachment_list
+                           if attachment is not None])
+
+def parse_mail_file(f):
+    """Parses a mail.
+
+    **Argument:**
+
+    - `f` (file) -- The mail, with headers.
+
+    **Returns:** ParsedMail
+    """
+
+    return MailParser(f).parse()
+
+def parse_mail(data):
+    """Parses a mail.
+
+    **Argument:**
+
+    - `data` (str) -- The mail, with headers.
+
+    **Returns:** tuple -- See `ParsedMail.get_fields`.
+    """
+
+    return parse_mail_file(StringIO(data)).get_fields()
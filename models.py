@@ -15,24 +15,150 @@
 # Copyright (C) 2012 Attila Nagy
 # Copyright (C) 2012 Csaba Hoch
 
-from django.db import models
+from django.db import connection, models, transaction
+from django.db.models import Count, F, Max, Q
+from django.db.models.signals import m2m_changed, post_delete, post_init, \
+                                      post_save, pre_delete, pre_save
+from django.conf import settings
 from django.contrib.auth.models import User
 from django.core import urlresolvers
 from django.core.exceptions import PermissionDenied
+from hk import fragmentcache
+from hk import ingestcache
+from hk import search
+from hk import textdelta
 import datetime
+import threading
+
+# Cache of the given user rights, keyed by (heap id, user id). It is enabled
+# only while a request is processed (see UserRightCacheMiddleware), and it is
+# cleared whenever a UserRight changes.
+userright_cache = threading.local()
+
+def enable_userright_cache():
+    userright_cache.rights = {}
+
+def disable_userright_cache():
+    userright_cache.rights = None
+
+def clear_userright_cache():
+    rights = getattr(userright_cache, 'rights', None)
+    if rights is not None:
+        rights.clear()
+
+def move_subtree(old_path, new_path, root_id):
+    # Replaces the old_path prefix of the paths in the subtree with new_path
+    # and sets the root of the subtree.
+    cursor = connection.cursor()
+    cursor.execute(
+        'UPDATE %(table)s SET %(path)s = %%s || substr(%(path)s, %%s), '
+        '%(root)s = %%s WHERE %(path)s LIKE %%s' %
+        {'table': connection.ops.quote_name(Message._meta.db_table),
+         'path': connection.ops.quote_name('path'),
+         'root': connection.ops.quote_name('root_id')},
+        [new_path, len(old_path) + 1, root_id, old_path + '%'])
+    transaction.commit_unless_managed()
+
+def compute_ancestry(parents):
+    """Calculates the root and path of messages.
+
+    **Argument:**
+
+    - `parents` ({int: int}) -- The id of the current parent of each message
+      (``None`` for root messages).
+
+    **Returns:** {int: (int, str)} -- The root id and path of each message
+    that is not in or below a parent loop.
+    """
+
+    children = {}
+    for msg_id, parent_id in parents.iteritems():
+        children.setdefault(parent_id, []).append(msg_id)
+    result = {}
+    stack = [(msg_id, msg_id, '/%d/' % msg_id)
+             for msg_id in children.get(None, [])]
+    while stack:
+        msg_id, root_id, path = stack.pop()
+        result[msg_id] = (root_id, path)
+        for child_id in children.get(msg_id, []):
+            stack.append((child_id, root_id, '%s%d/' % (path, child_id)))
+    return result
+
+def compute_latest_versions(message_ids=None):
+    """Finds the latest version of messages with one pass over their
+    versions.
+
+    **Argument:**
+
+    - `message_ids` ([int] | None) -- The messages; ``None`` means all
+      messages. The ids should be at most a few hundred, because they are
+      put into one query.
+
+    **Returns:** {int: int} -- The id of the latest version by message id.
+    Messages without versions are missing.
+    """
+
+    # The versions are ordered so that the last version seen for a message is
+    # its latest one.
+    latest = {}
+    versions = MessageVersion.objects \
+                   .order_by('message', 'version_date', 'id') \
+                   .values_list('message', 'id')
+    if message_ids is not None:
+        versions = versions.filter(message__in=message_ids)
+    for message_id, version_id in versions.iterator():
+        latest[message_id] = version_id
+    return latest
+
+def get_snapshot_interval():
+    return getattr(settings, 'HK_VERSION_SNAPSHOT_INTERVAL', 10)
+
+def get_label_objs(labels):
+    """Returns the Label objects of label texts, creating the missing labels.
+
+    The labels are looked up with one query in the transaction of the caller,
+    so a label deleted meanwhile by another process (e.g. by "manage.py
+    gclabels") is created again.
+
+    **Argument:**
+
+    - `labels` ([unicode])
+
+    **Returns:** [Label] -- The labels without duplicates, in the order of
+    their first occurrence.
+    """
+
+    texts = []
+    for text in labels:
+        if text not in texts:
+            texts.append(text)
+    if texts:
+        existing = set(Label.objects.filter(text__in=texts)
+                           .values_list('text', flat=True))
+        for text in texts:
+            if text not in existing:
+                Label(text=text).save(force_insert=True)
+    return [Label(text=text) for text in texts]
 
-def get_or_make_label_obj(label):
-    try:
-        label_obj = Label.objects.get(pk=label)
-    except Label.DoesNotExist:
-        label_obj = Label(text=label)
-        label_obj.save()
-    return label_obj
-        
 
 class Message(models.Model):
     users_have_read = models.ManyToManyField(User, null=True, blank=True)
-    message_id = models.CharField(max_length=1024, null=True, blank=True) 
+    message_id = models.CharField(max_length=1024, null=True, blank=True,
+                                  db_index=True)
+    # The latest version of the message. It is kept up to date by
+    # MessageVersion.save, so reading the current state of a message does not
+    # need to look at its whole history.
+    current_version = models.ForeignKey('MessageVersion', null=True,
+                                        blank=True, editable=False,
+                                        related_name='+',
+                                        on_delete=models.SET_NULL)
+    # The root of the thread that contains the message, and the ids of the
+    # messages from the root to this message (e.g. "/1/5/9/"). They describe
+    # the current version, and are maintained together with current_version.
+    root = models.ForeignKey('self', null=True, blank=True, editable=False,
+                             related_name='+', on_delete=models.SET_NULL)
+    path = models.CharField(max_length=2048, blank=True, editable=False,
+                            db_index=True)
 
     def __unicode__(self):
         return "Message #%d" % (
@@ -40,12 +166,104 @@ class Message(models.Model):
             )
 
     def latest_version(self):
-        version_list = list(MessageVersion.objects.filter(message=self))
-        version_list.sort(key=lambda l: l.version_date)
+        if self.current_version_id is None:
+            # The pointer has not been filled in yet (e.g. the database was
+            # created before it existed and has not been backfilled).
+            return self.find_latest_version()
+        return self.current_version
+
+    def find_latest_version(self):
+        # Finds the latest version without using the current_version pointer.
+        version_list = MessageVersion.objects.filter(message=self) \
+                           .order_by('-version_date', '-id')[:1]
         if len(version_list) == 0:
             return None
         else:
-            return version_list[-1]
+            return version_list[0]
+
+    def refresh_current_version(self):
+        # Recalculates the current_version pointer from the versions of the
+        # message.
+        self.current_version = self.find_latest_version()
+        Message.objects.filter(pk=self.pk).update(
+            current_version=self.current_version)
+        if self.current_version is not None:
+            # It may be an old version that was stored as a delta
+            self.current_version.expand()
+        return self.update_ancestry()
+
+    def version_saved(self, version):
+        # Called by MessageVersion.save. The version becomes the current one
+        # unless there is a newer version already; the check and the update
+        # are performed in one statement.
+        if version.id == self.current_version_id:
+            # The current version itself was modified, maybe its date too.
+            root_ids = self.refresh_current_version()
+        else:
+            version_date = version.version_date
+            newer = (Q(current_version__isnull=True) |
+                     Q(current_version__version_date__lte=version_date))
+            old_version_id = Message.objects.filter(pk=self.pk) \
+                                 .values_list('current_version', flat=True)[0]
+            updated = Message.objects.filter(pk=self.pk).filter(newer) \
+                          .update(current_version=version)
+            if updated:
+                self.current_version = version
+                version.expand()
+                if old_version_id is not None:
+                    # The previous version is stored as a delta from now
+                    MessageVersion.objects.get(pk=old_version_id) \
+                        .compress(version)
+                root_ids = self.update_ancestry()
+            else:
+                # An old version was saved; the message was not moved
+                root_ids = [get_root_id(self.pk)]
+        # If the message was moved, both conversations change.
+        update_conversation_stats(root_ids)
+        self.update_search_index()
+
+    def update_search_index(self):
+        version = self.current_version
+        if version is None or version.deleted:
+            search.index_messages([(self.pk, None)])
+        else:
+            search.index_messages([(self.pk, version.text)])
+
+    def update_ancestry(self):
+        # Recalculates root and path from the current parent. If they change,
+        # the whole subtree of the message is moved with one statement.
+        # Returns the old and the new root id.
+        old_root_id, old_path, parent_id, parent_root_id, parent_path = \
+            Message.objects.filter(pk=self.pk).values_list(
+                'root',
+                'path',
+                'current_version__parent',
+                'current_version__parent__root',
+                'current_version__parent__path')[0]
+        if parent_id is None:
+            root_id = self.pk
+            path = '/%d/' % self.pk
+        else:
+            if not parent_path:
+                # The parent has not been backfilled yet; the updatepaths
+                # command will take care of this message too.
+                return old_root_id, old_root_id
+            if old_path and parent_path.startswith(old_path):
+                # The message would become its own ancestor. The path is left
+                # as it is; fsck reports the loop.
+                return old_root_id, old_root_id
+            root_id = parent_root_id
+            path = '%s%d/' % (parent_path, self.pk)
+
+        if path != old_path or root_id != old_root_id:
+            if old_path:
+                move_subtree(old_path, path, root_id)
+            else:
+                Message.objects.filter(pk=self.pk).update(path=path,
+                                                          root=root_id)
+        self.root_id = root_id
+        self.path = path
+        return old_root_id, root_id
 
     def latest_version_link(self):
         latest = self.latest_version()
@@ -66,6 +284,7 @@ class Message(models.Model):
         # A function to create a new version of the message with some
         # fields changed
         latest = self.latest_version()
+        labels = kwargs.pop('labels', None)
         mv = MessageVersion(
                 message=self,
                 parent=latest.parent,
@@ -74,29 +293,59 @@ class Message(models.Model):
                 version_date=datetime.datetime.now(),
                 text=latest.text,
             )
-        # We have to save before because many-to-many relations need a PK.
-        mv.save()
-        mv.labels = list(latest.labels.all())
         for field in kwargs:
             setattr(mv, field, kwargs[field])
-        mv.save() 
+        # The version is saved only once (saving it updates the statistics
+        # of the conversation); the many-to-many relations need its PK.
+        mv.save()
+        if labels is not None:
+            mv.labels = labels
+        else:
+            mv.labels = list(latest.labels.all())
+        mv.copy_attachments(latest)
 
     def add_label(self, label_or_labels):
         if label_or_labels.__class__ in (str, unicode):
             label_list = (label_or_labels,)
         else:
             label_list = label_or_labels
+        self.change_labels(get_label_objs(label_list), ())
+
+    def change_labels(self, add, remove):
+        """Adds and removes labels by creating one new version.
+
+        No version is created if the labels would not change.
+
+        **Arguments:**
+
+        - `add` ([Label])
+        - `remove` ([unicode]) -- The texts of the labels to remove.
+
+        **Returns:** bool -- Whether the labels changed.
+        """
 
-        label_objs = [ get_or_make_label_obj(label) for label in label_list ]
         labels = list(self.latest_version().labels.all())
-        labels.extend(label_objs)
-        self.change(labels=labels)
+        texts = set(label.text for label in labels)
+        new_labels = [label for label in labels if label.text not in remove]
+        new_labels.extend(label for label in add
+                          if label.text not in texts and
+                             label.text not in remove)
+        if set(label.text for label in new_labels) == texts:
+            return False
+        # The primary keys are used, since the labels returned by
+        # get_label_objs are not loaded from the database
+        self.change(labels=[label.pk for label in new_labels])
+        return True
 
     def current_parent(self):
         parent = self.latest_version().parent
         return parent
 
     def get_root_message(self, exception=False):
+        if not exception and self.root_id is not None:
+            return Message.objects.get(pk=self.root_id)
+        # Walking the parents is needed to detect loops (and for messages
+        # whose root has not been backfilled).
         touched = []
         msg = self
         while True:
@@ -111,17 +360,23 @@ class Message(models.Model):
                 return msg
             msg = latest_parent
 
+    def is_ancestor_of(self, msg):
+        # Returns whether self is msg or one of its ancestors.
+        return bool(self.path) and msg.path.startswith(self.path)
+
     def get_conversation(self):
-        root_message = self.get_root_message()
+        if self.root_id is not None:
+            root_message = self.root_id
+        else:
+            root_message = self.get_root_message()
         return Conversation.objects.get(root_message=root_message)
 
     def get_heap(self):
         return self.get_conversation().heap
 
     def get_children(self):
-        return [m for m in Message.objects.all()
-                    if not m.is_deleted()
-                        and m.current_parent() == self]
+        return list(Message.objects.filter(current_version__parent=self,
+                                           current_version__deleted=False))
 
 
 class Label(models.Model):
@@ -140,15 +395,165 @@ class MessageVersion(models.Model):
     text = models.TextField('the text of the message')
     labels = models.ManyToManyField(Label, null=True, blank=True)
     deleted = models.BooleanField()
+    # If set, `text` is not the text of the version but a delta against the
+    # text of this newer version of the message (see hk.textdelta). The
+    # current version is always stored in full, and so is every
+    # HK_VERSION_SNAPSHOT_INTERVAL-th version, which limits the number of
+    # deltas applied to get a text. Use get_text to read old versions.
+    text_base = models.ForeignKey('self', null=True, blank=True,
+                                  editable=False, related_name='+',
+                                  on_delete=models.SET_NULL)
 
     def __unicode__(self):
         labels = ', '.join([label.text for label in self.labels.all()])
         return "MessageVersion #%d (labels: %s, text: %s)" % (
                 self.id,
                 labels or '<none>',
-                self.text[0:32],
+                self.get_text()[0:32],
             )
 
+    def save(self, *args, **kwargs):
+        if self.id is not None and self.text_base_id is None:
+            old_text = MessageVersion.objects.filter(pk=self.id) \
+                           .values_list('text', flat=True)
+            if old_text and old_text[0] != self.text:
+                # The deltas against the old text would be wrong
+                for version in MessageVersion.objects.filter(text_base=self):
+                    version.expand()
+        super(MessageVersion, self).save(*args, **kwargs)
+        self.message.version_saved(self)
+
+    def get_text(self):
+        # Returns the text of the version, applying the deltas if needed.
+        deltas = []
+        text, text_base_id = self.text, self.text_base_id
+        while text_base_id is not None:
+            deltas.append(text)
+            text, text_base_id = MessageVersion.objects \
+                                     .filter(pk=text_base_id) \
+                                     .values_list('text', 'text_base')[0]
+        for delta in reversed(deltas):
+            text = textdelta.apply_delta(text, delta)
+        return text
+
+    def expand(self):
+        # Stores the text of the version in full.
+        if self.text_base_id is not None:
+            self.text = self.get_text()
+            self.text_base = None
+            MessageVersion.objects.filter(pk=self.id) \
+                .update(text=self.text, text_base=None)
+
+    def compress(self, base):
+        """Stores the text as a delta against a newer version.
+
+        Nothing happens if the version is a snapshot (see `text_base`), or if
+        the delta would not be shorter than the text.
+
+        **Argument:**
+
+        - `base` (MessageVersion) -- A version stored in full.
+
+        **Returns:** bool -- Whether the version was compressed.
+        """
+
+        if self.text_base_id is not None or base.text_base_id is not None:
+            return False
+        older = MessageVersion.objects \
+                    .filter(message=self.message_id) \
+                    .filter(Q(version_date__lt=self.version_date) |
+                            Q(version_date=self.version_date,
+                              id__lt=self.id)) \
+                    .count()
+        if older % get_snapshot_interval() == 0:
+            return False
+        # The texts are read from the database, so that they are unicode
+        texts = dict(MessageVersion.objects
+                         .filter(pk__in=[self.id, base.id])
+                         .values_list('id', 'text'))
+        delta = textdelta.make_delta(texts[base.id], texts[self.id])
+        if len(delta) >= len(texts[self.id]):
+            return False
+        self.text, self.text_base = delta, base
+        MessageVersion.objects.filter(pk=self.id) \
+            .update(text=delta, text_base=base)
+        return True
+
+    def copy_attachments(self, version):
+        # Gives the attachments of `version` to this version.
+        for attachment in version.attachments.all():
+            Attachment(version=self,
+                       blob_id=attachment.blob_id,
+                       filename=attachment.filename,
+                       content_type=attachment.content_type).save()
+
+
+def get_version_texts(versions):
+    """Returns the texts of the versions of a message.
+
+    The deltas are applied to the texts of the other versions where
+    possible, instead of reading the chain of bases of each version.
+
+    **Argument:**
+
+    - `versions` ([MessageVersion]) -- In the order of their dates.
+
+    **Returns:** {int: unicode} -- The texts by version id.
+    """
+
+    texts = {}
+    for version in reversed(versions):
+        if version.text_base_id is None:
+            texts[version.id] = version.text
+        elif version.text_base_id in texts:
+            texts[version.id] = textdelta.apply_delta(
+                                    texts[version.text_base_id],
+                                    version.text)
+        else:
+            texts[version.id] = version.get_text()
+    return texts
+
+def compress_versions(message_id, expand=False):
+    """Stores the old versions of a message as deltas.
+
+    Every version except the current one and the snapshots (see
+    `MessageVersion.text_base`) is stored as a delta against the next
+    version, if that is shorter than its text.
+
+    **Arguments:**
+
+    - `message_id` (int)
+    - `expand` (bool) -- If true, every version is stored in full instead.
+
+    **Returns:** (int, int) -- The number of versions changed and the number
+    of characters saved.
+    """
+
+    versions = list(MessageVersion.objects
+                        .filter(message=message_id)
+                        .order_by('version_date', 'id'))
+    current_id = Message.objects.filter(pk=message_id) \
+                     .values_list('current_version', flat=True)[0]
+    texts = get_version_texts(versions)
+    interval = get_snapshot_interval()
+    changed = saved = 0
+    for i, version in enumerate(versions):
+        text, base_id = texts[version.id], None
+        if not (expand or
+                i % interval == 0 or
+                i == len(versions) - 1 or
+                version.id == current_id):
+            base = versions[i + 1]
+            delta = textdelta.make_delta(texts[base.id], text)
+            if len(delta) < len(text):
+                text, base_id = delta, base.id
+        if (text, base_id) != (version.text, version.text_base_id):
+            MessageVersion.objects.filter(pk=version.id) \
+                .update(text=text, text_base=base_id)
+            changed += 1
+            saved += len(version.text) - len(text)
+    return changed, saved
+
 
 class Heap(models.Model):
     HEAP_VISIBILITY_CHOICES = (
@@ -157,7 +562,7 @@ class Heap(models.Model):
            (2, 'Private'),
        )
     visibility = models.SmallIntegerField(choices=HEAP_VISIBILITY_CHOICES)
-    short_name = models.CharField(max_length=64)
+    short_name = models.CharField(max_length=64, db_index=True)
     long_name = models.CharField(max_length=256)
     user_fields = models.ManyToManyField(User, through='UserRight')
 
@@ -176,13 +581,20 @@ class Heap(models.Model):
         # into account.
         if not user.is_authenticated():
             return -1
+        rights = getattr(userright_cache, 'rights', None)
+        key = (self.id, user.id)
+        if rights is not None and key in rights:
+            return rights[key]
         highest = None
         # TODO: issue a warning if multiple userrights exist for a given user
         # and heap
         for uright in self.userright_set.filter(user=user):
             if highest is None or uright.right > highest.right:
                 highest = uright
-        return highest.right if highest is not None else -1
+        right = highest.right if highest is not None else -1
+        if rights is not None:
+            rights[key] = right
+        return right
 
     def get_effective_userright(self, user):
         # Skip all checks if the user is None, then xe is anon.
@@ -192,7 +604,10 @@ class Heap(models.Model):
         if user.is_superuser:
             return 3
         given_right = self.get_given_userright(user)
-        visibility = self.visibility
+        return max(given_right, self.get_visibility_right())
+
+    def get_visibility_right(self):
+        # This is the right that everyone has on the heap.
         visibility_rights = \
             (
                 # visibility == 0:
@@ -202,16 +617,45 @@ class Heap(models.Model):
                 # visibility == 2:
                 -1 # Private heaps give no rights to anyone.
             )
-        visibility_right = visibility_rights[visibility]
-        return max(given_right, visibility_right)
+        return visibility_rights[self.visibility]
 
     def is_visible_for(self, user):
         return self.get_effective_userright(user) >= 0
 
+    @classmethod
+    def get_visible_heaps(cls, user):
+        # Returns the heaps that the user can read, using the EffectiveRight
+        # table.
+        if user is None or not user.is_authenticated():
+            return cls.objects.filter(visibility__lt=2)
+        return cls.objects.filter(
+                   Q(visibility__lt=2) |
+                   Q(effectiveright__user=user,
+                     effectiveright__right__gte=0)).distinct()
+
     def users(self):
         return list(set(self.user_fields.all()))
 
 
+class RetentionPolicy(models.Model):
+    # Which old versions of the messages of a heap are deleted by "manage.py
+    # pruneversions" (see hk.retention). The first and the current version
+    # of a message are always kept; heaps without a policy keep every
+    # version.
+    heap = models.OneToOneField(Heap)
+    # Only the last keep_versions versions are kept (None means all)
+    keep_versions = models.PositiveIntegerField(null=True, blank=True)
+    # Of the consecutive versions that did not change the text (e.g. label
+    # changes), only the last one is kept if they are older than this (None
+    # means that they are kept)
+    collapse_after_days = models.PositiveIntegerField(null=True, blank=True)
+
+    def __unicode__(self):
+        return "RetentionPolicy of heap '%s'" % (
+                self.heap.short_name,
+            )
+
+
 class UserRight(models.Model):
     RIGHT_CHOICES = (
            (0, 'read'),
@@ -237,11 +681,108 @@ class UserRight(models.Model):
             if num==right][0]
 
 
+class EffectiveRight(models.Model):
+    # The effective right of users on heaps, calculated from their UserRight
+    # objects, the visibility of the heap and their superuser status. Rows
+    # exist for users who have a UserRight on the heap and for superusers;
+    # everyone else has the visibility right of the heap. The rows are
+    # maintained by signal handlers (see update_effective_right).
+    user = models.ForeignKey(User)
+    heap = models.ForeignKey(Heap)
+    # -1 if the user has no UserRight on the heap
+    given_right = models.SmallIntegerField()
+    right = models.SmallIntegerField()
+
+    class Meta:
+        unique_together = ('user', 'heap')
+
+    def __unicode__(self):
+        return "%s: %s has effective right %s" % (
+                self.heap,
+                self.user,
+                self.right,
+            )
+
+
+def calculate_effective_right(user, heap):
+    # Returns the (given right, effective right) pair of the user on the heap,
+    # or None if no EffectiveRight row is needed.
+    given_right = -1
+    for right in UserRight.objects.filter(user=user, heap=heap) \
+                     .values_list('right', flat=True):
+        given_right = max(given_right, right)
+    if user.is_superuser:
+        return given_right, 3
+    elif given_right != -1:
+        return given_right, max(given_right, heap.get_visibility_right())
+    else:
+        return None
+
+def update_effective_right(user, heap):
+    rights = calculate_effective_right(user, heap)
+    if rights is None:
+        EffectiveRight.objects.filter(user=user, heap=heap).delete()
+        return
+    given_right, right = rights
+    updated = EffectiveRight.objects.filter(user=user, heap=heap) \
+                  .update(given_right=given_right, right=right)
+    if not updated:
+        EffectiveRight(user=user, heap=heap,
+                       given_right=given_right, right=right).save()
+
+def compute_effective_rights():
+    """Calculates the rows of the EffectiveRight table from the UserRight
+    objects, the visibility of the heaps and the superusers.
+
+    **Returns:** {(int, int): (int, int)} -- The (given right, effective
+    right) pairs by (user id, heap id).
+    """
+
+    visibility_rights = {}
+    for heap in Heap.objects.all():
+        visibility_rights[heap.id] = heap.get_visibility_right()
+    given_rights = {}
+    for user_id, heap_id, right in \
+            UserRight.objects.values_list('user', 'heap', 'right').iterator():
+        key = (user_id, heap_id)
+        given_rights[key] = max(given_rights.get(key, -1), right)
+    result = {}
+    for key, given_right in given_rights.iteritems():
+        result[key] = (given_right,
+                       max(given_right, visibility_rights[key[1]]))
+    for user_id in User.objects.filter(is_superuser=True) \
+                       .values_list('id', flat=True):
+        for heap_id in visibility_rights:
+            key = (user_id, heap_id)
+            result[key] = (given_rights.get(key, -1), 3)
+    return result
+
+def update_effective_rights_of_heap(heap):
+    users = set(User.objects.filter(Q(is_superuser=True) |
+                                    Q(userright__heap=heap) |
+                                    Q(effectiveright__heap=heap)))
+    for user in users:
+        update_effective_right(user, heap)
+
+def update_effective_rights_of_user(user):
+    for heap in Heap.objects.all():
+        update_effective_right(user, heap)
+
+
 class Conversation(models.Model):
     subject = models.CharField(max_length=256) 
     labels = models.ManyToManyField(Label, null=True, blank=True)
     root_message = models.ForeignKey(Message)
     heap = models.ForeignKey(Heap)
+    # The latest version date in the thread, the number of non-deleted
+    # messages and the number of their authors. They are maintained by
+    # update_conversation_stats.
+    last_activity = models.DateTimeField(default=datetime.datetime.now,
+                                         editable=False)
+    message_count = models.IntegerField(default=0, editable=False)
+    participant_count = models.IntegerField(default=0, editable=False)
+    # The conversations of a heap are listed by last activity using an index
+    # created by sql/heap.sql.
 
     def __unicode__(self):
         return "Conversation #%s (%s)" % (
@@ -254,11 +795,336 @@ class Conversation(models.Model):
             label_list = (label_or_labels,)
         else:
             label_list = label_or_labels
+        self.change_labels(get_label_objs(label_list), ())
+
+    def change_labels(self, add, remove):
+        """Adds and removes labels; see `Message.change_labels`."""
 
-        label_objs = [ get_or_make_label_obj(label) for label in label_list ]
-        for label_obj in label_objs:
-            self.labels.add(label_obj)
+        texts = set(self.labels.values_list('text', flat=True))
+        add = [label for label in add
+               if label.text not in texts and label.text not in remove]
+        remove = [text for text in remove if text in texts]
+        if not add and not remove:
+            return False
+        if add:
+            self.labels.add(*[label.pk for label in add])
+        if remove:
+            self.labels.remove(*remove)
         self.save()
+        return True
+
+def compute_conversation_stats(root_ids=None):
+    """Calculates the statistics of the threads from the messages.
+
+    **Argument:**
+
+    - `root_ids` ([int] | None) -- The roots of the threads. If ``None``, all
+      threads are calculated.
+
+    **Returns:** {int: (datetime, int, int)} -- The last activity, message
+    count and participant count by root id.
+    """
+
+    all_messages = Message.objects.all()
+    if root_ids is not None:
+        all_messages = all_messages.filter(root__in=root_ids)
+    last_activities = all_messages \
+                          .values('root') \
+                          .annotate(last=Max('current_version__version_date'))
+    counts = all_messages \
+                 .filter(current_version__deleted=False) \
+                 .values('root') \
+                 .annotate(messages=Count('id'),
+                           participants=Count('current_version__author',
+                                              distinct=True))
+    result = {}
+    for row in last_activities:
+        if row['root'] is not None and row['last'] is not None:
+            result[row['root']] = (row['last'], 0, 0)
+    for row in counts:
+        if row['root'] in result:
+            result[row['root']] = (result[row['root']][0],
+                                   row['messages'],
+                                   row['participants'])
+    return result
+
+def update_conversation_stats(root_ids):
+    root_ids = set(root_ids)
+    root_ids.discard(None)
+    if not root_ids:
+        return
+    stats = compute_conversation_stats(list(root_ids))
+    for root_id in root_ids:
+        if root_id not in stats:
+            # The root has no versions (e.g. it is being created)
+            continue
+        last_activity, message_count, participant_count = stats[root_id]
+        Conversation.objects.filter(root_message=root_id).update(
+            last_activity=last_activity,
+            message_count=message_count,
+            participant_count=participant_count)
+    update_label_counts(root_ids)
+
+
+class LabelCount(models.Model):
+    # The label index: a row tells that a label is carried by a conversation
+    # itself or by the current versions of some of its messages, and how many
+    # of them. Finding out whether a label is used, listing the labels of a
+    # heap and filtering conversations by labels use these rows, so they do
+    # not need to look at the old versions or the messages. Rows of unused
+    # labels are deleted. The rows are maintained by update_label_counts,
+    # which is called together with update_conversation_stats and when the
+    # labels of a version or a conversation change.
+    label = models.ForeignKey(Label)
+    conversation = models.ForeignKey(Conversation)
+    message_count = models.IntegerField(default=0)
+    # Deleted messages are counted separately: they are not listed, but
+    # their labels are still in use, since they can be undeleted.
+    deleted_count = models.IntegerField(default=0)
+    on_conversation = models.BooleanField(default=False)
+
+    class Meta:
+        unique_together = ('conversation', 'label')
+
+    def __unicode__(self):
+        return "LabelCount (%s, conversation #%d: %d, %d deleted%s)" % (
+                self.label_id,
+                self.conversation_id,
+                self.message_count,
+                self.deleted_count,
+                ', on conversation' if self.on_conversation else '',
+            )
+
+def compute_label_counts(root_ids=None):
+    """Counts the labels of the current versions and the conversations of
+    the threads.
+
+    **Argument:**
+
+    - `root_ids` ([int] | None) -- The roots of the threads. If ``None``, all
+      threads are counted.
+
+    **Returns:** {(int, unicode): (int, int, bool)} -- The number of
+    non-deleted and deleted messages, and whether the conversation has the
+    label, by root id and label.
+    """
+
+    messages = Message.objects.filter(current_version__labels__isnull=False)
+    conv_labels = Conversation.labels.through.objects
+    if root_ids is not None:
+        messages = messages.filter(root__in=root_ids)
+        conv_labels = conv_labels.filter(
+                          conversation__root_message__in=root_ids)
+    rows = messages \
+               .values_list('root', 'current_version__labels',
+                            'current_version__deleted') \
+               .annotate(count=Count('id')) \
+               .order_by()
+    result = {}
+    for root_id, label, deleted, count in rows:
+        if root_id is None:
+            continue
+        counts = result.get((root_id, label), (0, 0, False))
+        if deleted:
+            result[(root_id, label)] = (counts[0], counts[1] + count, False)
+        else:
+            result[(root_id, label)] = (counts[0] + count, counts[1], False)
+    for root_id, label in \
+            conv_labels.values_list('conversation__root_message', 'label'):
+        counts = result.get((root_id, label), (0, 0, False))
+        result[(root_id, label)] = (counts[0], counts[1], True)
+    return result
+
+def update_label_counts(root_ids):
+    """Brings the LabelCount rows of the threads up to date.
+
+    **Argument:**
+
+    - `root_ids` ([int])
+
+    **Returns:** int -- The number of rows created, changed or deleted.
+    """
+
+    root_ids = set(root_ids)
+    root_ids.discard(None)
+    if not root_ids:
+        return 0
+    conv_ids = dict(Conversation.objects
+                        .filter(root_message__in=root_ids)
+                        .values_list('root_message', 'id'))
+    expected = dict(((conv_ids[root_id], label), counts)
+                    for (root_id, label), counts in
+                    compute_label_counts(list(root_ids)).iteritems()
+                    if root_id in conv_ids)
+    changed = 0
+    unused = []
+    for row in LabelCount.objects \
+                   .filter(conversation__in=conv_ids.values()) \
+                   .values_list('id', 'conversation', 'label',
+                                'message_count', 'deleted_count',
+                                'on_conversation'):
+        row_id, conv_id, label, current = row[0], row[1], row[2], row[3:]
+        counts = expected.pop((conv_id, label), None)
+        if counts is None:
+            LabelCount.objects.filter(pk=row_id).delete()
+            unused.append(label)
+            changed += 1
+        elif counts != current:
+            LabelCount.objects.filter(pk=row_id).update(
+                message_count=counts[0],
+                deleted_count=counts[1],
+                on_conversation=counts[2])
+            changed += 1
+    for (conv_id, label), (message_count, deleted_count, on_conversation) \
+            in expected.iteritems():
+        LabelCount(label_id=label,
+                   conversation_id=conv_id,
+                   message_count=message_count,
+                   deleted_count=deleted_count,
+                   on_conversation=on_conversation).save(force_insert=True)
+        changed += 1
+    # The labels that may have become unused are checked by the next
+    # incremental fsck
+    touch('label', unused)
+    return changed
+
+
+class PendingReply(models.Model):
+    # A message received as a reply whose parent was not found. It waits for
+    # the messages listed in its In-Reply-To and References headers; when one
+    # of them arrives in the same heap, the reply is attached to it (see
+    # hk.emaillistener.attach_pending_replies). The lower the rank, the closer
+    # the awaited message is to the reply.
+    message = models.ForeignKey(Message)
+    heap = models.ForeignKey(Heap)
+    awaited = models.CharField(max_length=1024, db_index=True)
+    rank = models.IntegerField()
+
+    def __unicode__(self):
+        return "PendingReply #%d: %s awaits %s" % (
+                self.id,
+                self.message,
+                self.awaited,
+            )
+
+
+class Blob(models.Model):
+    # A file in the attachment store (see hk.attachments), named after the
+    # SHA-256 digest of its content in hexadecimal. Attachments with the same
+    # content share their blob.
+    digest = models.CharField(max_length=64, unique=True)
+    size = models.BigIntegerField()
+    # The number of attachments of the blob, maintained by the signal
+    # handlers of Attachment. Blobs without attachments are removed by
+    # "manage.py gcattachments".
+    refcount = models.IntegerField(default=0)
+
+    def __unicode__(self):
+        return "Blob %s (%d references)" % (
+                self.digest,
+                self.refcount,
+            )
+
+
+class Attachment(models.Model):
+    # A file attached to a version of a message. A new version of a message
+    # gets copies of the attachments of the version it is based on.
+    version = models.ForeignKey(MessageVersion, related_name='attachments')
+    blob = models.ForeignKey(Blob)
+    filename = models.CharField(max_length=256)
+    content_type = models.CharField(max_length=128)
+
+    def __unicode__(self):
+        return "Attachment #%d (%s)" % (
+                self.id,
+                self.filename,
+            )
+
+
+class SearchPosting(models.Model):
+    # The occurrences of words in the current versions of messages; used by
+    # hk.search.InvertedIndexBackend.
+    term = models.CharField(max_length=64, db_index=True)
+    message = models.ForeignKey(Message)
+    count = models.IntegerField()
+
+
+class TouchedObject(models.Model):
+    # The objects changed recently; used by the incremental mode of fsck,
+    # which checks only the objects changed since the last clean check. The
+    # rows are written by signal handlers (see touch) and deleted by fsck.
+    KIND_CHOICES = (
+           ('message', 'message'),
+           ('conversation', 'conversation'),
+           ('label', 'label'),
+           ('heap', 'heap'),
+           ('user', 'user'),
+       )
+    kind = models.CharField(max_length=16, choices=KIND_CHOICES)
+    # The primary key of the object (the text of labels, the id of others)
+    key = models.CharField(max_length=64, db_index=True)
+    date = models.DateTimeField(db_index=True)
+
+def touch(kind, keys):
+    now = datetime.datetime.now()
+    for key in set(keys):
+        if key is None:
+            continue
+        key = unicode(key)
+        updated = TouchedObject.objects.filter(kind=kind, key=key) \
+                      .update(date=now)
+        if not updated:
+            TouchedObject(kind=kind, key=key, date=now).save()
+
+
+class FsckJob(models.Model):
+    # A run of the database integrity check (see hk.fsck). The checks are
+    # performed one after the other; next_check is the checkpoint from which
+    # an interrupted job is resumed.
+    STATUS_CHOICES = (
+           ('queued', 'queued'),
+           ('running', 'running'),
+           ('done', 'done'),
+           ('failed', 'failed'),
+       )
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES,
+                              default='queued')
+    # Incremental jobs check only the objects changed since `since`
+    incremental = models.BooleanField()
+    since = models.DateTimeField(null=True, blank=True)
+    created = models.DateTimeField(default=datetime.datetime.now)
+    started = models.DateTimeField(null=True, blank=True)
+    finished = models.DateTimeField(null=True, blank=True)
+    # Updated at every checkpoint; a running job whose heartbeat is old was
+    # interrupted.
+    heartbeat = models.DateTimeField(null=True, blank=True)
+    next_check = models.IntegerField(default=0)
+    error = models.TextField(blank=True)
+
+    def __unicode__(self):
+        return "FsckJob #%d (%s)" % (
+                self.id,
+                self.status,
+            )
+
+
+class FsckFinding(models.Model):
+    job = models.ForeignKey(FsckJob)
+    # The number of the check in hk.fsck.CHECKS
+    check = models.IntegerField()
+    error = models.TextField()
+    # The admin pages to be used to fix the problem, as a JSON list of (text,
+    # model name, object id) triples.
+    links = models.TextField(blank=True)
+    # The data used by the repair function of the check, as a JSON list
+    data = models.TextField(blank=True)
+
+    def __unicode__(self):
+        return "FsckFinding #%d (%s)" % (
+                self.id,
+                self.error,
+            )
+
 
 class HkException(Exception):
     """A very simple exception class used."""
@@ -294,3 +1160,285 @@ class LoopException(Exception):
 
     def __unicode__(self):
         return u'%d messages in loop' % len(self.messages)
+
+
+##### Signal handlers
+
+def messageversion_before_delete(sender, instance, **kwargs):
+    # The versions stored as deltas against the version are stored in full
+    # before it is deleted.
+    for version in MessageVersion.objects.filter(text_base=instance):
+        version.expand()
+
+def messageversion_deleted(sender, instance, **kwargs):
+    # The current_version pointer is set to NULL by the database layer when
+    # the current version is deleted, so the pointer has to be recalculated.
+    try:
+        message = Message.objects.get(pk=instance.message_id)
+    except Message.DoesNotExist:
+        return # The message itself is being deleted
+    if message.current_version_id is not None:
+        # An old version was deleted, which does not change the current state
+        # of the message
+        return
+    old_root_id = message.root_id
+    message.refresh_current_version()
+    update_conversation_stats([old_root_id, message.root_id])
+    message.update_search_index()
+
+def message_deleted(sender, instance, **kwargs):
+    search.index_messages([(instance.id, None)])
+    update_conversation_stats([instance.root_id])
+    ingestcache.invalidate('message', [instance.message_id])
+
+def message_saved(sender, instance, **kwargs):
+    ingestcache.invalidate('message', [instance.message_id])
+
+def get_root_id(message_id):
+    return Message.objects.filter(pk=message_id) \
+               .values_list('root', flat=True)[0]
+
+def messageversion_saved(sender, instance, created, **kwargs):
+    # New versions do not need to be invalidated since they have a new id.
+    if not created:
+        fragmentcache.invalidate_version(instance.id,
+                                         get_root_id(instance.message_id))
+
+def messageversion_labels_changed(sender, instance, action, reverse, pk_set,
+                                  **kwargs):
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if reverse:
+        # The labels of instance (a Label) were changed
+        if pk_set is None:
+            pk_set = instance.messageversion_set.values_list('id', flat=True)
+        versions = MessageVersion.objects.filter(pk__in=pk_set) \
+                       .values_list('id', 'message__root')
+    else:
+        versions = [(instance.id, get_root_id(instance.message_id))]
+    for version_id, root_id in versions:
+        fragmentcache.invalidate_version(version_id, root_id)
+
+def labels_counted(sender, instance, action, reverse, pk_set, **kwargs):
+    # The label counts of the threads of the changed versions or
+    # conversations are recalculated. The objects losing a label by clear()
+    # are found before the change.
+    if sender is MessageVersion.labels.through:
+        root_field = 'message__root'
+    else:
+        root_field = 'root_message'
+    if reverse:
+        if sender is MessageVersion.labels.through:
+            objects = instance.messageversion_set
+        else:
+            objects = instance.conversation_set
+        if action in ('post_add', 'post_remove'):
+            objects = objects.model.objects.filter(pk__in=pk_set)
+        elif action == 'pre_clear':
+            instance._cleared_root_ids = list(
+                objects.values_list(root_field, flat=True))
+            return
+        elif action == 'post_clear':
+            update_label_counts(instance._cleared_root_ids)
+            return
+        else:
+            return
+        update_label_counts(objects.values_list(root_field, flat=True))
+    elif action in ('post_add', 'post_remove', 'post_clear'):
+        if isinstance(instance, MessageVersion):
+            update_label_counts([get_root_id(instance.message_id)])
+        else:
+            update_label_counts([instance.root_message_id])
+
+def attachment_saved(sender, instance, created, **kwargs):
+    if created:
+        Blob.objects.filter(pk=instance.blob_id) \
+            .update(refcount=F('refcount') + 1)
+
+def attachment_deleted(sender, instance, **kwargs):
+    Blob.objects.filter(pk=instance.blob_id) \
+        .update(refcount=F('refcount') - 1)
+
+def object_touched(sender, instance, **kwargs):
+    # Only the changes that the checks read are recorded, e.g. not the subject
+    # of a conversation. `created` is missing when the object is deleted.
+    created = kwargs.get('created', True)
+    if sender is MessageVersion:
+        # The parent is touched too, since its replies changed
+        touch('message', [instance.message_id, instance.parent_id])
+    elif sender is Message:
+        # The other fields of a message are updated without saving it
+        if created:
+            touch('message', [instance.id])
+    elif sender is Conversation:
+        if (created or
+            instance.heap_id != instance._old_heap_id or
+            instance.root_message_id != instance._old_root_id):
+            touch('conversation', [instance.id])
+            touch('message', [instance.root_message_id,
+                              getattr(instance, '_old_root_id', None)])
+    elif sender is Label:
+        if created:
+            touch('label', [instance.pk])
+    elif sender is Heap:
+        if created or instance.visibility != instance._old_visibility:
+            touch('heap', [instance.id])
+    elif sender is UserRight:
+        touch('heap', [instance.heap_id])
+        touch('user', [instance.user_id])
+    elif sender is User:
+        # Only deletions; user_saved touches the saved users
+        touch('user', [instance.id])
+
+def labels_touched(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if reverse:
+        # The labels of instance (a Label) were changed
+        touch('label', [instance.pk])
+        if pk_set is None:
+            return
+        if sender is MessageVersion.labels.through:
+            touch('message', MessageVersion.objects.filter(pk__in=pk_set) \
+                                 .values_list('message', flat=True))
+        else:
+            touch('conversation', pk_set)
+    else:
+        if pk_set is None:
+            pk_set = instance.labels.values_list('pk', flat=True)
+        touch('label', pk_set)
+        if isinstance(instance, MessageVersion):
+            touch('message', [instance.message_id])
+        else:
+            touch('conversation', [instance.id])
+
+def conversation_changed(sender, instance, **kwargs):
+    fragmentcache.invalidate_thread(instance.root_message_id)
+
+def conversation_before_save(sender, instance, **kwargs):
+    # The heap and the root are remembered so that conversation_saved and
+    # object_touched can check whether they changed.
+    instance._old_heap_id = instance._old_root_id = None
+    if instance.id is not None:
+        old = Conversation.objects.filter(pk=instance.id) \
+                  .values_list('heap', 'root_message')
+        if old:
+            instance._old_heap_id, instance._old_root_id = old[0]
+
+def conversation_saved(sender, instance, **kwargs):
+    # Conversation.save writes the statistics fields too, so they are
+    # recalculated.
+    update_conversation_stats([instance.root_message_id])
+    old_heap_id = getattr(instance, '_old_heap_id', None)
+    if old_heap_id is not None and old_heap_id != instance.heap_id:
+        # The cached heaps of the messages of the thread are wrong
+        ingestcache.invalidate(
+            'message',
+            Message.objects.filter(root=instance.root_message_id)
+                .values_list('message_id', flat=True))
+
+def userright_changed(sender, instance, **kwargs):
+    clear_userright_cache()
+    fragmentcache.invalidate_heap(instance.heap_id)
+    # When the UserRight is deleted together with its heap or user, the
+    # EffectiveRight rows are deleted with them too.
+    if (Heap.objects.filter(pk=instance.heap_id).exists() and
+        User.objects.filter(pk=instance.user_id).exists()):
+        update_effective_right(instance.user, instance.heap)
+
+def heap_before_save(sender, instance, **kwargs):
+    # The short name is remembered so that its cache entry can be deleted,
+    # and the visibility so that object_touched can check whether it changed.
+    instance._old_short_name = instance._old_visibility = None
+    if instance.id is not None:
+        old = Heap.objects.filter(pk=instance.id) \
+                  .values_list('short_name', 'visibility')
+        if old:
+            instance._old_short_name, instance._old_visibility = old[0]
+
+def heap_saved(sender, instance, **kwargs):
+    update_effective_rights_of_heap(instance)
+    ingestcache.invalidate('heap', [instance.short_name,
+                                    getattr(instance, '_old_short_name',
+                                            None)])
+
+def heap_deleted(sender, instance, **kwargs):
+    ingestcache.invalidate('heap', [instance.short_name])
+
+def user_initialized(sender, instance, **kwargs):
+    # The superuser status is remembered when the user is loaded (or saved)
+    # so that user_saved can check whether it changed without a query, and
+    # the email address so that its cache entry can be deleted. The username
+    # is remembered because it is shown in the cached messages of the user.
+    instance._was_superuser = instance.is_superuser
+    instance._old_email = instance.email
+    instance._old_username = instance.username
+
+def user_saved(sender, instance, created, **kwargs):
+    # A new user has no EffectiveRight rows unless xe is a superuser: the
+    # rows of the other users are created when they are given a right.
+    # Saving a user whose superuser status did not change (e.g. when
+    # last_login is updated) does not touch the rows either, and fsck does
+    # not need to check the user again (see object_touched).
+    if (instance.is_superuser != instance._was_superuser or
+        created and instance.is_superuser):
+        update_effective_rights_of_user(instance)
+        touch('user', [instance.id])
+    if instance.email != instance._old_email:
+        ingestcache.invalidate('user', [instance.email, instance._old_email])
+    if not created and (instance.is_superuser != instance._was_superuser or
+                        instance.email != instance._old_email or
+                        instance.username != instance._old_username):
+        # The name, the gravatar (which depends on the email address) and the
+        # icon of the author are shown in the cached messages
+        heap_ids = MessageVersion.objects \
+                       .filter(author=instance,
+                               message__root__conversation__isnull=False) \
+                       .values_list('message__root__conversation__heap',
+                                    flat=True) \
+                       .distinct()
+        for heap_id in heap_ids:
+            fragmentcache.invalidate_heap(heap_id)
+    user_initialized(sender, instance)
+
+def user_deleted(sender, instance, **kwargs):
+    ingestcache.invalidate('user', [instance.email])
+
+pre_delete.connect(messageversion_before_delete, sender=MessageVersion)
+post_delete.connect(messageversion_deleted, sender=MessageVersion)
+post_delete.connect(message_deleted, sender=Message)
+post_save.connect(message_saved, sender=Message)
+post_save.connect(messageversion_saved, sender=MessageVersion)
+m2m_changed.connect(messageversion_labels_changed,
+                    sender=MessageVersion.labels.through)
+m2m_changed.connect(labels_counted, sender=MessageVersion.labels.through)
+m2m_changed.connect(labels_counted, sender=Conversation.labels.through)
+post_save.connect(conversation_changed, sender=Conversation)
+pre_save.connect(conversation_before_save, sender=Conversation)
+post_save.connect(conversation_saved, sender=Conversation)
+post_delete.connect(conversation_changed, sender=Conversation)
+post_save.connect(userright_changed, sender=UserRight)
+post_delete.connect(userright_changed, sender=UserRight)
+pre_save.connect(heap_before_save, sender=Heap)
+post_save.connect(heap_saved, sender=Heap)
+post_delete.connect(heap_deleted, sender=Heap)
+post_save.connect(attachment_saved, sender=Attachment)
+post_delete.connect(attachment_deleted, sender=Attachment)
+post_init.connect(user_initialized, sender=User)
+post_save.connect(user_saved, sender=User)
+post_delete.connect(user_deleted, sender=User)
+post_save.connect(object_touched, sender=Message)
+post_delete.connect(object_touched, sender=Message)
+post_save.connect(object_touched, sender=MessageVersion)
+post_delete.connect(object_touched, sender=MessageVersion)
+post_save.connect(object_touched, sender=Conversation)
+post_delete.connect(object_touched, sender=Conversation)
+post_save.connect(object_touched, sender=Label)
+post_delete.connect(object_touched, sender=Label)
+post_save.connect(object_touched, sender=Heap)
+post_delete.connect(object_touched, sender=Heap)
+post_save.connect(object_touched, sender=UserRight)
+post_delete.connect(object_touched, sender=UserRight)
+post_delete.connect(object_touched, sender=User)
+m2m_changed.connect(labels_touched, sender=MessageVersion.labels.through)
+m2m_changed.connect(labels_touched, sender=Conversation.labels.through)
@@ -0,0 +1,172 @@
+# This file is part of Heapkeeper.
+#
+# Heapkeeper is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Heapkeeper is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Heapkeeper.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright (C) 2012 Csaba Hoch
+
+# Pruning the version history of the messages.
+#
+# Every change of a message creates a new version, and the old versions are
+# kept with their labels and attachments. The heaps that have a
+# RetentionPolicy (set on the admin pages) keep only some of them: the
+# versions that the policy does not keep are deleted by "manage.py
+# pruneversions", one batch of messages in a transaction. The remaining old
+# versions are stored as deltas again afterwards (see compress_versions).
+
+import datetime
+from django.db import transaction
+from django.db.models import Count
+from hk.models import *
+
+class PruneStats(object):
+    """The amount of data deleted (or to be deleted) by pruning.
+
+    - `messages` (int) -- The number of messages that lost versions.
+    - `versions` (int) -- The number of versions deleted.
+    - `label_rows` (int) -- The number of labels of the deleted versions.
+    - `attachment_rows` (int) -- The number of attachments of the deleted
+      versions.
+    - `text_bytes` (int) -- The size of the texts of the deleted versions as
+      they are stored (deltas are usually much shorter than the texts).
+    """
+
+    def __init__(self):
+        self.messages = 0
+        self.versions = 0
+        self.label_rows = 0
+        self.attachment_rows = 0
+        self.text_bytes = 0
+
+    def add(self, other):
+        self.messages += other.messages
+        self.versions += other.versions
+        self.label_rows += other.label_rows
+        self.attachment_rows += other.attachment_rows
+        self.text_bytes += other.text_bytes
+
+def select_pruned_versions(versions, texts, current_id, policy, now):
+    """Selects the versions of a message that a retention policy deletes.
+
+    **Arguments:**
+
+    - `versions` ([MessageVersion]) -- The versions of the message in the
+      order of their dates.
+    - `texts` ({int: unicode}) -- The texts of the versions by id.
+    - `current_id` (int) -- The id of the current version.
+    - `policy` (RetentionPolicy)
+    - `now` (datetime)
+
+    **Returns:** [int] -- The ids of the versions to be deleted.
+    """
+
+    count = len(versions)
+    keep = policy.keep_versions
+    if policy.collapse_after_days is not None:
+        cutoff = now - datetime.timedelta(days=policy.collapse_after_days)
+    else:
+        cutoff = None
+    pruned = []
+    for i, version in enumerate(versions):
+        if i == 0 or i == count - 1 or version.id == current_id:
+            continue
+        if keep is not None and i < count - keep:
+            pruned.append(version.id)
+        elif (cutoff is not None and
+              version.version_date < cutoff and
+              texts[versions[i - 1].id] == texts[version.id] and
+              texts[versions[i + 1].id] == texts[version.id]):
+            # Only the last one of the consecutive versions with the same
+            # text is kept
+            pruned.append(version.id)
+    return pruned
+
+def prune_message(message_id, policy, now, dry_run=False):
+    """Deletes the versions of a message that a retention policy does not
+    keep.
+
+    **Arguments:**
+
+    - `message_id` (int)
+    - `policy` (RetentionPolicy)
+    - `now` (datetime)
+    - `dry_run` (bool) -- If true, nothing is deleted.
+
+    **Returns:** PruneStats
+    """
+
+    stats = PruneStats()
+    versions = list(MessageVersion.objects
+                        .filter(message=message_id)
+                        .order_by('version_date', 'id'))
+    current_id = Message.objects.filter(pk=message_id) \
+                     .values_list('current_version', flat=True)[0]
+    pruned = select_pruned_versions(versions, get_version_texts(versions),
+                                    current_id, policy, now)
+    if not pruned:
+        return stats
+    stats.messages = 1
+    stats.versions = len(pruned)
+    stats.text_bytes = sum(len(version.text.encode('utf-8'))
+                           for version in versions if version.id in pruned)
+    stats.label_rows = MessageVersion.labels.through.objects \
+                           .filter(messageversion__in=pruned).count()
+    stats.attachment_rows = Attachment.objects \
+                                .filter(version__in=pruned).count()
+    if not dry_run:
+        # The remaining versions may have been stored as deltas against the
+        # deleted ones; they are expanded when their base is deleted and
+        # compressed again here
+        MessageVersion.objects.filter(pk__in=pruned).delete()
+        compress_versions(message_id)
+    return stats
+
+def get_policy_messages(policy):
+    # Returns the ids of the messages of the heap of the policy that have
+    # old versions other than the first one.
+    return list(MessageVersion.objects
+                    .filter(message__root__conversation__heap=policy.heap_id)
+                    .values('message')
+                    .annotate(versions=Count('id'))
+                    .filter(versions__gt=2)
+                    .order_by('message')
+                    .values_list('message', flat=True))
+
+def prune(heap=None, dry_run=False, batch_size=100, now=None):
+    """Applies the retention policies.
+
+    **Arguments:**
+
+    - `heap` (Heap | None) -- If given, only the messages of this heap are
+      pruned.
+    - `dry_run` (bool) -- If true, only the statistics are calculated.
+    - `batch_size` (int) -- The number of messages pruned in one
+      transaction.
+    - `now` (datetime | None) -- The time compared with the version dates.
+
+    **Returns:** PruneStats
+    """
+
+    if now is None:
+        now = datetime.datetime.now()
+    policies = RetentionPolicy.objects.order_by('heap')
+    if heap is not None:
+        policies = policies.filter(heap=heap)
+    stats = PruneStats()
+    for policy in policies:
+        message_ids = get_policy_messages(policy)
+        for i in range(0, len(message_ids), batch_size):
+            with transaction.commit_on_success():
+                for message_id in message_ids[i:i + batch_size]:
+                    stats.add(prune_message(message_id, policy, now,
+                                            dry_run))
+    return stats
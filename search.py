@@ -0,0 +1,286 @@
+# This file is part of Heapkeeper.
+#
+# Heapkeeper is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Heapkeeper is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Heapkeeper.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright (C) 2012 Csaba Hoch
+
+# Full-text search over the text of messages.
+#
+# Only the current versions of the non-deleted messages are indexed, by message
+# id. The index is updated by Message.version_saved whenever a version is
+# written, so it is in the same transaction as the version.
+#
+# Two backends are provided:
+#
+# - FTS5Backend uses an FTS5 virtual table of SQLite, which is created by
+#   syncdb (see hk.management) and by "manage.py reindexsearch". It is not
+#   created when it is first used, because SQLite commits the transaction
+#   that is open when a table is created.
+# - InvertedIndexBackend stores (term, message, count) rows in the
+#   hk_searchposting table (the SearchPosting model), so it works with any
+#   database.
+#
+# The backend is chosen by the HK_SEARCH_BACKEND setting (the dotted path of a
+# class); by default FTS5Backend is used if the database is SQLite and supports
+# FTS5.
+#
+# The backends use SQL directly, because this module is imported by
+# hk.models.
+
+import math
+import re
+from django.conf import settings
+from django.db import connection
+from django.utils.importlib import import_module
+
+# Longer words are truncated
+MAX_TERM_LENGTH = 64
+
+# The maximum number of ids put into one "IN (...)" clause (see
+# hk.threads.MAX_IDS_PER_QUERY).
+MAX_IDS_PER_QUERY = 500
+
+def get_terms(text):
+    """Splits a text into lower case words.
+
+    **Argument:**
+
+    - `text` (unicode)
+
+    **Returns:** [unicode]
+    """
+
+    return [term[:MAX_TERM_LENGTH]
+            for term in re.findall(r'\w+', text.lower(), re.UNICODE)]
+
+def placeholders(l):
+    return ', '.join(['%s'] * len(l))
+
+def chunks(l, size=MAX_IDS_PER_QUERY):
+    for i in range(0, len(l), size):
+        yield l[i:i + size]
+
+def quote(name):
+    return connection.ops.quote_name(name)
+
+# Selects the messages that are in a conversation of the given heaps. The
+# message id is expected in the "message_id" column of a table called "s".
+HEAP_FILTER = """
+    JOIN %(message)s m ON m.id = s.message_id
+    JOIN %(conversation)s c ON c.root_message_id = m.root_id
+    WHERE c.heap_id IN (%%(heaps)s)
+""" % {'message': quote('hk_message'),
+       'conversation': quote('hk_conversation')}
+
+
+##### Backends
+
+class SearchBackend(object):
+    """Base class of the search backends."""
+
+    def setup(self):
+        """Creates the tables of the backend if they do not exist."""
+
+        pass
+
+    def index(self, messages):
+        """Adds messages to the index, replacing their earlier text.
+
+        **Argument:**
+
+        - `messages` ([(int, unicode)]) -- Message ids and texts.
+        """
+
+        raise NotImplementedError
+
+    def remove(self, message_ids):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def search(self, query, heap_ids, offset, limit):
+        """Searches for the messages that contain all words of the query.
+
+        **Arguments:**
+
+        - `query` (unicode)
+        - `heap_ids` ([int]) -- Only the messages in these heaps are returned.
+        - `offset` (int), `limit` (int) -- The part of the result list to be
+          returned.
+
+        **Returns:** [int] -- Message ids, the most relevant first.
+        """
+
+        raise NotImplementedError
+
+
+class FTS5Backend(SearchBackend):
+
+    table = quote('hk_search')
+
+    @classmethod
+    def is_available(cls):
+        if settings.DATABASES['default']['ENGINE'] != \
+               'django.db.backends.sqlite3':
+            return False
+        cursor = connection.cursor()
+        cursor.execute("SELECT sqlite_compileoption_used('ENABLE_FTS5')")
+        return bool(cursor.fetchone()[0])
+
+    def setup(self):
+        connection.cursor().execute(
+            'CREATE VIRTUAL TABLE IF NOT EXISTS %s USING fts5(text)'
+            % self.table)
+
+    def index(self, messages):
+        self.remove([message_id for message_id, text in messages])
+        connection.cursor().executemany(
+            'INSERT INTO %s (rowid, text) VALUES (%%s, %%s)' % self.table,
+            messages)
+
+    def remove(self, message_ids):
+        for ids in chunks(message_ids):
+            connection.cursor().execute(
+                'DELETE FROM %s WHERE rowid IN (%s)'
+                % (self.table, placeholders(ids)),
+                ids)
+
+    def clear(self):
+        connection.cursor().execute('DELETE FROM %s' % self.table)
+
+    def search(self, query, heap_ids, offset, limit):
+        terms = get_terms(query)
+        if not terms or not heap_ids:
+            return []
+        # Each term is quoted, so the user cannot use the query syntax of
+        # FTS5; the terms are joined by an implicit AND.
+        match = ' '.join('"%s"' % term for term in terms)
+        sql = ('SELECT s.message_id FROM '
+               '(SELECT rowid AS message_id, bm25(%(table)s) AS score '
+               ' FROM %(table)s WHERE %(table)s MATCH %%s) s '
+               + HEAP_FILTER +
+               'ORDER BY s.score, s.message_id DESC LIMIT %%s OFFSET %%s') % \
+              {'table': self.table, 'heaps': placeholders(heap_ids)}
+        cursor = connection.cursor()
+        cursor.execute(sql, [match] + list(heap_ids) + [limit, offset])
+        return [row[0] for row in cursor.fetchall()]
+
+
+class InvertedIndexBackend(SearchBackend):
+
+    table = quote('hk_searchposting')
+
+    def index(self, messages):
+        self.remove([message_id for message_id, text in messages])
+        postings = []
+        for message_id, text in messages:
+            counts = {}
+            for term in get_terms(text):
+                counts[term] = counts.get(term, 0) + 1
+            postings.extend((term, message_id, count)
+                            for term, count in counts.iteritems())
+        connection.cursor().executemany(
+            'INSERT INTO %s (term, message_id, count) VALUES (%%s, %%s, %%s)'
+            % self.table,
+            postings)
+
+    def remove(self, message_ids):
+        for ids in chunks(message_ids):
+            connection.cursor().execute(
+                'DELETE FROM %s WHERE message_id IN (%s)'
+                % (self.table, placeholders(ids)),
+                ids)
+
+    def clear(self):
+        connection.cursor().execute('DELETE FROM %s' % self.table)
+
+    def search(self, query, heap_ids, offset, limit):
+        terms = list(set(get_terms(query)))
+        if not terms or not heap_ids:
+            return []
+
+        # The messages are ranked by tf-idf: rare terms weigh more.
+        cursor = connection.cursor()
+        # The highest message id is used as the number of messages; counting
+        # them would be slower.
+        cursor.execute('SELECT MAX(message_id) FROM %s' % self.table)
+        total = cursor.fetchone()[0] or 1
+        cursor.execute('SELECT term, COUNT(*) FROM %s WHERE term IN (%s) '
+                       'GROUP BY term' % (self.table, placeholders(terms)),
+                       terms)
+        weights = dict((term, math.log(float(total) / count) + 1)
+                       for term, count in cursor.fetchall())
+        if len(weights) < len(terms):
+            return [] # A term does not occur anywhere
+
+        weight_sql = 'CASE term %s END' % \
+                     ' '.join(['WHEN %s THEN %s'] * len(terms))
+        weight_params = []
+        for term in terms:
+            weight_params.extend([term, weights[term]])
+        sql = ('SELECT s.message_id FROM '
+               '(SELECT message_id, SUM(count * %(weight)s) AS score '
+               ' FROM %(table)s WHERE term IN (%(terms)s) '
+               ' GROUP BY message_id HAVING COUNT(*) = %%s) s '
+               + HEAP_FILTER +
+               'ORDER BY s.score DESC, s.message_id DESC '
+               'LIMIT %%s OFFSET %%s') % \
+              {'table': self.table,
+               'weight': weight_sql,
+               'terms': placeholders(terms),
+               'heaps': placeholders(heap_ids)}
+        cursor.execute(sql,
+                       weight_params + terms + [len(terms)] + list(heap_ids) +
+                       [limit, offset])
+        return [row[0] for row in cursor.fetchall()]
+
+
+_backend = None
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        path = getattr(settings, 'HK_SEARCH_BACKEND', None)
+        if path is not None:
+            module_name, class_name = path.rsplit('.', 1)
+            backend_class = getattr(import_module(module_name), class_name)
+        elif FTS5Backend.is_available():
+            backend_class = FTS5Backend
+        else:
+            backend_class = InvertedIndexBackend
+        _backend = backend_class()
+    return _backend
+
+
+##### Index maintenance
+
+def index_messages(messages):
+    """Updates the index of messages.
+
+    **Argument:**
+
+    - `messages` ([(int, unicode | None)]) -- Message ids and the text of their
+      current version; ``None`` if the message should not be found (e.g. it is
+      deleted).
+    """
+
+    backend = get_backend()
+    backend.remove([message_id for message_id, text in messages
+                    if text is None])
+    backend.index([(message_id, text) for message_id, text in messages
+                   if text is not None])
+
+def find_messages(query, heap_ids, offset, limit):
+    # See SearchBackend.search.
+    return get_backend().search(query, heap_ids, offset, limit)
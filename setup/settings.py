@@ -71,6 +71,7 @@ MIDDLEWARE_CLASSES = (
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
+    'hk.middleware.UserRightCacheMiddleware',
 )
 
 ROOT_URLCONF = 'Heapkeeper.urls'
@@ -89,3 +90,92 @@ INSTALLED_APPS = (
 
 LOGIN_URL = '/login/'
 LOGIN_REDIRECT_URL = '/'
+
+# Cache of rendered conversations (see hk/fragmentcache.py). By default an
+# in-process LRU cache is used; to use another Django cache backend, define it
+# in CACHES and put its name here:
+#
+# CACHES = {
+#     'default': {
+#         'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+#     },
+#     'fragments': {
+#         'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+#         'LOCATION': os.path.join(PROJECT_DIR, 'fragment_cache'),
+#     },
+# }
+# HK_FRAGMENT_CACHE = 'fragments'
+
+# Conversations with more messages than this are sent to the browser while
+# they are rendered (None turns it off). Streaming does not work with
+# middlewares that need the whole content, such as USE_ETAGS or GZipMiddleware.
+# HK_STREAM_THRESHOLD = 500
+
+# The first HK_THREAD_MAX_DEPTH levels and at most HK_THREAD_MAX_NODES
+# messages of a conversation are displayed; the rest is replaced by links that
+# load the replies on demand (None turns a limit off).
+# HK_THREAD_MAX_DEPTH = 30
+# HK_THREAD_MAX_NODES = 1000
+
+# Number of conversations on one page of a heap.
+# HK_HEAP_PAGE_SIZE = 50
+
+# The old versions of the messages are stored as deltas against the next
+# version, except every HK_VERSION_SNAPSHOT_INTERVAL-th version, which is
+# stored in full. Reading an old version applies at most this many deltas.
+# HK_VERSION_SNAPSHOT_INTERVAL = 10
+
+# The full-text search backend (the dotted path of a class in hk.search). By
+# default the FTS5 extension of SQLite is used if it is available, and
+# 'hk.search.InvertedIndexBackend' otherwise.
+# HK_SEARCH_BACKEND = 'hk.search.InvertedIndexBackend'
+
+# Number of search results on one page.
+# HK_SEARCH_PAGE_SIZE = 20
+
+# Database integrity checks (fsck) are run by a thread of the web server
+# process. Set HK_FSCK_IN_PROCESS to False if they are run by an external
+# worker instead ("manage.py fsck --worker", e.g. from cron). A running check
+# that has not finished a test for HK_FSCK_STALE_AFTER seconds is considered
+# interrupted and can be resumed.
+# HK_FSCK_IN_PROCESS = True
+# HK_FSCK_STALE_AFTER = 3600
+
+# The SMTP service ("manage.py smtpserver") listens on HK_SMTP_PORT. The
+# received mails are written into a spool directory, from which
+# HK_SMTP_WORKERS threads store them into the database, at most
+# HK_SMTP_BATCH_SIZE mails in one transaction. A mail that cannot be stored is
+# tried again later, and it is moved into the "spool/failed" directory after
+# HK_SMTP_MAX_ATTEMPTS attempts. The spool is in HK_SMTP_DIR (by default a
+# directory in the temporary directory of the system, which should be changed
+# so that the spooled mails survive a reboot), and the service and the web
+# interface communicate through files in it as well. Mails larger than
+# HK_SMTP_MAX_MESSAGE_SIZE bytes are refused (with "552"), since the service
+# keeps a mail in memory while it is received.
+# HK_SMTP_PORT = 25
+# HK_SMTP_WORKERS = 4
+# HK_SMTP_BATCH_SIZE = 100
+# HK_SMTP_MAX_ATTEMPTS = 10
+# HK_SMTP_DIR = os.path.join(PROJECT_DIR, 'smtp')
+# HK_SMTP_MAX_MESSAGE_SIZE = 32 * 1024 * 1024
+
+# The text of a received mail is cut after HK_MAIL_MAX_TEXT_SIZE bytes (the
+# whole text is kept as an attachment). Attachments are stored as files in
+# HK_ATTACHMENT_DIR (by default a directory in the temporary directory of the
+# system, which should be changed as well).
+# HK_MAIL_MAX_TEXT_SIZE = 1048576
+# HK_ATTACHMENT_DIR = os.path.join(PROJECT_DIR, 'attachments')
+#
+# Files of the attachment store without references are removed by "manage.py
+# gcattachments" if they were not modified in the last
+# HK_ATTACHMENT_GRACE_PERIOD seconds. Attachments are sent by the web server
+# if HK_ATTACHMENT_SENDFILE is set (see hk/attachments.py and
+# hk/setup/nginx.conf).
+# HK_ATTACHMENT_GRACE_PERIOD = 3600
+# HK_ATTACHMENT_SENDFILE = 'X-Accel-Redirect'
+# HK_ATTACHMENT_SENDFILE_URL = '/hk-attachments/'
+
+# The heaps, users and messages looked up while mails are stored are cached in
+# the HK_INGEST_CACHE Django cache (see hk/ingestcache.py); by default an
+# in-process cache is used, whose entries expire after a minute.
+# HK_INGEST_CACHE = 'memcached://127.0.0.1:11211/'
@@ -0,0 +1,11 @@
+-- The users are looked up by their email addresses when mails are received
+-- (see hk.emaillistener.get_author). django.contrib.auth does not index that
+-- column, so the index is created together with the Heap table.
+CREATE INDEX hk_auth_user_email ON auth_user (email);
+
+-- The conversations of a heap are listed by last activity (see
+-- hk.views.get_conversation_page). The index cannot be declared in the model,
+-- because Django 1.3 has no multi-column indexes; the table is created before
+-- the custom SQL of the models is run.
+CREATE INDEX hk_conversation_heap_activity
+    ON hk_conversation (heap_id, last_activity, id);
@@ -21,3 +21,14 @@ Another way to test that 1 + 1 is equal to 2.
 True
 """}
 
+# The unit tests are in the modules of this package.
+
+from hk.tests.test_attachments import *
+from hk.tests.test_fsck import *
+from hk.tests.test_ingest import *
+from hk.tests.test_labels import *
+from hk.tests.test_messages import *
+from hk.tests.test_mime import *
+from hk.tests.test_spool import *
+from hk.tests.test_threading import *
+from hk.tests.test_versions import *
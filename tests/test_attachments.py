@@ -0,0 +1,41 @@
+# This file is part of Heapkeeper.
+#
+# Heapkeeper is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Heapkeeper is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Heapkeeper.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright (C) 2012 Csaba Hoch
+
+# Tests of serving attachments (hk.attachments).
+
+from django.utils import unittest
+from hk.attachments import parse_range
+
+
+class ParseRangeTest(unittest.TestCase):
+
+    def test_ranges(self):
+        self.assertEqual(parse_range('bytes=0-9', 100), (0, 9))
+        self.assertEqual(parse_range(' bytes=10- ', 100), (10, 99))
+        self.assertEqual(parse_range('bytes=90-200', 100), (90, 99))
+        self.assertEqual(parse_range('bytes=-10', 100), (90, 99))
+        self.assertEqual(parse_range('bytes=-200', 100), (0, 99))
+
+    def test_ignored(self):
+        # The whole file is sent
+        for header in ('bytes=-', 'bytes=0-1,5-6', 'lines=0-1', 'bytes=5-4',
+                       'garbage'):
+            self.assertEqual(parse_range(header, 100), None)
+
+    def test_not_satisfiable(self):
+        for header, size in (('bytes=100-', 100), ('bytes=-0', 100),
+                             ('bytes=-5', 0), ('bytes=0-0', 0)):
+            self.assertRaises(ValueError, parse_range, header, size)
@@ -0,0 +1,190 @@
+# This file is part of Heapkeeper.
+#
+# Heapkeeper is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Heapkeeper is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Heapkeeper.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright (C) 2012 Csaba Hoch
+
+# Tests of the database integrity check (hk.fsck).
+
+import datetime
+from django.contrib.auth.models import User
+from django.test import TestCase
+from hk import fsck
+from hk.models import *
+
+
+class FsckTestCase(TestCase):
+
+    def setUp(self):
+        self.admin = User.objects.create_user('admin', 'admin@example.org',
+                                              'password')
+        self.heap = Heap(short_name='h', long_name='Heap', visibility=0)
+        self.heap.save()
+        UserRight(heap=self.heap, user=self.admin, right=3).save()
+        self.now = datetime.datetime.now()
+
+    def add_message(self, parent=None):
+        msg = Message()
+        msg.save()
+        MessageVersion(message=msg, author=self.admin, parent=parent,
+                       creation_date=self.now, version_date=self.now,
+                       text=u'text').save()
+        if parent is None:
+            Conversation(heap=self.heap, subject='subject',
+                         root_message=msg).save()
+        return Message.objects.get(pk=msg.id)
+
+    def set_parent(self, msg, parent):
+        # Changes the parent without maintaining the other objects, like a
+        # bug would.
+        MessageVersion.objects.filter(pk=msg.current_version_id) \
+            .update(parent=parent)
+
+    def run_job(self):
+        # Returns the (check number, error) pairs found by a full job.
+        job = fsck.create_job()
+        fsck.claim_job(job.id)
+        fsck.run_job(job.id)
+        return [(finding.check, finding.error)
+                for finding in FsckFinding.objects.filter(job=job)
+                                   .order_by('id')]
+
+
+class FsckCheckTest(FsckTestCase):
+
+    def test_clean(self):
+        root = self.add_message()
+        self.add_message(self.add_message(root))
+        Message.objects.get(pk=root.id).change(text=u'changed')
+        self.assertEqual(self.run_job(), [])
+
+    def test_loop(self):
+        root = self.add_message()
+        child = self.add_message(root)
+        other = self.add_message()
+        self.set_parent(root, child)
+        findings = self.run_job()
+        loops = [error for check, error in findings if check == 3]
+        self.assertEqual(loops,
+                         ['Message #%d is in a parent loop!' % root.id,
+                          'Message #%d is in a parent loop!' % child.id])
+        self.assertIn((5, 'Conversation #%d has root message (#%d) that has '
+                          'a parent!'
+                          % (Conversation.objects.get(root_message=root).id,
+                             root.id)),
+                      findings)
+        self.assertFalse([error for check, error in findings
+                          if str(other.id) in error])
+
+    def test_deleted_parent(self):
+        root = self.add_message()
+        child = self.add_message(root)
+        Message.objects.get(pk=root.id).mark_deleted()
+        self.assertEqual(self.run_job(),
+                         [(2, 'Deleted message #%d is parent of message #%d!'
+                              % (root.id, child.id)),
+                          (4, 'Deleted message #%d is the root of a '
+                              'conversation!' % root.id)])
+
+    def test_denormalized_state(self):
+        root = self.add_message()
+        child = self.add_message(root)
+        Message.objects.filter(pk=child.id).update(path='/%d/' % child.id)
+        conv = Conversation.objects.get(root_message=root)
+        Conversation.objects.filter(pk=conv.id).update(message_count=7)
+        Label(text='unused').save()
+        self.assertEqual(
+            self.run_job(),
+            [(6, "Label 'unused' is unused!"),
+             (9, 'Message #%d has wrong root or path! (Run "manage.py '
+                 'updatepaths" to fix it.)' % child.id),
+             (11, 'Conversation #%d has wrong statistics! (Run "manage.py '
+                  'updateconversationstats" to fix it.)' % conv.id)])
+
+    def test_find_loops(self):
+        root = self.add_message()
+        child = self.add_message(root)
+        grandchild = self.add_message(child)
+        self.set_parent(child, grandchild)
+        self.assertEqual(fsck.MessageGraph().find_loops(),
+                         [child.id, grandchild.id])
+
+
+class FsckRepairTest(FsckTestCase):
+
+    def repair(self, heap=None, admin=None):
+        # Repairs the problems found by a full job; returns the descriptions
+        # of the fixes.
+        job = fsck.create_job()
+        fsck.claim_job(job.id)
+        fsck.run_job(job.id)
+        findings = FsckFinding.objects.filter(job=job).order_by('id')
+        fixes, unrepairable = fsck.plan_repairs(
+                                  findings, fsck.RepairContext(heap, admin))
+        self.assertEqual(unrepairable, [])
+        fsck.repair(fixes, batch_size=2)
+        return [description for description, fix in fixes]
+
+    def test_round_trip(self):
+        root = self.add_message()
+        child = self.add_message(root)
+        self.set_parent(root, child)
+        deleted = self.add_message()
+        reply = self.add_message(deleted)
+        Message.objects.get(pk=deleted.id).mark_deleted()
+        conv = Conversation.objects.get(root_message=root)
+        Conversation.objects.filter(pk=conv.id).update(message_count=7)
+        Label(text='unused').save()
+        self.repair(self.heap)
+        self.assertEqual(self.run_job(), [])
+        self.assertEqual(Conversation.objects.get(root_message=root).id,
+                         conv.id)
+        self.assertEqual(Message.objects.get(pk=child.id).path,
+                         '/%d/%d/' % (root.id, child.id))
+        self.assertTrue(Conversation.objects.filter(root_message=reply)
+                            .exists())
+        self.assertFalse(Conversation.objects.filter(root_message=deleted)
+                             .exists())
+        self.assertFalse(Label.objects.filter(text='unused').exists())
+
+    def test_loop_without_conversation(self):
+        root = self.add_message()
+        child = self.add_message(root)
+        self.set_parent(root, child)
+        Conversation.objects.filter(root_message=root).delete()
+        self.assertEqual(self.repair(self.heap)[:3],
+                         ['~ Message #%d: parent #%d -> none'
+                          % (root.id, child.id),
+                          "+ Conversation of message #%d in heap 'h'"
+                          % root.id,
+                          '~ Root and path of the messages of the loop'])
+        self.assertEqual(self.run_job(), [])
+
+    def test_heap_admin(self):
+        heap = Heap(short_name='h2', long_name='Heap 2', visibility=0)
+        heap.save()
+        self.repair(admin=self.admin)
+        self.assertEqual(self.run_job(), [])
+        self.assertTrue(UserRight.objects.filter(heap=heap, user=self.admin,
+                                                 right=3).exists())
+
+    def test_dry_run(self):
+        # Planning the repairs does not change anything
+        root = self.add_message()
+        child = self.add_message(root)
+        self.set_parent(root, child)
+        findings = self.run_job()
+        job = FsckJob.objects.order_by('-id')[0]
+        fsck.plan_repairs(job.fsckfinding_set.all(),
+                          fsck.RepairContext(self.heap))
+        self.assertEqual(self.run_job(), findings)
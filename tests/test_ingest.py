@@ -0,0 +1,56 @@
+# This file is part of Heapkeeper.
+#
+# Heapkeeper is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Heapkeeper is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Heapkeeper.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright (C) 2012 Csaba Hoch
+
+# Tests of the lookups of received mails (hk.emaillistener, hk.ingestcache).
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import TestCase
+from hk import ingestcache
+from hk.emaillistener import get_author, get_heaps, look_up_messages
+from hk.models import *
+
+
+class IngestLookupTest(TestCase):
+
+    def setUp(self):
+        ingestcache.get_ingest_cache().clear()
+
+    def test_missing_objects_not_cached(self):
+        self.assertEqual(get_heaps(['h']), {'h': None})
+        self.assertEqual(get_author('User <user@example.org>'), None)
+        self.assertEqual(look_up_messages(['<1@x>']), {'<1@x>': ()})
+        # Created by another process, whose changes do not reach the cache
+        cursor = connection.cursor()
+        cursor.execute("INSERT INTO hk_heap (short_name, long_name, "
+                       "visibility) VALUES ('h', 'Heap', 0)")
+        cursor.execute("INSERT INTO auth_user (username, first_name, "
+                       "last_name, email, password, is_staff, is_active, "
+                       "is_superuser, last_login, date_joined) VALUES "
+                       "('user', '', '', 'user@example.org', '', 0, 1, 0, "
+                       "'2012-01-01', '2012-01-01')")
+        cursor.execute("INSERT INTO hk_message (message_id, path) "
+                       "VALUES ('<1@x>', '')")
+        self.assertEqual(get_heaps(['h'])['h'].short_name, 'h')
+        self.assertEqual(get_author('User <user@example.org>').username,
+                         'user')
+        self.assertEqual(len(look_up_messages(['<1@x>'])['<1@x>']), 1)
+
+    def test_found_objects_cached(self):
+        Heap(short_name='h', long_name='Heap', visibility=0).save()
+        get_heaps(['h'])
+        self.assertEqual(ingestcache.get_entries('heap', ['h'])['h']
+                             .short_name, 'h')
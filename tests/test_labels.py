@@ -0,0 +1,54 @@
+# This file is part of Heapkeeper.
+#
+# Heapkeeper is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Heapkeeper is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Heapkeeper.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright (C) 2012 Csaba Hoch
+
+# Tests of the label expressions (hk.labels).
+
+from django.utils import unittest
+from hk.labels import LabelExpressionError, parse_label_expression
+
+
+class LabelExpressionTest(unittest.TestCase):
+
+    def test_label(self):
+        self.assertEqual(parse_label_expression(u'bug'), ('label', u'bug'))
+        self.assertEqual(parse_label_expression(u' "needs review" '),
+                         ('label', u'needs review'))
+        self.assertEqual(parse_label_expression(u'"or"'), ('label', u'or'))
+
+    def test_operators(self):
+        self.assertEqual(
+            parse_label_expression(u'a or b and not c'),
+            ('or', [('label', u'a'),
+                    ('and', [('label', u'b'), ('not', ('label', u'c'))])]))
+        self.assertEqual(
+            parse_label_expression(u'(a OR b) c'),
+            ('and', [('or', [('label', u'a'), ('label', u'b')]),
+                     ('label', u'c')]))
+        self.assertEqual(
+            parse_label_expression(u'not not a'),
+            ('not', ('not', ('label', u'a'))))
+
+    def test_implicit_and(self):
+        self.assertEqual(parse_label_expression(u'a b'),
+                         parse_label_expression(u'a and b'))
+        self.assertEqual(parse_label_expression(u'a not b'),
+                         ('and', [('label', u'a'), ('not', ('label', u'b'))]))
+
+    def test_errors(self):
+        for text in (u'', u'  ', u'a and', u'(a', u'a)', u'or a', u'"a',
+                     u'not', u'()'):
+            self.assertRaises(LabelExpressionError,
+                              parse_label_expression, text)
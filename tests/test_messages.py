@@ -0,0 +1,162 @@
+# This file is part of Heapkeeper.
+#
+# Heapkeeper is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Heapkeeper is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Heapkeeper.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright (C) 2012 Csaba Hoch
+
+# Tests of the denormalized state of messages: the current version pointer,
+# and the root and path of the messages.
+
+import datetime
+from django.contrib.auth.models import User
+from django.test import TestCase
+from django.utils import unittest
+from hk.models import *
+
+
+class MessageTestCase(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user('user', 'user@example.org',
+                                             'password')
+        self.heap = Heap(short_name='h', long_name='Heap', visibility=0)
+        self.heap.save()
+        self.now = datetime.datetime.now()
+
+    def add_message(self, parent=None, text=u'text'):
+        msg = Message()
+        msg.save()
+        MessageVersion(message=msg, author=self.user, parent=parent,
+                       creation_date=self.now, version_date=self.now,
+                       text=text).save()
+        if parent is None:
+            Conversation(heap=self.heap, subject='subject',
+                         root_message=msg).save()
+        return Message.objects.get(pk=msg.id)
+
+
+class CurrentVersionTest(MessageTestCase):
+
+    def add_version(self, msg, version_date, text):
+        version = MessageVersion(message=msg, author=self.user,
+                                 creation_date=self.now,
+                                 version_date=version_date, text=text)
+        version.save()
+        return version
+
+    def get_current_text(self, msg):
+        return Message.objects.get(pk=msg.id).current_version.text
+
+    def test_new_version(self):
+        msg = self.add_message()
+        self.assertEqual(msg.current_version.text, u'text')
+        msg.change(text=u'changed')
+        self.assertEqual(self.get_current_text(msg), u'changed')
+        self.assertEqual(Message.objects.get(pk=msg.id).latest_version(),
+                         msg.find_latest_version())
+
+    def test_old_version(self):
+        # A version saved later but dated earlier does not become current
+        msg = self.add_message()
+        self.add_version(msg, self.now - datetime.timedelta(days=1), u'old')
+        self.assertEqual(self.get_current_text(msg), u'text')
+
+    def test_delete_current_version(self):
+        msg = self.add_message()
+        version = self.add_version(msg, self.now + datetime.timedelta(days=1),
+                                   u'new')
+        self.assertEqual(self.get_current_text(msg), u'new')
+        version.delete()
+        self.assertEqual(self.get_current_text(msg), u'text')
+
+    def test_missing_pointer(self):
+        # Messages that have not been backfilled fall back to a query
+        msg = self.add_message()
+        Message.objects.filter(pk=msg.id).update(current_version=None)
+        msg = Message.objects.get(pk=msg.id)
+        self.assertEqual(msg.latest_version().text, u'text')
+
+
+class AncestryTest(MessageTestCase):
+
+    def get_ancestry(self, msg):
+        msg = Message.objects.get(pk=msg.id)
+        return msg.root_id, msg.path
+
+    def test_new_messages(self):
+        root = self.add_message()
+        child = self.add_message(root)
+        grandchild = self.add_message(child)
+        self.assertEqual(self.get_ancestry(root),
+                         (root.id, '/%d/' % root.id))
+        self.assertEqual(self.get_ancestry(grandchild),
+                         (root.id, '/%d/%d/%d/' %
+                                   (root.id, child.id, grandchild.id)))
+        self.assertEqual(grandchild.get_root_message(), root)
+        self.assertEqual(grandchild.get_conversation().root_message_id,
+                         root.id)
+        self.assertTrue(child.is_ancestor_of(grandchild))
+        self.assertFalse(grandchild.is_ancestor_of(child))
+
+    def test_move_subtree(self):
+        root1 = self.add_message()
+        child = self.add_message(root1)
+        grandchild = self.add_message(child)
+        root2 = self.add_message()
+        Message.objects.get(pk=child.id).change(parent=root2)
+        self.assertEqual(self.get_ancestry(child),
+                         (root2.id, '/%d/%d/' % (root2.id, child.id)))
+        self.assertEqual(self.get_ancestry(grandchild),
+                         (root2.id, '/%d/%d/%d/' %
+                                    (root2.id, child.id, grandchild.id)))
+        self.assertEqual(self.get_ancestry(root1),
+                         (root1.id, '/%d/' % root1.id))
+        self.assertEqual(Conversation.objects.get(root_message=root1)
+                             .message_count, 1)
+        self.assertEqual(Conversation.objects.get(root_message=root2)
+                             .message_count, 3)
+
+    def test_detach_subtree(self):
+        root = self.add_message()
+        child = self.add_message(root)
+        grandchild = self.add_message(child)
+        Message.objects.get(pk=child.id).change(parent=None)
+        self.assertEqual(self.get_ancestry(grandchild),
+                         (child.id, '/%d/%d/' % (child.id, grandchild.id)))
+
+    def test_parent_loop(self):
+        # A message that would become its own ancestor is not moved
+        root = self.add_message()
+        child = self.add_message(root)
+        Message.objects.get(pk=root.id).change(parent=child)
+        self.assertEqual(self.get_ancestry(root),
+                         (root.id, '/%d/' % root.id))
+        self.assertEqual(self.get_ancestry(child),
+                         (root.id, '/%d/%d/' % (root.id, child.id)))
+
+
+class ComputeAncestryTest(unittest.TestCase):
+
+    def test_trees(self):
+        parents = {1: None, 2: 1, 3: 2, 4: 1, 5: None}
+        self.assertEqual(compute_ancestry(parents),
+                         {1: (1, '/1/'),
+                          2: (1, '/1/2/'),
+                          3: (1, '/1/2/3/'),
+                          4: (1, '/1/4/'),
+                          5: (5, '/5/')})
+
+    def test_loops(self):
+        # The messages in and below a parent loop are left out
+        parents = {1: None, 2: 3, 3: 2, 4: 3, 5: 4}
+        self.assertEqual(compute_ancestry(parents), {1: (1, '/1/')})
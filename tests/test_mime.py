@@ -0,0 +1,97 @@
+# This file is part of Heapkeeper.
+#
+# Heapkeeper is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Heapkeeper is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Heapkeeper.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright (C) 2012 Csaba Hoch
+
+# Tests of the streaming MIME parser (hk.mime).
+
+import shutil
+import tempfile
+from django.conf import settings
+from django.utils import unittest
+from hk.attachments import get_blob_path
+from hk.mime import parse_mail
+
+
+class MimeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.attachment_dir = tempfile.mkdtemp()
+        self.old_attachment_dir = getattr(settings, 'HK_ATTACHMENT_DIR', None)
+        settings.HK_ATTACHMENT_DIR = self.attachment_dir
+
+    def tearDown(self):
+        if self.old_attachment_dir is None:
+            del settings.HK_ATTACHMENT_DIR
+        else:
+            settings.HK_ATTACHMENT_DIR = self.old_attachment_dir
+        shutil.rmtree(self.attachment_dir)
+
+    def test_plain(self):
+        subject, message_id, in_reply_to, text, references, attachments = \
+            parse_mail('From: user@example.org\r\n'
+                       'Subject: =?utf-8?q?h=C3=A9llo?=\r\n'
+                       'Message-ID: <m2@example.org>\r\n'
+                       'In-Reply-To: <m1@example.org>\r\n'
+                       'References: <m0@example.org> <m1@example.org>\r\n'
+                       '\r\n'
+                       'line 1\r\n'
+                       'line 2\r\n')
+        self.assertEqual(subject, 'h\xc3\xa9llo')
+        self.assertEqual(message_id, '<m2@example.org>')
+        self.assertEqual(in_reply_to, '<m1@example.org>')
+        self.assertEqual(text, 'line 1\nline 2\n')
+        self.assertEqual(references, ['<m0@example.org>', '<m1@example.org>'])
+        self.assertEqual(attachments, [])
+
+    def test_multipart(self):
+        fields = parse_mail(
+            'Subject: parts\n'
+            'MIME-Version: 1.0\n'
+            'Content-Type: multipart/mixed; boundary="OUT"\n'
+            '\n'
+            'preamble\n'
+            '--OUT\n'
+            'Content-Type: multipart/alternative; boundary="ALT"\n'
+            '\n'
+            '--ALT\n'
+            'Content-Type: text/html; charset=utf-8\n'
+            '\n'
+            '<p>html</p>\n'
+            '--ALT\n'
+            'Content-Type: text/plain; charset=iso-8859-1\n'
+            'Content-Transfer-Encoding: quoted-printable\n'
+            '\n'
+            'caf=E9 with a soft=\n'
+            ' break\n'
+            '--ALT--\n'
+            '--OUT\n'
+            'Content-Type: application/octet-stream\n'
+            'Content-Disposition: attachment; filename="../x.bin"\n'
+            'Content-Transfer-Encoding: base64\n'
+            '\n'
+            'AAECAw==\n'
+            '--OUT--\n'
+            'epilogue\n')
+        text, attachments = fields[3], fields[5]
+        self.assertTrue('caf\xc3\xa9 with a soft break' in text)
+        self.assertFalse('html' in text)
+        self.assertFalse('epilogue' in text)
+        self.assertEqual(len(attachments), 1)
+        filename, content_type, size, digest = attachments[0]
+        self.assertEqual(filename, 'x.bin')
+        self.assertEqual(content_type, 'application/octet-stream')
+        self.assertEqual(size, 4)
+        with open(get_blob_path(digest), 'rb') as f:
+            self.assertEqual(f.read(), '\x00\x01\x02\x03')
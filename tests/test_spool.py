@@ -0,0 +1,206 @@
+# This file is part of Heapkeeper.
+#
+# Heapkeeper is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Heapkeeper is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Heapkeeper.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright (C) 2012 Csaba Hoch
+
+# Tests of the spool of the SMTP service (hk.emaillistener).
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+from StringIO import StringIO
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.test import TestCase
+from django.utils import unittest
+from hk import emaillistener
+from hk import ingestcache
+from hk.emaillistener import MailService, Spool, store_mails
+from hk.models import *
+
+
+def make_mail(message_id, text='text'):
+    return ('From: user@example.org\r\n'
+            'Subject: Subject\r\n'
+            'Message-ID: %s\r\n'
+            '\r\n'
+            '%s\r\n' % (message_id, text))
+
+
+class SpoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.spool = Spool(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_add_claim_read(self):
+        self.spool.add('user@example.org', ['h@example.org'],
+                       make_mail('<1@x>'))
+        self.assertEqual(self.spool.count(), 1)
+        name, = self.spool.claim(10)
+        self.assertEqual(self.spool.claim(10), [])
+        mailfrom, rcpttos, received, mail = self.spool.read(name)
+        self.assertEqual((mailfrom, rcpttos),
+                         ('user@example.org', ['h@example.org']))
+        self.assertEqual(mail.get_fields()[1], '<1@x>')
+        self.spool.done(name)
+        self.assertEqual(os.listdir(self.spool.path('cur')), [])
+
+    def expire_delay(self):
+        # Makes the mail in "new" claimable again.
+        name, = os.listdir(self.spool.path('new'))
+        unique, attempts, not_before = name.rsplit(',', 2)
+        os.rename(self.spool.path('new', name),
+                  self.spool.path('new', '%s,%s,0' % (unique, attempts)))
+
+    def test_retry(self):
+        self.spool.add('user@example.org', ['h@example.org'],
+                       make_mail('<1@x>'))
+        name, = self.spool.claim(10)
+        self.assertTrue(self.spool.retry(name, 3))
+        # The mail is not tried again before its delay expires
+        self.assertEqual(self.spool.count(), 1)
+        self.assertEqual(self.spool.claim(10), [])
+        name, = os.listdir(self.spool.path('new'))
+        unique, attempts, not_before = name.rsplit(',', 2)
+        self.assertEqual(attempts, '1')
+        self.assertTrue(int(not_before) > time.time())
+
+        self.expire_delay()
+        name, = self.spool.claim(10)
+        self.assertTrue(self.spool.retry(name, 3))
+        self.expire_delay()
+        name, = self.spool.claim(10)
+        self.assertFalse(self.spool.retry(name, 3))
+        self.assertEqual(self.spool.count(), 0)
+        self.assertEqual(os.listdir(self.spool.path('failed')), [name])
+
+    def test_recover(self):
+        self.spool.add('user@example.org', ['h@example.org'],
+                       make_mail('<1@x>'))
+        name, = self.spool.claim(10)
+        self.spool.recover()
+        self.assertEqual(self.spool.claim(10), [name])
+
+
+class MailServiceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.old_smtp_dir = getattr(settings, 'HK_SMTP_DIR', None)
+        settings.HK_SMTP_DIR = self.directory
+        self.service = MailService(0, 1, 10, 3)
+        self.spool = self.service.spool
+        self.stored = []
+        self.old_store_mails = emaillistener.store_mails
+        emaillistener.store_mails = self.store_mails
+
+    def tearDown(self):
+        emaillistener.store_mails = self.old_store_mails
+        if self.old_smtp_dir is None:
+            del settings.HK_SMTP_DIR
+        else:
+            settings.HK_SMTP_DIR = self.old_smtp_dir
+        shutil.rmtree(self.directory)
+
+    def store_mails(self, mails):
+        # Stands in for the database: the mails with "wrong" in their text
+        # cannot be stored.
+        for mail in mails:
+            if 'wrong' in mail[5]:
+                raise ValueError('wrong mail')
+        self.stored.extend(mail[3] for mail in mails)
+
+    def store_spooled(self):
+        # Stores the spooled mails, hiding the errors printed.
+        stdout, stderr = sys.stdout, sys.stderr
+        sys.stdout = sys.stderr = StringIO()
+        try:
+            self.service.store(self.spool.claim(10))
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+
+    def test_store(self):
+        for i in range(3):
+            self.spool.add('user@example.org', ['h@example.org'],
+                           make_mail('<%d@x>' % i))
+        self.store_spooled()
+        self.assertEqual(self.stored, ['<0@x>', '<1@x>', '<2@x>'])
+        self.assertEqual(self.spool.count(), 0)
+        counters = self.service.counters.get()
+        self.assertEqual((counters['stored'], counters['batches']), (3, 1))
+
+    def test_retry_wrong_mail(self):
+        # The batch fails, so the mails are stored one by one and only the
+        # wrong one is retried
+        self.spool.add('user@example.org', ['h@example.org'],
+                       make_mail('<1@x>'))
+        self.spool.add('user@example.org', ['h@example.org'],
+                       make_mail('<2@x>', 'wrong'))
+        self.spool.add('user@example.org', ['h@example.org'],
+                       make_mail('<3@x>'))
+        self.store_spooled()
+        self.assertEqual(self.stored, ['<1@x>', '<3@x>'])
+        self.assertEqual(self.spool.count(), 1)
+        counters = self.service.counters.get()
+        self.assertEqual((counters['stored'], counters['retried']), (2, 1))
+
+    def test_unreadable_mail(self):
+        self.spool.add('user@example.org', ['h@example.org'],
+                       make_mail('<1@x>'))
+        with open(self.spool.path('new', 'broken,0,0'), 'wb') as f:
+            f.write('no envelope\n')
+        self.store_spooled()
+        self.assertEqual(self.stored, ['<1@x>'])
+        self.assertEqual(os.listdir(self.spool.path('new'))[0]
+                             .split(',')[:2],
+                         ['broken', '1'])
+
+
+class StoreStoredMailTest(TestCase):
+
+    def setUp(self):
+        # The cache is not rolled back with the database
+        ingestcache.get_ingest_cache().clear()
+        User.objects.create_user('user', 'user@example.org', 'password')
+        self.heap1 = Heap(short_name='h1', long_name='Heap 1', visibility=0)
+        self.heap1.save()
+        self.heap2 = Heap(short_name='h2', long_name='Heap 2', visibility=0)
+        self.heap2.save()
+
+    def store(self, rcpttos):
+        store_mails([('user@example.org', rcpttos, 'Subject', '<1@x>', None,
+                      'text')])
+
+    def get_heap_ids(self):
+        return sorted(Message.objects.filter(message_id='<1@x>')
+                          .values_list('root__conversation__heap',
+                                       flat=True))
+
+    def test_skip_stored(self):
+        # The service stopped after storing the mail but before removing it
+        # from the spool
+        self.store(['h1@example.org'])
+        self.store(['h1@example.org'])
+        self.assertEqual(self.get_heap_ids(), [self.heap1.id])
+
+    def test_skip_only_stored_heaps(self):
+        self.store(['h1@example.org'])
+        self.store(['h1@example.org', 'h2@example.org'])
+        self.assertEqual(self.get_heap_ids(), [self.heap1.id, self.heap2.id])
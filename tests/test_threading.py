@@ -0,0 +1,91 @@
+# This file is part of Heapkeeper.
+#
+# Heapkeeper is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Heapkeeper is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Heapkeeper.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright (C) 2012 Csaba Hoch
+
+# Tests of threading received mails (hk.emaillistener).
+
+from django.contrib.auth.models import User
+from django.test import TestCase
+from hk import emaillistener
+from hk import ingestcache
+from hk.emaillistener import message_from_mail
+from hk.models import *
+
+
+class ThreadingTest(TestCase):
+
+    def setUp(self):
+        # The cache is not rolled back with the database
+        ingestcache.get_ingest_cache().clear()
+        User.objects.create_user('user', 'user@example.org', 'password')
+        self.heap = Heap(short_name='h', long_name='Heap', visibility=0)
+        self.heap.save()
+
+    def send(self, message_id, in_reply_to=None, references=()):
+        message_from_mail('user@example.org', ['h@example.org'],
+                          'Subject', message_id, in_reply_to,
+                          'text of %s' % message_id, references)
+        return Message.objects.get(message_id=message_id)
+
+    def get_parent_id(self, message_id):
+        return Message.objects.get(message_id=message_id) \
+                   .current_version.parent_id
+
+    def test_parent(self):
+        root = self.send('<1@x>')
+        reply = self.send('<2@x>', '<1@x>')
+        self.assertEqual(reply.current_version.parent_id, root.id)
+        self.assertEqual(reply.root_id, root.id)
+        self.assertFalse(Conversation.objects.filter(root_message=reply)
+                             .exists())
+
+    def test_references(self):
+        # The closest ancestor that exists is the parent
+        root = self.send('<1@x>')
+        reply = self.send('<3@x>', '<2@x>', ['<1@x>', '<2@x>'])
+        self.assertEqual(reply.current_version.parent_id, root.id)
+        self.assertEqual(PendingReply.objects.filter(message=reply)
+                             .values_list('awaited', flat=True)[0],
+                         '<2@x>')
+
+    def test_pending_replies(self):
+        # The replies arrive before their parents
+        grandchild = self.send('<3@x>', '<2@x>', ['<1@x>', '<2@x>'])
+        self.assertEqual(grandchild.current_version.parent_id, None)
+        child = self.send('<2@x>', '<1@x>')
+        self.assertEqual(self.get_parent_id('<3@x>'), child.id)
+        root = self.send('<1@x>')
+        self.assertEqual(self.get_parent_id('<2@x>'), root.id)
+        self.assertEqual(Conversation.objects.get().root_message_id, root.id)
+        self.assertEqual(Message.objects.get(pk=grandchild.id).path,
+                         '/%d/%d/%d/' % (root.id, child.id, grandchild.id))
+        self.assertFalse(PendingReply.objects.exists())
+
+    def test_parent_stored_concurrently(self):
+        # The parent is stored by another worker whose transaction was not
+        # committed when the reply was looked up, so the lookup did not find
+        # it; the reply is attached when its pending rows are written.
+        root = self.send('<1@x>')
+        look_up_messages = emaillistener.look_up_messages
+        emaillistener.look_up_messages = \
+            lambda message_ids: dict((message_id, ())
+                                     for message_id in message_ids)
+        try:
+            self.send('<2@x>', '<1@x>')
+        finally:
+            emaillistener.look_up_messages = look_up_messages
+        self.assertEqual(self.get_parent_id('<2@x>'), root.id)
+        self.assertEqual(Conversation.objects.get().root_message_id, root.id)
+        self.assertFalse(PendingReply.objects.exists())
@@ -0,0 +1,164 @@
+# This file is part of Heapkeeper.
+#
+# Heapkeeper is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Heapkeeper is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Heapkeeper.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright (C) 2012 Csaba Hoch
+
+# Tests of the storage of old versions as deltas (hk.textdelta) and
+# their pruning (hk.retention).
+
+import datetime
+from django.contrib.auth.models import User
+from django.test import TestCase
+from django.utils import unittest
+from hk.models import *
+from hk.retention import prune_message, select_pruned_versions
+from hk.textdelta import apply_delta, make_delta
+
+
+class TextDeltaTest(unittest.TestCase):
+
+    def assertRoundTrip(self, base, text):
+        delta = make_delta(base, text)
+        self.assertEqual(apply_delta(base, delta), text)
+
+    def test_same_text(self):
+        self.assertEqual(make_delta(u'a\nb\n', u'a\nb\n'), u'')
+        self.assertEqual(apply_delta(u'a\nb\n', u''), u'a\nb\n')
+
+    def test_round_trip(self):
+        base = u'first\nsecond\nthird\n'
+        self.assertRoundTrip(base, u'first\nchanged\nthird\n')
+        self.assertRoundTrip(base, u'zeroth\n' + base + u'fourth')
+        self.assertRoundTrip(base, u'')
+        self.assertRoundTrip(u'', base)
+        self.assertRoundTrip(u'no newline', u'no newline\nat the end')
+
+    def test_line_separators(self):
+        # splitlines breaks lines at these too, not only at "\n"
+        for separator in (u'\r', u'\r\n', u'\x0b', u'\x0c', u'\x1c',
+                          u'\x1d', u'\x1e', u'\x85', u'\u2028', u'\u2029'):
+            base = separator.join([u'a', u'b', u'c', u''])
+            text = separator.join([u'a', u'x', u'c', u'd'])
+            self.assertRoundTrip(base, text)
+            self.assertRoundTrip(text, base)
+            self.assertRoundTrip(base, base.replace(separator, u'\n'))
+
+    def test_mixed_separators(self):
+        base = u'a\r\nb\rc\nd\u2028e'
+        self.assertRoundTrip(base, u'a\r\nb\nc\rd\u2028e\r')
+        self.assertRoundTrip(base, u'a\r\nX\rc\nd\u2028e')
+
+
+class SelectPrunedVersionsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = datetime.datetime.now()
+
+    def select(self, texts, ages, keep_versions=None, collapse_after_days=None,
+               current_id=None):
+        # The versions get the ids 1, 2, ... in the order of their dates; the
+        # ages are given in days.
+        versions = [MessageVersion(id=i + 1,
+                                   version_date=self.now -
+                                                datetime.timedelta(days=age))
+                    for i, age in enumerate(ages)]
+        policy = RetentionPolicy(keep_versions=keep_versions,
+                                 collapse_after_days=collapse_after_days)
+        if current_id is None:
+            current_id = len(versions)
+        return select_pruned_versions(
+                   versions,
+                   dict((i + 1, text) for i, text in enumerate(texts)),
+                   current_id, policy, self.now)
+
+    def test_no_policy(self):
+        self.assertEqual(self.select([u'a', u'a', u'b'], [3, 2, 1]), [])
+
+    def test_keep_versions(self):
+        texts = [u'a', u'b', u'c', u'd', u'e', u'f']
+        ages = [6, 5, 4, 3, 2, 1]
+        self.assertEqual(self.select(texts, ages, keep_versions=2), [2, 3, 4])
+        # The first and the current versions are always kept
+        self.assertEqual(self.select(texts, ages, keep_versions=0),
+                         [2, 3, 4, 5])
+        self.assertEqual(self.select(texts, ages, keep_versions=0,
+                                     current_id=3),
+                         [2, 4, 5])
+        self.assertEqual(self.select(texts[:2], ages[:2], keep_versions=0),
+                         [])
+
+    def test_collapse(self):
+        # Of the versions that did not change the text (2-4 and 6), only the
+        # last one of each run is kept, if they are old enough
+        texts = [u'a', u'a', u'a', u'a', u'b', u'b', u'c']
+        ages = [20, 19, 18, 17, 16, 15, 1]
+        self.assertEqual(self.select(texts, ages, collapse_after_days=10),
+                         [2, 3])
+        self.assertEqual(self.select(texts, ages, collapse_after_days=30),
+                         [])
+        ages = [20, 19, 5, 4, 3, 2, 1]
+        self.assertEqual(self.select(texts, ages, collapse_after_days=10),
+                         [2])
+
+
+class VersionHistoryTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user('user', 'user@example.org',
+                                             'password')
+        self.heap = Heap(short_name='h', long_name='Heap', visibility=0)
+        self.heap.save()
+        now = datetime.datetime.now()
+        self.msg = Message()
+        self.msg.save()
+        MessageVersion(message=self.msg, author=self.user,
+                       creation_date=now, version_date=now,
+                       text=u'line 1\nline 2\n').save()
+        Conversation(heap=self.heap, subject='subject',
+                     root_message=self.msg).save()
+
+    def get_texts(self):
+        # Returns the text of each version of the message, by id.
+        return dict((version.id, version.get_text())
+                    for version in
+                    MessageVersion.objects.filter(message=self.msg))
+
+    def test_compress_prune_get_text(self):
+        texts = [u'line 1\nline 2\n', u'line 1\nline 2\nline 3\n',
+                 u'line 0\r\nline 1\nline 2\nline 3\n', u'\u2028\n',
+                 u'line 1\rline 2\n', u'line 1\rline 2\n', u'final\n']
+        for text in texts[1:]:
+            Message.objects.get(pk=self.msg.id).change(text=text)
+        expected = self.get_texts()
+        self.assertEqual(sorted(expected.values()), sorted(texts))
+
+        compress_versions(self.msg.id)
+        self.assertEqual(self.get_texts(), expected)
+        self.assertTrue(MessageVersion.objects
+                            .filter(message=self.msg,
+                                    text_base__isnull=False)
+                            .exists())
+
+        policy = RetentionPolicy(heap=self.heap, keep_versions=2)
+        policy.save()
+        stats = prune_message(self.msg.id, policy, datetime.datetime.now())
+        self.assertEqual(stats.versions, len(texts) - 3)
+        remaining = self.get_texts()
+        self.assertEqual(len(remaining), 3)
+        for version_id, text in remaining.iteritems():
+            self.assertEqual(text, expected[version_id])
+
+        msg = Message.objects.get(pk=self.msg.id)
+        self.assertEqual(msg.current_version.text_base_id, None)
+        self.assertEqual(msg.current_version.text, u'final\n')
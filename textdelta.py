@@ -0,0 +1,76 @@
+# This file is part of Heapkeeper.
+#
+# Heapkeeper is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Heapkeeper is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Heapkeeper.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright (C) 2012 Csaba Hoch
+
+# Line based deltas between texts.
+#
+# The old versions of the messages are stored as deltas against a newer
+# version (see MessageVersion.text_base). A delta is a JSON list whose items
+# are either [first, last] pairs, which copy the lines first..last-1 of the
+# base text, or strings, which are inserted as they are. The empty string
+# means that the text is the same as the base text.
+
+import difflib
+import json
+
+def make_delta(base, text):
+    """Calculates the delta that creates `text` from `base`.
+
+    **Arguments:**
+
+    - `base` (unicode)
+    - `text` (unicode)
+
+    **Returns:** unicode
+    """
+
+    if text == base:
+        return u''
+    base_lines = base.splitlines(True)
+    lines = text.splitlines(True)
+    matcher = difflib.SequenceMatcher(None, base_lines, lines, autojunk=False)
+    items = []
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            items.append([i1, i2])
+        elif j1 < j2:
+            inserted = u''.join(lines[j1:j2])
+            if items and isinstance(items[-1], unicode):
+                items[-1] += inserted
+            else:
+                items.append(inserted)
+    return unicode(json.dumps(items, separators=(',', ':')))
+
+def apply_delta(base, delta):
+    """Creates a text from its base and a delta returned by `make_delta`.
+
+    **Arguments:**
+
+    - `base` (unicode)
+    - `delta` (unicode)
+
+    **Returns:** unicode
+    """
+
+    if delta == u'':
+        return base
+    base_lines = base.splitlines(True)
+    parts = []
+    for item in json.loads(delta):
+        if isinstance(item, list):
+            parts.extend(base_lines[item[0]:item[1]])
+        else:
+            parts.append(item)
+    return u''.join(parts)
@@ -0,0 +1,232 @@
+# This file is part of Heapkeeper.
+#
+# Heapkeeper is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Heapkeeper is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Heapkeeper.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright (C) 2012 Csaba Hoch
+
+from django.db.models import Count
+from hk.models import *
+
+# The maximum number of ids put into one "IN (...)" clause. SQLite does not
+# accept more than 999 parameters in a query.
+MAX_IDS_PER_QUERY = 500
+
+
+##### Thread tree
+
+class ThreadNode(object):
+    """A message of a thread together with its current version.
+
+    The nodes are created by `load_thread`. The children of a node are the
+    non-deleted messages whose current parent is the message of the node,
+    sorted by their creation date. If the replies of the message were not
+    loaded, `hidden` is the number of replies.
+    """
+
+    __slots__ = ('message', 'version', 'labels', 'children', 'hidden')
+
+    def __init__(self, message):
+        self.message = message
+        self.version = message.current_version
+        self.labels = []
+        self.children = []
+        self.hidden = 0
+
+    def find(self, message_id):
+        """Returns the node of the given message in the subtree of this node,
+        or ``None`` if there is no such node."""
+
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if node.message.id == message_id:
+                return node
+            stack.extend(node.children)
+        return None
+
+    def walk(self):
+        """Yields the nodes of the subtree in the order they are displayed,
+        together with their depth relative to this node.
+
+        **Returns:** iterable((ThreadNode, int))
+        """
+
+        stack = [(self, 0)]
+        while stack:
+            node, depth = stack.pop()
+            yield node, depth
+            for child in reversed(node.children):
+                stack.append((child, depth + 1))
+
+    def count(self):
+        """Returns the number of nodes in the subtree."""
+
+        return sum(1 for _ in self.walk())
+
+
+def chunks(l, size=MAX_IDS_PER_QUERY):
+    for i in range(0, len(l), size):
+        yield l[i:i + size]
+
+def current_messages():
+    return Message.objects \
+               .filter(current_version__deleted=False) \
+               .select_related('current_version', 'current_version__author')
+
+def load_thread(root, max_depth=None, max_nodes=None):
+    """Loads the thread under the given message.
+
+    If the thread has at most `max_nodes` messages, they are selected by their
+    materialized path in one query. Otherwise the thread is loaded breadth
+    first until `max_nodes` messages are loaded. Replies deeper than
+    `max_depth` levels are not loaded either.
+
+    **Arguments:**
+
+    - `root` (Message)
+    - `max_depth` (int | None)
+    - `max_nodes` (int | None)
+
+    **Returns:** ThreadNode
+    """
+
+    root = Message.objects \
+               .select_related('current_version', 'current_version__author') \
+               .get(pk=root.pk)
+    if root.current_version is None:
+        # The current_version pointer has not been backfilled yet
+        root.current_version = root.find_latest_version()
+    root_node = ThreadNode(root)
+    if root.path and (max_nodes is None or
+                      count_subtree(root) <= max_nodes):
+        nodes = load_subtree(root_node)
+    else:
+        nodes = load_levels(root_node, max_depth, max_nodes)
+
+    for node in nodes.itervalues():
+        node.children.sort(key=lambda n: (n.version.creation_date,
+                                          n.message.id))
+    if max_depth is not None:
+        prune(root_node, nodes, max_depth)
+    load_labels(nodes.values())
+    return root_node
+
+def count_subtree(root):
+    return Message.objects \
+               .filter(root=root.root_id, path__startswith=root.path) \
+               .count()
+
+def load_subtree(root_node):
+    root = root_node.message
+    nodes = {root.id: root_node}
+    messages = current_messages() \
+                   .filter(root=root.root_id,
+                           path__startswith=root.path) \
+                   .exclude(pk=root.id)
+    for msg in messages:
+        nodes[msg.id] = ThreadNode(msg)
+    for msg_id, node in nodes.items():
+        if msg_id == root.id:
+            continue
+        parent = nodes.get(node.version.parent_id)
+        if parent is None:
+            # The parent is deleted; fsck reports these
+            del nodes[msg_id]
+        else:
+            parent.children.append(node)
+    return nodes
+
+def load_levels(root_node, max_depth=None, max_nodes=None):
+    # Loads the thread breadth first with one query per level. The replies of
+    # a message are loaded either all or none, and the number of the replies
+    # not loaded is stored in the `hidden` attribute of the nodes.
+    #
+    # This is also used when the paths have not been backfilled yet.
+    root = root_node.message
+    nodes = {root.id: root_node}
+    level = [root.id]
+    depth = 0
+    not_loaded = []
+    full = False
+    while level:
+        if full or (max_depth is not None and depth >= max_depth):
+            not_loaded.extend(level)
+            break
+        next_level = []
+        for ids in chunks(level):
+            if full:
+                not_loaded.extend(ids)
+                continue
+            children = current_messages() \
+                           .filter(current_version__parent__in=ids) \
+                           .order_by('current_version__parent',
+                                     'current_version__creation_date',
+                                     'id')
+            if max_nodes is not None:
+                children = children[:max_nodes - len(nodes) + 1]
+            groups = {}
+            for child in children:
+                groups.setdefault(child.current_version.parent_id, []) \
+                    .append(child)
+            # The groups are processed in the order of the query, so only the
+            # last one may be incomplete, and it does not fit.
+            for parent_id in sorted(ids):
+                group = groups.get(parent_id, [])
+                if full or (max_nodes is not None and
+                            len(nodes) + len(group) > max_nodes):
+                    not_loaded.append(parent_id)
+                    full = True
+                    continue
+                for child in group:
+                    if child.id in nodes:
+                        # Parent loop; fsck reports these
+                        continue
+                    node = ThreadNode(child)
+                    nodes[child.id] = node
+                    nodes[parent_id].children.append(node)
+                    next_level.append(child.id)
+        level = next_level
+        depth += 1
+
+    for ids in chunks(not_loaded):
+        counts = Message.objects \
+                     .filter(current_version__deleted=False,
+                             current_version__parent__in=ids) \
+                     .values('current_version__parent') \
+                     .annotate(replies=Count('id'))
+        for row in counts:
+            nodes[row['current_version__parent']].hidden = row['replies']
+    return nodes
+
+def prune(root_node, nodes, max_depth):
+    # Removes the replies below max_depth from the tree and from `nodes`.
+    for node, depth in root_node.walk():
+        if depth == max_depth and node.children:
+            for child in node.children:
+                for descendant, _ in child.walk():
+                    del nodes[descendant.message.id]
+            node.hidden = len(node.children)
+            node.children = []
+
+def load_labels(nodes):
+    """Fills in the `labels` attribute of the given nodes."""
+
+    by_version = dict((node.version.id, node) for node in nodes)
+    through = MessageVersion.labels.through
+    for ids in chunks(by_version.keys()):
+        pairs = through.objects \
+                    .filter(messageversion__in=ids) \
+                    .order_by('id') \
+                    .values_list('messageversion', 'label')
+        for version_id, label in pairs:
+            by_version[version_id].labels.append(label)
@@ -35,12 +35,21 @@ urlpatterns = patterns('hk.views',
     url(r'^conversation/(?P<conv_id>\d+)/$',
         view='conversation',
         name='conversation'),
+    url(r'^replies/(?P<msg_id>\d+)/$',
+        view='replies',
+        name='replies'),
     url(r'^heap/(?P<heap_id>\d+)/$',
         view='heap',
         name='heap'),
+    url(r'^heap/(?P<obj_id>\d+)/labels/$',
+        view='heaplabels',
+        name='heaplabels'),
     url(r'^heap/$',
         view='heaps',
         name='heaps'),
+    url(r'^search/$',
+        view='search',
+        name='search'),
     url(r'^addmessage/$',
         view='addmessage',
         name='addmessage'),
@@ -80,6 +89,12 @@ urlpatterns = patterns('hk.views',
     url(r'^fsck/$',
         view='fsck',
         name='fsck'),
+    url(r'^fsck/(?P<job_id>\d+)/$',
+        view='fsck_job',
+        name='fsck_job'),
+    url(r'^attachment/(?P<attachment_id>\d+)/$',
+        view='attachment',
+        name='attachment'),
     url(r'^smtp/$',
         view='smtp',
         name='smtp'),
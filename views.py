@@ -19,19 +19,39 @@
 from django.shortcuts import get_object_or_404, render, redirect
 from django.http import HttpResponseRedirect, HttpResponse
 from django.template import RequestContext
+from django.template.defaultfilters import filesizeformat
+from django.template.loader import render_to_string
+from django.utils.html import escape
+from django.conf import settings
 from django import forms
 from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import ObjectDoesNotExist, PermissionDenied
 from django.http import Http404
 from django.core.urlresolvers import reverse
-from fsck import fsck
+from fsck import fsck, fsck_job
 from emaillistener import smtp, enable_smtp, disable_smtp
+from attachments import attachment
+from threads import chunks, load_thread
+from search import find_messages
+from labels import LabelExpressionError, change_labels, \
+                   delete_unused_labels, filter_conversations, \
+                   get_heap_labels, parse_labels, quote_label, \
+                   select_conversations
+import fragmentcache
 import django.db
+from django.db import transaction
 from hk.models import *
 import datetime
+import itertools
 import urllib, hashlib
 
+# Number of messages rendered at once by print_thread
+RENDER_BATCH_SIZE = 100
+
+# Placeholder of the thread in the template when it is streamed
+THREAD_MARKER = u'<!-- hk-thread -->'
+
 ##### Helper functions 
 
 def get_user_icon(user, heap, size):
@@ -50,25 +70,29 @@ def get_user_icon(user, heap, size):
     url += urllib.urlencode({'s': str(size), 'd': default})
     return url
 
-def format_labels(obj, conv=False, add_controls = False):
-    if conv:
-        labels_obj = obj
-    else:
-        labels_obj = obj.latest_version()
+def format_labels(obj, conv=False, add_controls=False, labels=None):
+    # `labels` is the list of label texts to display; if it is not given, the
+    # labels of `obj` are queried.
+    if labels is None:
+        if conv:
+            labels_obj = obj
+        else:
+            labels_obj = obj.latest_version()
+        labels = [label.pk for label in labels_obj.labels.all()]
     rmview = 'hk.views.remove%slabel' \
                 % ('conversation' if conv else 'message')
     addview = 'hk.views.add%slabel' \
                 % ('conversation' if conv else 'message')
     if add_controls:
         labels = [u'<span class="label">%s<a class="rmlabel" href="%s">\u00d7</a></span>'
-                    % (label.pk,
+                    % (label,
                         reverse(rmview,
-                                args=(label.pk, obj.id,)))
-                    for label in labels_obj.labels.all()]
+                                args=(label, obj.id,)))
+                    for label in labels]
     else: 
         labels = [u'<span class="label">%s</span>'
-                    % (label.pk,)
-                    for label in labels_obj.labels.all()]
+                    % (label,)
+                    for label in labels]
 
     if add_controls:
         labels.append('<a class="addlabel" href="%s">+</a>'
@@ -76,26 +100,42 @@ def format_labels(obj, conv=False, add_controls = False):
                             args=(obj.id,)))
     return '[%s]' % ', '.join([l for l in labels])
 
-def print_message(l, msg, request_user):
-    lv = msg.latest_version()
-    heap = msg.get_heap()
-    author = lv.author
-    gravatar_size = 70
-    gravatar_url = get_user_icon(author, heap, gravatar_size)
-
+def message_controls(author, request_user, right):
+    # Returns whether the label controls of a message are shown to the user
+    # who has the given right.
     if author is None:
-        controls = True
+        return True
     elif author == request_user:
         # The author can edit their own post if they can send
-        controls = heap.get_effective_userright(request_user) >= 1
+        return right >= 1
     else:
         # The author can edit sy else's post if they can alter
-        controls = heap.get_effective_userright(request_user) >= 2
+        return right >= 2
+
+def format_attachments(attachments):
+    l = ["<div class='attachments'>\n"]
+    for attachment in attachments:
+        l.append(u"<a class='attachment' href='%s'>%s</a> (%s)\n"
+                 % (reverse('hk.views.attachment', args=(attachment.id,)),
+                    escape(attachment.filename),
+                    filesizeformat(attachment.blob.size)))
+    l.append('</div>\n')
+    return u''.join(l)
+
+def format_message(node, heap, controls, attachments=()):
+    # Returns the HTML of the message of `node` (a ThreadNode) without its
+    # replies and without the closing tag. `attachments` are the Attachments
+    # of the version of the node.
+    msg = node.message
+    lv = node.version
+    author = lv.author
+    gravatar_size = 70
+    gravatar_url = get_user_icon(author, heap, gravatar_size)
 
-    children = msg.get_children()
     edit_url = reverse('hk.views.editmessage', args=(msg.id,))
     reply_url = reverse('hk.views.replymessage', args=(msg.id,))
     delete_url = reverse('hk.views.delmessage', args=(msg.id,))
+    l = []
     l.append("<div class='message'>\n")
     l.append("<div class='message_head'>\n")
 
@@ -115,7 +155,8 @@ def print_message(l, msg, request_user):
 
     l.append("<div class='message_head_line2'>\n")
     l.append('<span class="labels">\n%s\n</span>\n' \
-                % format_labels(msg, add_controls=controls))
+                % format_labels(msg, add_controls=controls,
+                                labels=node.labels))
     l.append('</div>\n') # end of 'message_head_line2'
 
     l.append("<div class='message_head_line3'>\n")
@@ -127,20 +168,152 @@ def print_message(l, msg, request_user):
     l.append('</div>\n') # end of 'message_head'
 
     l.append('<p>\n%s\n</p>\n' % lv.text)
-    for child in msg.get_children():
-        print_message(l, child, request_user)
-
-    l.append('</div>\n') # end of 'message'
-
-def add_children_recursively(l, root):
-    for child in root.get_children():
-        l.append(child)
-        add_children_recursively(l, child)
-
-def remove_children_recursively(l, root):
-    for child in root.get_children():
-        l.remove(child)
-        remove_children_recursively(l, child)
+    if attachments:
+        l.append(format_attachments(attachments))
+    return u''.join([unicode(s) for s in l])
+
+def render_messages(nodes, request_user, heap, right, heap_stamp):
+    # Returns the output of format_message for the given nodes as a {message
+    # id: html} dictionary. The messages found in the fragment cache are not
+    # rendered again.
+    keys = {}
+    for node in nodes:
+        controls = message_controls(node.version.author, request_user, right)
+        keys[node.message.id] = (node.version.id, controls)
+    cached = fragmentcache.get_messages(heap_stamp, keys.values())
+    attachments = {}
+    uncached = [key[0] for key in keys.values() if key not in cached]
+    for ids in chunks(uncached):
+        for attachment in Attachment.objects.filter(version__in=ids) \
+                              .select_related('blob').order_by('id'):
+            attachments.setdefault(attachment.version_id, []) \
+                .append(attachment)
+    rendered = {}
+    heads = {}
+    for node in nodes:
+        key = keys[node.message.id]
+        if key in cached:
+            heads[node.message.id] = cached[key]
+        else:
+            rendered[key] = format_message(node, heap, key[1],
+                                           attachments.get(key[0], ()))
+            heads[node.message.id] = rendered[key]
+    fragmentcache.set_messages(heap_stamp, rendered)
+    return heads
+
+def format_collapsed(node):
+    # Returns the placeholder of the replies of a message that were not loaded
+    url = reverse('hk.views.replies', args=(node.message.id,))
+    return ("<div class='collapsed'>\n"
+            "<a href='%s' onclick='return expand(this);'>%d %s not shown</a>\n"
+            "</div>\n"
+            % (url, node.hidden, 'reply' if node.hidden == 1 else 'replies'))
+
+def print_thread(root_node, request_user, heap, right):
+    # Yields the HTML of a thread loaded by load_thread in chunks. Messages
+    # are rendered in batches while the thread is walked, so the HTML of the
+    # whole thread is never in memory at once.
+    heap_stamp = fragmentcache.get_heap_stamp(heap.id)
+    walk = root_node.walk()
+    prev_depth = None
+    while True:
+        batch = list(itertools.islice(walk, RENDER_BATCH_SIZE))
+        if not batch:
+            break
+        heads = render_messages([node for node, depth in batch],
+                                request_user, heap, right, heap_stamp)
+        l = []
+        for node, depth in batch:
+            if prev_depth is not None:
+                # Closing the previous message and its ancestors that are
+                # not ancestors of this one
+                l.append('</div>\n' * (prev_depth - depth + 1))
+            l.append(heads[node.message.id])
+            if node.hidden:
+                l.append(format_collapsed(node))
+            prev_depth = depth
+        yield u''.join(l)
+    yield '</div>\n' * (prev_depth + 1)
+
+def render_thread(root_node, request_user, heap):
+    # Returns the HTML of a thread loaded by load_thread. The HTML of the
+    # whole thread is taken from the fragment cache when possible.
+    right = heap.get_effective_userright(request_user)
+    root_id = root_node.message.id
+    tier = fragmentcache.get_tier(request_user, right)
+    signature = fragmentcache.get_thread_signature(
+                    root_id, heap.id,
+                    [(node.version.id, node.hidden)
+                     for node, depth in root_node.walk()])
+    html = fragmentcache.get_thread(root_id, tier, signature)
+    if html is None:
+        html = u''.join(print_thread(root_node, request_user, heap, right))
+        fragmentcache.set_thread(root_id, tier, signature, html)
+    return html
+
+class StreamedContent(object):
+    """The content of a response that is produced while it is sent.
+
+    Django sends the `request_finished` signal, which turns off the user right
+    cache and closes the database connection, before the server iterates over
+    the content. So the iterator turns on the cache itself while the chunks
+    are produced, and turns it off and closes the database connection (which
+    the chunks reopened) when the iteration ends or the response is closed.
+    """
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.started = False
+        self.finished = False
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self.finished:
+            raise StopIteration
+        if not self.started:
+            self.started = True
+            enable_userright_cache()
+        try:
+            return self.chunks.next()
+        except:
+            self.close()
+            raise
+
+    def close(self):
+        if not self.finished:
+            self.finished = True
+            if self.started:
+                disable_userright_cache()
+                django.db.close_connection()
+
+def render_streaming(request, template, variables, chunks):
+    # Returns a response whose content is produced while it is sent: the
+    # template is rendered with THREAD_MARKER in place of the `l` variable,
+    # and the chunks are sent between the part before and after it.
+    variables['l'] = THREAD_MARKER
+    page = render_to_string(template, variables,
+                            context_instance=RequestContext(request))
+    head, tail = page.split(THREAD_MARKER, 1)
+    return HttpResponse(StreamedContent(itertools.chain([head], chunks,
+                                                        [tail])))
+
+def thread_limits():
+    # Returns the maximum depth and number of messages loaded for a thread;
+    # the rest is loaded on demand by the 'replies' view.
+    return (getattr(settings, 'HK_THREAD_MAX_DEPTH', 30),
+            getattr(settings, 'HK_THREAD_MAX_NODES', 1000))
+
+def add_children_recursively(l, node):
+    # The tree is walked without recursion, so that long reply chains do not
+    # hit the recursion limit of Python.
+    l.extend([child.message for child, depth in node.walk() if depth > 0])
+
+def remove_children_recursively(l, node):
+    removed = set([child.message.id for child, depth in node.walk()
+                   if depth > 0])
+    l[:] = [msg for msg in l if msg.id not in removed]
 
 ##### Simple views
 
@@ -158,12 +331,11 @@ def conversation(request, conv_id):
     conv = get_object_or_404(Conversation, pk=conv_id)
     conv.heap.check_access(request.user, 0)
     root = conv.root_message
-    l = []
     if not root.is_deleted():
-        print_message(l, root, request.user)
+        max_depth, max_nodes = thread_limits()
+        root_node = load_thread(root, max_depth, max_nodes)
     else:
         raise Http404
-    ls = [unicode(m) for m in l]
     effective_right = conv.heap.get_effective_userright(request.user)
     rlv = conv.root_message.latest_version()
     if rlv.author is None:
@@ -174,32 +346,135 @@ def conversation(request, conv_id):
         else:
             needed_right = 2 
     add_controls = effective_right >= needed_right
+    variables = {
+            'conv': conv,
+            'add_controls': add_controls,
+            'conv_labels': format_labels(conv, conv=True, 
+                                         add_controls=add_controls
+            ),
+        }
+
+    # Big threads are sent while they are rendered
+    stream_threshold = getattr(settings, 'HK_STREAM_THRESHOLD', 500)
+    if stream_threshold is not None and root_node.count() > stream_threshold:
+        chunks = print_thread(root_node, request.user, conv.heap,
+                              effective_right)
+        return render_streaming(request, 'conversation.html', variables,
+                                chunks)
+
+    variables['l'] = render_thread(root_node, request.user, conv.heap)
     return render(
             request,
             'conversation.html',
-            {'conv': conv,
-             'add_controls': add_controls,
-             'conv_labels': format_labels(conv, conv=True, 
-                                          add_controls=add_controls
-             ),
-             'l': '\n'.join(ls)}
+            variables
         )
 
+def replies(request, msg_id):
+    # Returns the HTML of the replies of a message that were collapsed by
+    # format_collapsed.
+    msg = get_object_or_404(Message, pk=msg_id)
+    heap = msg.get_heap()
+    heap.check_access(request.user, 0)
+    if msg.is_deleted():
+        raise Http404
+    max_depth, max_nodes = thread_limits()
+    if max_depth is not None:
+        # The replies are one level below msg
+        max_depth += 1
+    node = load_thread(msg, max_depth, max_nodes)
+    right = heap.get_effective_userright(request.user)
+    chunks = itertools.chain(*[print_thread(child, request.user, heap, right)
+                               for child in node.children])
+    return HttpResponse(StreamedContent(chunks))
+
+CURSOR_FORMAT = '%Y%m%d%H%M%S%f'
+
+def make_cursor(conv):
+    return '%s-%d' % (conv.last_activity.strftime(CURSOR_FORMAT), conv.id)
+
+def parse_cursor(cursor):
+    # Returns the (last activity, id) pair encoded by make_cursor.
+    try:
+        last_activity, conv_id = cursor.split('-')
+        return (datetime.datetime.strptime(last_activity, CURSOR_FORMAT),
+                int(conv_id))
+    except ValueError:
+        raise Http404
+
+def get_conversation_page(convs, cursor):
+    """Returns a page of the conversations of a heap, the ones with the most
+    recent activity first.
+
+    The page is selected by the position of the last conversation of the
+    previous page instead of an offset, so it costs the same on every page.
+
+    **Arguments:**
+
+    - `convs` (QuerySet) -- The conversations of the heap (maybe filtered by
+      labels).
+    - `cursor` (str | None) -- Returned by this function for the previous
+      page; ``None`` for the first page.
+
+    **Returns:** ([Conversation], str | None) -- The conversations and the
+    cursor of the next page (``None`` on the last page).
+    """
+
+    page_size = getattr(settings, 'HK_HEAP_PAGE_SIZE', 50)
+    convs = convs.order_by('-last_activity', '-id')
+    if cursor is not None:
+        last_activity, conv_id = parse_cursor(cursor)
+        convs = convs.filter(Q(last_activity__lt=last_activity) |
+                             Q(last_activity=last_activity, id__lt=conv_id))
+    convs = list(convs[:page_size + 1])
+    if len(convs) > page_size:
+        return convs[:page_size], make_cursor(convs[page_size - 1])
+    else:
+        return convs, None
+
 def heap(request, heap_id):
     heap = get_object_or_404(Heap, pk=heap_id)
     heap.check_access(request.user, 0)
-    heapadmin = heap.get_effective_userright(request.user) == 3
+    user_right = heap.get_effective_userright(request.user)
+    heapadmin = user_right == 3
+    cursor = request.GET.get('before')
+    expression = request.GET.get('labels', '').strip()
     convs = Conversation.objects.filter(heap=heap)
+    expression_error = None
+    if expression:
+        try:
+            convs = filter_conversations(convs, expression)
+        except LabelExpressionError, e:
+            expression_error = unicode(e)
+            convs = convs.none()
+    if expression_error is None:
+        page, next_cursor = get_conversation_page(convs, cursor)
+    else:
+        page, next_cursor = [], None
+    # The labels of the listed conversations, each with the expression that
+    # narrows the listing to it
+    labels = []
+    if expression_error is None:
+        for label, conversations, messages in \
+                get_heap_labels(heap, convs if expression else None):
+            if expression:
+                narrowed = u'(%s) and %s' % (expression, quote_label(label))
+            else:
+                narrowed = quote_label(label)
+            labels.append((label, conversations, messages, narrowed))
     visibility = heap.get_visibility_display
 
     # We do not display all userrights, only the effective ones, ie. the
     # highest value for each name.
     urights = []
-    for user in heap.users():
-        right = heap.get_effective_userright(user)
+    erights = EffectiveRight.objects \
+                  .filter(heap=heap, given_right__gte=0) \
+                  .select_related('user') \
+                  .order_by('user__username')
+    for eright in erights:
+        right = eright.right
         urights.append({
-                'uid': user.id,
-                'name': user,
+                'uid': eright.user.id,
+                'name': eright.user,
                 'verb': ('is'
                     if right == 3
                     else 'can'),
@@ -223,20 +498,96 @@ def heap(request, heap_id):
             'heap.html',
             {'heap': heap,
              'visibility': visibility,
-             'convs': convs,
+             'convs': page,
+             'expression': expression,
+             'expression_error': expression_error,
+             'first_page': cursor is None,
+             'next_cursor': next_cursor,
              'urights': urights,
-             'heapadmin': heapadmin}
+             'labels': labels,
+             'heapadmin': heapadmin,
+             'can_alter': user_right >= 2}
         )
 
 def heaps(request):
-    heaps = [heap for heap in Heap.objects.all()
-                if heap.is_visible_for(request.user)]
+    heaps = Heap.get_visible_heaps(request.user)
     return render(
             request,
             'heaps.html',
             {'heaps': heaps}
         )
 
+##### Search
+
+SNIPPET_LENGTH = 200
+
+def search(request):
+    query = request.GET.get('q', '').strip()
+    heap_id = request.GET.get('heap')
+    try:
+        page = int(request.GET.get('page', 1))
+    except ValueError:
+        raise Http404
+    if page < 1:
+        raise Http404
+    if heap_id:
+        if not heap_id.isdigit():
+            raise Http404
+        heap = get_object_or_404(Heap, pk=int(heap_id))
+        heap.check_access(request.user, 0)
+        heap_ids = [heap.id]
+    else:
+        heap = None
+        heap_ids = list(Heap.get_visible_heaps(request.user) \
+                            .values_list('id', flat=True))
+
+    page_size = getattr(settings, 'HK_SEARCH_PAGE_SIZE', 20)
+    if query:
+        ids = find_messages(query, heap_ids, (page - 1) * page_size,
+                            page_size + 1)
+    else:
+        ids = []
+    has_next = len(ids) > page_size
+    ids = ids[:page_size]
+
+    messages = Message.objects \
+                   .select_related('current_version',
+                                   'current_version__author') \
+                   .in_bulk(ids)
+    convs = {}
+    root_ids = [msg.root_id for msg in messages.itervalues()]
+    for conv in Conversation.objects.filter(root_message__in=root_ids):
+        convs[conv.root_message_id] = conv
+    results = []
+    for msg_id in ids:
+        # The message may have been deleted since it was indexed
+        msg = messages.get(msg_id)
+        if msg is None:
+            continue
+        text = msg.current_version.text
+        if len(text) > SNIPPET_LENGTH:
+            text = text[:SNIPPET_LENGTH] + '...'
+        results.append({'message': msg,
+                        'version': msg.current_version,
+                        'conv': convs.get(msg.root_id),
+                        'snippet': text})
+
+    def page_url(page):
+        params = {'q': query.encode('utf-8'), 'page': page}
+        if heap is not None:
+            params['heap'] = heap.id
+        return '%s?%s' % (reverse('hk.views.search'), urllib.urlencode(params))
+
+    return render(
+            request,
+            'search.html',
+            {'query': query,
+             'heap': heap,
+             'results': results,
+             'prev_url': page_url(page - 1) if page > 1 else None,
+             'next_url': page_url(page + 1) if has_next else None}
+        )
+
 def removeconversationlabel(request, label_text, obj_id):
     conv = get_object_or_404(Conversation, pk=obj_id)
     root_author = conv.root_message.latest_version().author
@@ -250,11 +601,10 @@ def removeconversationlabel(request, label_text, obj_id):
     label = get_object_or_404(Label, pk=label_text)
     conv.labels.remove(label)
     conv.save()
-    if label.messageversion_set.count() == 0 \
-            and label.conversation_set.count() == 0:
-        label.delete()
+    delete_unused_labels([label.text])
     return redirect(reverse('hk.views.conversation', args=(conv.id,)))
 
+@transaction.commit_on_success
 def removemessagelabel(request, label_text, obj_id):
     msg = get_object_or_404(Message, pk=obj_id)
     conv = msg.get_conversation()
@@ -281,10 +631,9 @@ def removemessagelabel(request, label_text, obj_id):
         )
     mv.save()
     mv.labels = labels
+    mv.copy_attachments(lv)
     mv.save()
-    if label.messageversion_set.count() == 0 \
-            and label.conversation_set.count() == 0:
-        label.delete()
+    delete_unused_labels([label.text])
     return redirect(reverse('hk.views.conversation', args=(conv.id,)))
 
 ##### Generic framework for form-related views
@@ -341,8 +690,7 @@ def front(request):
         username = user.username
     else:
         username = None
-    heaps = [heap for heap in Heap.objects.all()
-                if heap.is_visible_for(user)]
+    heaps = Heap.get_visible_heaps(user)
     return render(
                request,
                'front.html',
@@ -450,6 +798,7 @@ def addconv_creation_access_controller(variables):
         needed_level = 1
     heap.check_access(variables['request'].user, needed_level)
 
+@transaction.commit_on_success
 def addconv_creator(variables):
     now = datetime.datetime.now()
     root_msg = Message()
@@ -547,6 +896,7 @@ def addmessage_init(variables):
         }
 
 
+@transaction.commit_on_success
 def addmessage_creator(variables):
     now = datetime.datetime.now()
     msg = Message()
@@ -597,6 +947,7 @@ def delmessage_init(variables):
     msg_id = variables['obj_id']
     variables['message'] = Message.objects.get(pk=msg_id)
 
+@transaction.commit_on_success
 def delmessage_creator(variables):
     message = variables['message']
     heap = message.get_heap()
@@ -719,29 +1070,33 @@ def editmessage_init(variables):
 
 def editmessage_form_postprocessor(variables):
     msg = variables['m']
-    root = msg.get_root_message()
-    possible_parents = [root]
-    add_children_recursively(possible_parents, root)
+    root_node = load_thread(msg.get_root_message())
+    possible_parents = [root_node.message]
+    add_children_recursively(possible_parents, root_node)
     possible_parents.remove(msg)
-    remove_children_recursively(possible_parents, msg)
+    remove_children_recursively(possible_parents, root_node.find(msg.id))
     choices = [(msg.id, msg) for msg in possible_parents]
     choices.append((0, '(none)'))
     variables['form'].fields['parent'].choices = choices
 
+@transaction.commit_on_success
 def editmessage_creator(variables):
-    # TODO It is still possible to create a loop via a crafted POST. Such cases
-    # should be detected and denied.
     now = datetime.datetime.now()
     form = variables['form']
     msg = Message.objects.get(id=variables['obj_id'])
     msg_conv = msg.get_conversation()
     heap = msg.get_heap()
-    curr_parent = msg.latest_version().parent
-    curr_labels = list(msg.latest_version().labels.all())
+    curr_version = msg.latest_version()
+    curr_parent = curr_version.parent
+    curr_labels = list(curr_version.labels.all())
     try:
         new_parent = form.cleaned_data['parent']
     except DoesNotExist:
         new_parent = None
+    if new_parent is not None and msg.is_ancestor_of(new_parent):
+        variables['error_message'] = \
+            'A message cannot be moved below one of its replies.'
+        return
     mv = MessageVersion(
             message=msg,
             parent=new_parent,
@@ -752,6 +1107,7 @@ def editmessage_creator(variables):
         )
     mv.save()
     mv.labels = curr_labels
+    mv.copy_attachments(curr_version)
     mv.save()
     # Joining conversations
     if curr_parent is None and new_parent is not None:
@@ -817,6 +1173,7 @@ def replymessage_creation_access_controller(variables):
     parent.get_heap().check_access(variables['request'].user,
                                    needed_level)
 
+@transaction.commit_on_success
 def replymessage_creator(variables):
     now = datetime.datetime.now()
     msg = Message()
@@ -986,6 +1343,79 @@ addmessagelabel = make_view(
                 addconversationlabel_access_controller
             )
 
+##### "Heap labels" view
+
+class LabelListField(forms.CharField):
+
+    def clean(self, value):
+        labels = parse_labels(super(LabelListField, self).clean(value))
+        for label in labels:
+            if len(label) > 64:
+                raise forms.ValidationError(
+                          'Labels can be at most 64 characters long.')
+        return labels
+
+
+class HeapLabelsForm(forms.Form):
+    add = LabelListField(required=False,
+                         help_text='Comma separated labels to add')
+    remove = LabelListField(required=False,
+                            help_text='Comma separated labels to remove')
+    target = forms.ChoiceField(choices=(('conversations', 'Conversations'),
+                                        ('messages', 'Their messages')))
+    conversation = forms.TypedMultipleChoiceField(
+                       coerce=int, required=False,
+                       widget=forms.MultipleHiddenInput)
+    label = forms.CharField(required=False,
+                            help_text='If no conversation is selected, the '
+                                      'conversations with this label are '
+                                      'changed')
+
+    def clean(self):
+        data = self.cleaned_data
+        if not data.get('add') and not data.get('remove'):
+            raise forms.ValidationError('No labels given.')
+        if not data.get('conversation') and not data.get('label'):
+            raise forms.ValidationError('No conversations selected.')
+        return data
+
+def heaplabels_init(variables):
+    variables['heap'] = get_object_or_404(Heap, pk=variables['obj_id'])
+
+def heaplabels_postprocessor(variables):
+    # The conversations of the heap can be chosen
+    request = variables['request']
+    ids = [value for value in request.POST.getlist('conversation')
+           if value.isdigit()]
+    variables['form'].fields['conversation'].choices = \
+        [(conv_id, conv_id) for conv_id in
+         Conversation.objects.filter(heap=variables['heap'], pk__in=ids)
+                             .values_list('id', flat=True)]
+
+def heaplabels_creator(variables):
+    data = variables['form'].cleaned_data
+    convs = select_conversations(variables['heap'],
+                                 data['conversation'] or None,
+                                 data['label'] or None)
+    changed = change_labels(convs, data['add'], data['remove'],
+                            data['target'] == 'messages')
+    variables['error_message'] = '%d %s changed.' % (changed, data['target'])
+
+def heaplabels_access_controller(variables):
+    # Changing the labels of other people's posts needs alter (2) rights.
+    variables['heap'].check_access(variables['request'].user, 2)
+
+heaplabels = make_view(
+                HeapLabelsForm,
+                heaplabels_init,
+                heaplabels_creator,
+                make_displayer('heaplabels.html',
+                    ('error_message', 'form', 'obj_id', 'heap')),
+                heaplabels_access_controller,
+                heaplabels_access_controller,
+                heaplabels_postprocessor
+            )
+
 ##### "Edit subject" view
 
 class EditSubjectForm(forms.Form):